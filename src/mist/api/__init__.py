@@ -97,6 +97,10 @@ def main(global_config, **settings):
     # Add CSV renderer
     configurator.add_renderer('csv', 'mist.api.renderers.CSVRenderer')
 
+    # Add streaming JSON renderer for large lists
+    configurator.add_renderer('json_stream',
+                              'mist.api.renderers.StreamingJSONRenderer')
+
     configurator.add_static_view('docs', path='../../../docs/build')
 
     # FIXME this should not be necessary
@@ -201,6 +205,7 @@ def add_routes(configurator):
 
     configurator.add_route('api_v1_providers', '/api/v1/providers')
     configurator.add_route('api_v1_clouds', '/api/v1/clouds')
+    configurator.add_route('api_v1_snapshot', '/api/v1/snapshot')
     configurator.add_route('api_v1_cloud_action', '/api/v1/clouds/{cloud}')
     # VSphere routes
     configurator.add_route('api_v1_cloud_folders',
@@ -0,0 +1,135 @@
+"""In-process cache of resolved auth tokens, users and whitelisted networks
+
+Every API request resolves its token and user, which used to cost a few
+Mongo reads per request. `AuthCache` keeps the raw documents of recently
+resolved tokens and users in a small LRU with a TTL and hands out fresh
+document instances built from them, so that callers can modify and save
+them as if they had been loaded from the db.
+
+Tokens are checked with `is_valid` on every hit, so an expired or timed out
+token is never served from the cache. Changes that the cache can't notice,
+such as a token revoked or a user's whitelisted IPs changed by another
+process, are broadcast to all processes through a RabbitMQ fanout exchange
+and each process drops the affected entries as soon as it receives them.
+If the broker is unreachable, stale entries expire after `AUTH_CACHE_TTL`.
+
+"""
+
+import netaddr
+
+from mist.api.concurrency.process import InvalidatedCache
+
+from mist.api import config
+
+
+AUTH_CACHE_EXCHANGE = 'auth_cache_invalidation'
+
+
+class AuthCache(InvalidatedCache):
+
+    exchange = AUTH_CACHE_EXCHANGE
+
+    def __init__(self, size, ttl):
+        super(AuthCache, self).__init__(size, ttl)
+        self.config_networks = None
+
+    def get_token(self, token):
+        """Return a valid token instance from the cache, or None"""
+        if not token or not self.enabled:
+            return None
+        cached = self.get(('token', token))
+        if cached is None:
+            return None
+        token_cls, son = cached
+        session = token_cls._from_son(son)
+        if not session.is_valid():
+            self.pop(('token', token))
+            return None
+        return session
+
+    def set_token(self, session):
+        if session.pk and session.token:
+            self.set(('token', session.token),
+                     (type(session), session.to_mongo().to_dict()))
+
+    def touch_token(self, session):
+        """Update the access time of a cached token in place"""
+        with self.lock:
+            entry = self.entries.get(('token', session.token))
+            if entry is not None:
+                entry[1][1]['last_accessed_at'] = session.last_accessed_at
+
+    def get_user(self, user_cls, user_id):
+        """Return a user instance from the cache, or None"""
+        if not user_id or not self.enabled:
+            return None
+        son = self.get(('user', user_id))
+        if son is None:
+            return None
+        return user_cls._from_son(son)
+
+    def set_user(self, user):
+        if user.pk:
+            self.set(('user', user.id), user.to_mongo().to_dict())
+
+    def get_user_email(self, user_id):
+        """Return the email of a user from the cache, or None"""
+        if not user_id or not self.enabled:
+            return None
+        son = self.get(('user', user_id))
+        if son is not None:
+            return son.get('email')
+        return self.get(('email', user_id))
+
+    def set_user_email(self, user_id, email):
+        self.set(('email', user_id), email)
+
+    def get_internal_api_key(self):
+        """Return the internal api key of the portal"""
+        internal_api_key = self.get(('portal', 'internal_api_key'))
+        if internal_api_key is None:
+            from mist.api.portal.models import Portal
+            internal_api_key = Portal.get_singleton().internal_api_key
+            self.set(('portal', 'internal_api_key'), internal_api_key)
+        return internal_api_key
+
+    def whitelist_networks(self, user):
+        """Return the parsed whitelisted networks of the user
+
+        A tuple of the networks whitelisted by the user and the networks of
+        `config.WHITELIST_CIDR` is returned. Networks are cached by the cidrs
+        themselves, so they never need to be invalidated.
+
+        """
+        if self.config_networks is None:
+            self.config_networks = [netaddr.IPNetwork(cidr)
+                                    for cidr in config.WHITELIST_CIDR]
+        cidrs = tuple(ip.cidr for ip in user.ips)
+        if not cidrs:
+            return [], self.config_networks
+        networks = self.get(('networks', cidrs))
+        if networks is None:
+            networks = [netaddr.IPNetwork(cidr) for cidr in cidrs]
+            self.set(('networks', cidrs), networks)
+        return networks, self.config_networks
+
+    def invalidate(self, tokens=(), users=(), broadcast=True):
+        """Drop tokens and users from the cache of this and all processes"""
+        message = {
+            'tokens': [token for token in tokens if token],
+            'users': [str(user_id) for user_id in users if user_id],
+        }
+        self._on_invalidate(message)
+        if broadcast and (message['tokens'] or message['users']):
+            self.broadcast(message)
+
+    def _on_invalidate(self, message):
+        with self.lock:
+            for token in message.get('tokens', []):
+                self.entries.pop(('token', token), None)
+            for user_id in message.get('users', []):
+                self.entries.pop(('user', user_id), None)
+                self.entries.pop(('email', user_id), None)
+
+
+auth_cache = AuthCache(config.AUTH_CACHE_SIZE, config.AUTH_CACHE_TTL)
@@ -21,11 +21,10 @@ from mist.api.exceptions import UserUnauthorizedError
 from mist.api.exceptions import AdminUnauthorizedError
 from mist.api.exceptions import InternalServerError
 
-from mist.api.portal.models import Portal
-
 from mist.api.auth.tasks import revoke_token
 from mist.api.auth.models import ApiToken
 from mist.api.auth.models import SessionToken
+from mist.api.auth.cache import auth_cache
 
 from mist.api import config
 
@@ -107,44 +106,25 @@ def session_from_request(request):
             parts = auth_value.split(' ')
             if len(parts) == 3:
                 internal_api_key, session_id = parts[1:]
-                if internal_api_key == Portal.get_singleton().internal_api_key:
-                    try:
-                        session_token = SessionToken.objects.get(
-                            token=session_id)
-                    except SessionToken.DoesNotExist:
-                        pass
-                    else:
-                        if session_token.is_valid():
-                            session_token.internal = True
-                            session = session_token
+                if internal_api_key == auth_cache.get_internal_api_key():
+                    session_token = _get_cached_token(session_id,
+                                                      SessionToken)
+                    if session_token is not None:
+                        session_token.internal = True
+                        session = session_token
         elif auth_value:
-            token_from_request = auth_value
-            try:
-                api_token = ApiToken.objects.get(
-                    token=token_from_request
-                )
-            except DoesNotExist:
-                api_token = None
-            try:
-                if not api_token and config.HAS_RBAC:
-                    api_token = SuperToken.objects.get(
-                        token=token_from_request)
-            except DoesNotExist:
-                pass
-            if api_token and api_token.is_valid():
+            token_classes = [ApiToken]
+            if config.HAS_RBAC:
+                token_classes.append(SuperToken)
+            api_token = _get_cached_token(auth_value, *token_classes)
+            if api_token is not None:
                 session = api_token
             else:
                 session = ApiToken()
                 session.name = 'dummy_token'
     if session is None:
-        try:
-            session_token = SessionToken.objects.get(
-                token=request.cookies.get('session.id')
-            )
-            if session_token.is_valid():
-                session = session_token
-        except DoesNotExist:
-            pass
+        session = _get_cached_token(request.cookies.get('session.id'),
+                                    SessionToken)
     if session is None:
         session = SessionToken(
             user_agent=request.user_agent,
@@ -155,6 +135,32 @@ def session_from_request(request):
     return session
 
 
+def _get_cached_token(token, *token_classes):
+    """Return the valid token of any of the given classes, or None
+
+    The token is looked up in the auth cache first, then in each of the
+    collections of `token_classes` in turn.
+
+    """
+    if not token:
+        return None
+    session = auth_cache.get_token(token)
+    if session is not None:
+        if isinstance(session, token_classes):
+            return session
+        return None
+    for token_cls in token_classes:
+        try:
+            session = token_cls.objects.get(token=token)
+        except DoesNotExist:
+            continue
+        if session.is_valid():
+            auth_cache.set_token(session)
+            return session
+        return None
+    return None
+
+
 def user_from_request(request, admin=False, redirect=False):
     """Given request, initiate User instance (mist.api.users.model.User)
 
@@ -1,4 +1,9 @@
+import time
+import atexit
 import logging
+import datetime
+import threading
+
 import netaddr
 
 from mist.api.logs.methods import log_event
@@ -11,6 +16,10 @@ from mist.api.auth.models import SessionToken
 from mist.api.auth.methods import session_from_request
 from mist.api.auth.methods import reissue_cookie_session
 
+from mist.api.auth.cache import auth_cache
+
+from mist.api.concurrency.process import ProcessThread
+
 from mist.api import config
 
 from pyramid.request import Request
@@ -25,6 +34,86 @@ log = logging.getLogger(__name__)
 CORS_ENABLED_PATHS = ['/api/v1/clouds', '/api/v1/stacks', '/api/v1/report']
 
 
+class SessionTouchBuffer(object):
+    """Write-behind buffer of session `last_accessed_at` updates
+
+    Instead of saving the session on every request, the latest access time
+    of each token is kept in memory and all of them are written with a
+    single bulk update every `flush_interval` seconds, by a background
+    thread of the process.
+
+    A session is saved right away if it is new, if it has other changes, or
+    if its timeout is close enough to expiring that a delayed write could
+    make `AuthToken.is_timedout` wrongly consider it timed out. Since only
+    tokens that are at least two flush intervals away from timing out are
+    buffered, the stored `last_accessed_at` is always recent enough.
+
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.entries = {}  # (token class, token id) -> last_accessed_at
+        self.lock = threading.Lock()
+        self.thread = ProcessThread(self._run, 'SessionTouchBuffer')
+
+    def touch(self, session):
+        """Touch the session and save it now or buffer the update"""
+        loaded_last_accessed_at = session.last_accessed_at
+        session.touch()
+        changed = set(session._get_changed_fields()) - {'last_accessed_at'}
+        if not self.flush_interval or not session.pk or changed or \
+                not loaded_last_accessed_at or \
+                self._times_out_soon(session, loaded_last_accessed_at):
+            session.save()
+            with self.lock:
+                self.entries.pop((type(session), session.pk), None)
+            return
+        self.thread.ensure(on_start=self._on_start)
+        with self.lock:
+            self.entries[(type(session), session.pk)] = \
+                session.last_accessed_at
+        auth_cache.touch_token(session)
+
+    def _times_out_soon(self, session, loaded_last_accessed_at):
+        if not session.timeout:
+            return False
+        timesout = loaded_last_accessed_at + datetime.timedelta(
+            seconds=session.timeout)
+        margin = datetime.timedelta(seconds=2 * self.flush_interval)
+        return timesout - margin <= datetime.datetime.utcnow()
+
+    def _on_start(self):
+        # Write what's still buffered when the process exits.
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as exc:
+                log.error("Error flushing session touches: %r", exc)
+
+    def flush(self):
+        """Write all buffered access times with one bulk update per class"""
+        with self.lock:
+            entries, self.entries = self.entries, {}
+        if not entries:
+            return
+        from pymongo import UpdateOne
+        operations = {}
+        for (token_cls, token_id), last_accessed_at in entries.items():
+            operations.setdefault(token_cls, []).append(UpdateOne(
+                {'_id': token_id},
+                {'$max': {'last_accessed_at': last_accessed_at}}))
+        for token_cls, ops in operations.items():
+            token_cls._get_collection().bulk_write(ops, ordered=False)
+        log.debug("Flushed %d session touches", len(entries))
+
+
+touch_buffer = SessionTouchBuffer(config.SESSION_TOUCH_FLUSH_INTERVAL)
+
+
 class AuthMiddleware(object):
     """ Authentication Middleware """
     def __init__(self, app):
@@ -54,8 +143,7 @@ class AuthMiddleware(object):
             if not (isinstance(session, ApiToken) and
                     'dummy' in session.name or
                     getattr(session, 'internal', False)):
-                session.touch()
-                session.save()
+                touch_buffer.touch(session)
             # CORS
             if (
                 environ.get('HTTP_ORIGIN') and
@@ -86,9 +174,7 @@ class AuthMiddleware(object):
         if session and user is not None and request.path != '/logout' and \
                 not getattr(session, 'internal', False):
             current_user_ip = netaddr.IPAddress(ip_from_request(request))
-            saved_wips = [netaddr.IPNetwork(ip.cidr) for ip in user.ips]
-            config_wips = [netaddr.IPNetwork(cidr)
-                           for cidr in config.WHITELIST_CIDR]
+            saved_wips, config_wips = auth_cache.whitelist_networks(user)
             wips = saved_wips + config_wips
             if len(saved_wips) > 0:
                 for ipnet in wips:
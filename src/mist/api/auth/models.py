@@ -10,6 +10,7 @@ from datetime import datetime, timedelta
 
 from mist.api.users.models import User, Organization
 from mist.api.exceptions import UserNotFoundError
+from mist.api.auth.cache import auth_cache
 
 from mist.api import config
 
@@ -94,17 +95,29 @@ class AuthToken(me.Document):
     def touch(self):
         self.last_accessed_at = datetime.utcnow()
 
+    def save(self, *args, **kwargs):
+        # Other processes only need to drop their cached copy if anything
+        # but the access time changed, e.g. when the token got revoked.
+        changed = set(self._get_changed_fields()) - {'last_accessed_at'}
+        broadcast = not self._created and bool(changed)
+        ret = super(AuthToken, self).save(*args, **kwargs)
+        auth_cache.invalidate(tokens=[self.token], broadcast=broadcast)
+        return ret
+
     def get_user(self, effective=True):
         """Return `su` user, if `effective` else `user`"""
         if self.user_id:
-            try:
-                if effective and self.su:
-                    user = User.objects.get(id=self.su)
-                else:
-                    user = User.objects.get(id=self.user_id)
+            user_id = self.su if effective and self.su else self.user_id
+            user = auth_cache.get_user(User, user_id)
+            if user is not None:
                 return user
+            try:
+                user = User.objects.get(id=user_id)
             except me.DoesNotExist:
                 pass
+            else:
+                auth_cache.set_user(user)
+                return user
         return None
 
     def set_user(self, user, effective=False):
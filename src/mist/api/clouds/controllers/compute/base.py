@@ -9,6 +9,8 @@ to db etc. Cloud specific controllers are in `mist.api.clouds.controllers`.
 import ssl
 import json
 import copy
+import pickle
+import hashlib
 import socket
 import logging
 import datetime
@@ -17,6 +19,7 @@ from typing import Any, Dict, List, Tuple, Union
 import requests
 import re
 import asyncio
+import threading
 
 from bson import json_util
 
@@ -80,19 +83,106 @@ __all__ = [
 ]
 
 
-def _update_machine_from_node_in_process_pool(params):
-    from mist.api.clouds.models import Cloud
+# Long-lived pool of processes used to reconcile nodes in parallel when
+# `config.PROCESS_POOL_WORKERS` is set. It is created once per worker process
+# on first use and reused across polls, see `_get_process_pool`.
+_PROCESS_POOL = None
+_PROCESS_POOL_LOCK = threading.Lock()
 
+# Cache of `(poll_id, compute controller, lookup maps)` per cloud id, kept in
+# each child process of the pool, so that the cloud is loaded and the lookup
+# maps are unpickled once per poll instead of once per node.
+_PROCESS_POOL_CACHE = {}
+_PROCESS_POOL_CACHE_SIZE = 32
+
+
+def _get_process_pool():
+    """Return the process pool of this worker, creating it if needed
+
+    Children are spawned rather than forked, so that each one sets up its
+    own mongo connection when importing `mist.api`.
+
+    """
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _PROCESS_POOL = ProcessPoolExecutor(
+                max_workers=config.PROCESS_POOL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _PROCESS_POOL
+
+
+def _reset_process_pool():
+    """Discard the process pool, eg after one of its children has died"""
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is not None:
+            _PROCESS_POOL.shutdown(wait=False)
+            _PROCESS_POOL = None
+
+
+def _update_machines_from_nodes_in_process_pool(params):
+    """Reconcile a chunk of nodes in a child process of the pool
+
+    Returns a list of `(machine, is_new)` tuples, one per node, along with
+    the stats of the chunk and the snapshots of reparsed machines, if these
+    were requested.
+
+    """
     cloud_id = params['cloud_id']
-    now = params['now']
-    locations_map = params['locations_map']
-    sizes_map = params['sizes_map']
-    images_map = params['images_map']
-    node_dict = params['node']
-    cloud = Cloud.objects.get(id=cloud_id)
+    cached = _PROCESS_POOL_CACHE.get(cloud_id)
+    if cached is None or cached[0] != params['poll_id']:
+        from mist.api.clouds.models import Cloud
+        cloud = Cloud.objects.get(id=cloud_id)
+        cached = (params['poll_id'], cloud.ctl.compute,
+                  pickle.loads(params['maps']))
+        _PROCESS_POOL_CACHE.pop(cloud_id, None)
+        while len(_PROCESS_POOL_CACHE) >= _PROCESS_POOL_CACHE_SIZE:
+            _PROCESS_POOL_CACHE.pop(next(iter(_PROCESS_POOL_CACHE)))
+        _PROCESS_POOL_CACHE[cloud_id] = cached
+    _, controller, (locations_map, sizes_map, images_map) = cached
+
+    stats = {}
+    snapshots = {} if params['snapshots'] else None
+    results = [
+        controller._update_machine_from_node(
+            node, locations_map, sizes_map, images_map, params['now'],
+            stats=stats, snapshots=snapshots)
+        for node in params['nodes']
+    ]
+    return results, stats, snapshots or {}
+
+
+def _node_fingerprint(node_dict, *extra):
+    """Return a stable hash of a libcloud node dict
+
+    The node dict is normalized by serializing it with sorted keys, so that
+    two polls returning the same node produce the same fingerprint. Any
+    additional arguments that affect the parsing of the node are hashed too.
+
+    """
+    normalized = json.dumps([node_dict, extra], sort_keys=True,
+                            default=str, separators=(',', ':'))
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def _prepare_machine_patch_dict(machine_dict):
+    """Strip fields excluded from machine patches and sort ports, in place"""
+    machine_dict.pop('last_seen', None)
+    machine_dict.pop('probe', None)
+    if machine_dict.get('extra') and machine_dict['extra'].get('ports'):
+        machine_dict['extra']['ports'] = sorted(
+            machine_dict['extra']['ports'],
+            key=lambda x: x.get('PublicPort', 0) * 100000 + x.get(
+                'PrivatePort', 0))
+    return machine_dict
+
 
-    return cloud.ctl.compute._update_machine_from_node(
-        node_dict, locations_map, sizes_map, images_map, now)
+def _machine_patch_path(key):
+    """Return the JSON pointer of a machine key in machine patches"""
+    return '/' + key.replace('~', '~0').replace('/', '~1')
 
 
 def _decide_machine_cost(machine, tags=None, cost=(0, 0)):
@@ -117,10 +207,11 @@ def _decide_machine_cost(machine, tags=None, cost=(0, 0)):
     now = datetime.datetime.utcnow()
     month_days = calendar.monthrange(now.year, now.month)[1]
 
-    # Get machine tags from db
-    tags = tags or {tag.key: tag.value for tag in Tag.objects(
-        resource_id=machine.id, resource_type='machine'
-    )}
+    # Get machine tags from db, unless they have been prefetched.
+    if tags is None:
+        tags = {tag.key: tag.value for tag in Tag.objects(
+            resource_id=machine.id, resource_type='machine'
+        )}
     percentage = 1
     try:
         cph = parse_num(tags.get('cost_per_hour'))
@@ -237,25 +328,37 @@ class BaseComputeController(BaseController):
         implementation.
 
         """
+        from mist.api.machines.models import Machine
         task_key = 'cloud:list_machines:%s' % self.cloud.id
         task = PeriodicTaskInfo.get_or_add(task_key)
         first_run = False if task.last_success else True
+        incremental = config.INCREMENTAL_MACHINE_PATCHES
+        snapshots = None
         try:
             with task.task_runner(persist=persist):
-                if (hasattr(self.cloud.ctl, 'container') and
+                if incremental:
+                    cached_machines = self._list_cached_machines_summary()
+                    if self._machine_patch_needed(first_run):
+                        snapshots = {}
+                elif (hasattr(self.cloud.ctl, 'container') and
                         self.cloud.container_enabled):
-                    cached_machines = [m.as_dict()
-                                       for m in self.list_cached_machines()
-                                       if m.machine_type != 'pod']
+                    cached_machines = Machine.as_dicts(
+                        self.list_cached_machines().filter(
+                            machine_type__ne='pod'))
                 else:
-                    cached_machines = [m.as_dict()
-                                       for m in self.list_cached_machines()]
-                machines = self._list_machines()
+                    cached_machines = Machine.as_dicts(
+                        self.list_cached_machines())
+                machines = self._list_machines(snapshots=snapshots)
         except PeriodicTaskThresholdExceeded:
             self.cloud.ctl.disable()
             raise
 
-        self.produce_and_publish_patch(cached_machines, machines, first_run)
+        if not incremental:
+            self.produce_and_publish_patch(cached_machines, machines,
+                                           first_run)
+        elif snapshots is not None:
+            self.produce_and_publish_incremental_patch(
+                cached_machines, machines, snapshots, first_run)
 
         # Push historic information for inventory and cost reporting.
         for machine in machines:
@@ -272,22 +375,66 @@ class BaseComputeController(BaseController):
 
     def produce_and_publish_patch(self, cached_machines, fresh_machines,
                                   first_run=False):
-        old_machines = {'%s-%s' % (m['id'], m['external_id']): copy.copy(m)
+        old_machines = {'%s-%s' % (m['id'], m['external_id']):
+                        _prepare_machine_patch_dict(copy.copy(m))
                         for m in cached_machines}
-        new_machines = {'%s-%s' % (m.id, m.external_id): m.as_dict()
-                        for m in fresh_machines}
-        # Exclude last seen and probe fields from patch.
-        for md in old_machines, new_machines:
-            for m in list(md.values()):
-                m.pop('last_seen')
-                m.pop('probe')
-                if m.get('extra') and m['extra'].get('ports'):
-                    m['extra']['ports'] = sorted(
-                        m['extra']['ports'],
-                        key=lambda x: x.get('PublicPort', 0) * 100000 + x.get(
-                            'PrivatePort', 0))
+        from mist.api.machines.models import Machine
+        new_machines = {'%s-%s' % (m['id'], m['external_id']):
+                        _prepare_machine_patch_dict(m)
+                        for m in Machine.as_dicts(fresh_machines)}
         patch = jsonpatch.JsonPatch.from_diff(old_machines,
                                               new_machines).patch
+        self._publish_machines_patch(patch, old_machines, new_machines,
+                                     first_run)
+
+    def produce_and_publish_incremental_patch(self, cached_machines,
+                                              fresh_machines, snapshots,
+                                              first_run=False):
+        """Produce and publish a machines patch without a cloud-wide diff
+
+        `cached_machines` is a list of the summary dicts returned by
+        `_list_cached_machines_summary` before the poll. `snapshots` maps
+        the ids of the machines that were reparsed during the poll to their
+        `as_dict()` before any changes. Only these machines are diffed.
+        Machines that weren't cached before are added, while cached machines
+        that weren't seen are removed. All other machines are unchanged,
+        since their node fingerprint was the same.
+
+        """
+        cached_map = {m['id']: m for m in cached_machines}
+        fresh_ids = set()
+        old_machines, new_machines = {}, {}
+        patch = []
+        for machine in fresh_machines:
+            fresh_ids.add(machine.id)
+            key = '%s-%s' % (machine.id, machine.external_id)
+            if machine.id not in cached_map:
+                new_machines[key] = _prepare_machine_patch_dict(
+                    machine.as_dict())
+                patch.append({'op': 'add', 'path': _machine_patch_path(key),
+                              'value': new_machines[key]})
+            elif machine.id in snapshots:
+                old_machines[key] = _prepare_machine_patch_dict(
+                    snapshots[machine.id])
+                new_machines[key] = _prepare_machine_patch_dict(
+                    machine.as_dict())
+                for op in jsonpatch.JsonPatch.from_diff(
+                        old_machines[key], new_machines[key]).patch:
+                    op['path'] = _machine_patch_path(key) + op['path']
+                    if 'from' in op:
+                        op['from'] = _machine_patch_path(key) + op['from']
+                    patch.append(op)
+        for machine_id, machine in cached_map.items():
+            if machine_id not in fresh_ids:
+                key = '%s-%s' % (machine_id, machine['external_id'])
+                old_machines[key] = machine
+                patch.append({'op': 'remove',
+                              'path': _machine_patch_path(key)})
+        self._publish_machines_patch(patch, old_machines, new_machines,
+                                     first_run)
+
+    def _publish_machines_patch(self, patch, old_machines, new_machines,
+                                first_run=False):
         if patch:  # Publish patches to rabbitmq.
             if not first_run and self.cloud.observation_logs_enabled:
                 from mist.api.logs.methods import log_observations
@@ -299,11 +446,50 @@ class BaseComputeController(BaseController):
                                   data={'cloud_id': self.cloud.id,
                                         'patch': patch})
 
-    def _list_machines(self):
+    def _machine_patch_needed(self, first_run=False):
+        """Return whether anyone will consume the machines patch of a poll
+
+        That is if observation logs are enabled or an owner session listens.
+
+        """
+        if not first_run and self.cloud.observation_logs_enabled:
+            return True
+        return amqp_owner_listening(self.cloud.owner.id)
+
+    def _list_cached_machines_summary(self):
+        """Return lightweight dicts of the cached machines
+
+        The dicts only contain the fields needed to produce incremental
+        patches, log observations and update metering data, formatted the
+        same way as in `Machine.as_dict`, without dereferencing anything.
+
+        """
+        machines = self.list_cached_machines().only(
+            'id', 'external_id', 'name', 'state', 'machine_type',
+            'last_seen', 'missing_since')
+        if (hasattr(self.cloud.ctl, 'container') and
+                self.cloud.container_enabled):
+            machines = machines.filter(machine_type__ne='pod')
+        return [{
+            'id': m.id,
+            'external_id': m.external_id,
+            'name': m.name,
+            'state': m.state,
+            'last_seen': str(m.last_seen.replace(tzinfo=None)
+                             if m.last_seen else ''),
+            'missing_since': str(m.missing_since.replace(tzinfo=None)
+                                 if m.missing_since else ''),
+        } for m in machines]
+
+    def _list_machines(self, snapshots=None):
         """Core logic of list_machines method
         A list of nodes is fetched from libcloud, the data is processed, stored
         on machine models, and a list of machine models is returned.
 
+        If `snapshots` is a dict, the `as_dict()` of every existing machine
+        that gets reparsed is stored in it, keyed by machine id, before it is
+        updated. This is used to produce incremental patches.
+
         Subclasses SHOULD NOT override or extend this method.
 
         There are instead a number of methods that are called from this method,
@@ -377,43 +563,66 @@ class BaseComputeController(BaseController):
         # Process each machine in returned list.
         # Store previously unseen machines separately.
         new_machines = []
-        if config.PROCESS_POOL_WORKERS:
-            from concurrent.futures import ProcessPoolExecutor
-            cloud_id = self.cloud.id
-
-            choices = map(
-                lambda node: {
-                    'node': node,
-                    'cloud_id': cloud_id,
-                    'locations_map': locations_map,
-                    'sizes_map': sizes_map,
-                    'images_map': images_map,
-                    'now': now,
-                },
-                nodes)
-
-            with ProcessPoolExecutor(
-                    max_workers=config.PROCESS_POOL_WORKERS) as executor:
-                res = executor.map(_update_machine_from_node_in_process_pool,
-                                   choices)
-            for machine, is_new in list(res):
+        # Count how many nodes were skipped/updated/created in this poll.
+        stats = {'skipped': 0, 'updated': 0, 'created': 0, 'unchanged': 0}
+        results = None
+        if config.PROCESS_POOL_WORKERS and nodes:
+            results = self._list_machines__reconcile_in_process_pool(
+                nodes, locations_map, sizes_map, images_map, now, stats,
+                snapshots=snapshots)
+        if results is not None:
+            for machine, is_new in results:
+                if not machine:
+                    continue
+                if is_new:
+                    new_machines.append(machine)
+                machines.append(machine)
+        elif config.BULK_MACHINE_RECONCILE:
+            # Prefetch all machines and their tags with a single query each,
+            # diff them in memory and write back all changes at once.
+            machines_map = {
+                machine.external_id: machine for machine in Machine.objects(
+                    cloud=self.cloud,
+                    external_id__in=[node['id'] for node in nodes])
+            }
+            tags_map = {machine.id: {} for machine in machines_map.values()}
+            for tag in Tag.objects(
+                    resource_type='machine',
+                    resource_id__in=list(tags_map.keys())).only(
+                        'resource_id', 'key', 'value'):
+                tags_map[tag.resource_id][tag.key] = tag.value
+            bulk_updates = []
+            for node in nodes:
+                machine, is_new = self._update_machine_from_node(
+                    node, locations_map, sizes_map, images_map, now,
+                    machines_map=machines_map, tags_map=tags_map,
+                    bulk_updates=bulk_updates, stats=stats,
+                    snapshots=snapshots)
                 if not machine:
                     continue
                 if is_new:
                     new_machines.append(machine)
                 machines.append(machine)
+            self._list_machines__bulk_write(bulk_updates)
         else:
             for node in nodes:
                 machine, is_new = self._update_machine_from_node(
-                    node, locations_map, sizes_map, images_map, now)
+                    node, locations_map, sizes_map, images_map, now,
+                    stats=stats, snapshots=snapshots)
                 if not machine:
                     continue
                 if is_new:
                     new_machines.append(machine)
                 machines.append(machine)
 
+        self.list_machines_stats = stats
+        log.info("Reconciled %d nodes for %s: %s", len(nodes), self.cloud,
+                 ', '.join('%s=%d' % item for item in stats.items()))
+
         # Append generic-type machines, which aren't handled by libcloud.
         for machine in self._list_machines__fetch_generic_machines():
+            if snapshots is not None:
+                snapshots[machine.id] = machine.as_dict()
             machine.last_seen = now
             self._list_machines__update_generic_machine_state(machine)
             self._list_machines__generic_machine_actions(machine)
@@ -507,15 +716,114 @@ class BaseComputeController(BaseController):
             log.error("Error getting size of %s: %r", machine, exc)
         return updated
 
+    def _list_machines__reconcile_in_process_pool(self, nodes, locations_map,
+                                                  sizes_map, images_map, now,
+                                                  stats, snapshots=None):
+        """Reconcile nodes in parallel using the long-lived process pool
+
+        Nodes are split in chunks of `config.PROCESS_POOL_CHUNK_SIZE`. The
+        lookup maps are pickled once per poll and are only unpickled once per
+        child process. Returns the list of `(machine, is_new)` tuples, or
+        `None` if the pool broke, in which case the caller should fall back
+        to reconciling the nodes serially.
+
+        """
+        from concurrent.futures.process import BrokenProcessPool
+        maps = pickle.dumps((locations_map, sizes_map, images_map))
+        poll_id = '%s:%s' % (self.cloud.id, now.isoformat())
+        chunk_size = max(config.PROCESS_POOL_CHUNK_SIZE, 1)
+        chunks = [{
+            'cloud_id': self.cloud.id,
+            'poll_id': poll_id,
+            'maps': maps,
+            'now': now,
+            'nodes': nodes[i:i + chunk_size],
+            'snapshots': snapshots is not None,
+        } for i in range(0, len(nodes), chunk_size)]
+        results = []
+        try:
+            for chunk_results, chunk_stats, chunk_snapshots in \
+                    _get_process_pool().map(
+                        _update_machines_from_nodes_in_process_pool, chunks):
+                results.extend(chunk_results)
+                if snapshots is not None:
+                    snapshots.update(chunk_snapshots)
+                for key, value in chunk_stats.items():
+                    stats[key] = stats.get(key, 0) + value
+        except BrokenProcessPool as exc:
+            log.error("Process pool broke while listing machines of %s, "
+                      "will reconcile serially: %r", self.cloud, exc)
+            _reset_process_pool()
+            for key in stats:
+                stats[key] = 0
+            if snapshots is not None:
+                snapshots.clear()
+            return None
+        return results
+
+    def _list_machines__bulk_write(self, bulk_updates):
+        """Write pending machine updates to the db with one bulk_write
+
+        `bulk_updates` is a list of machine models, as collected by
+        `_update_machine_from_node` when running in bulk reconcile mode.
+        Only the fields that have changed are `$set` or `$unset`.
+
+        """
+        if not bulk_updates:
+            return
+        from pymongo import UpdateOne
+        from mist.api.machines.models import Machine
+        operations = []
+        for machine in bulk_updates:
+            set_data, unset_data = machine._delta()
+            update = {}
+            if set_data:
+                update['$set'] = set_data
+            if unset_data:
+                update['$unset'] = unset_data
+            if update:
+                operations.append(UpdateOne({'_id': machine.pk}, update))
+        if operations:
+            Machine._get_collection().bulk_write(operations, ordered=False)
+        for machine in bulk_updates:
+            machine._clear_changed_fields()
+        log.info("Bulk updated %d machines for %s.", len(operations),
+                 self.cloud)
+
     def _update_machine_from_node(self, node, locations_map, sizes_map,
-                                  images_map, now):
+                                  images_map, now, machines_map=None,
+                                  tags_map=None, bulk_updates=None,
+                                  stats=None, snapshots=None):
+        """Update or create the machine model that corresponds to node
+
+        When `machines_map` (external_id -> Machine) and `tags_map`
+        (machine id -> tags dict) are given, they are used instead of
+        querying the db. When `bulk_updates` is a list, changed existing
+        machines are validated and appended to it instead of being saved,
+        so that they can be written back with `_list_machines__bulk_write`.
+
+        A fingerprint of the node is stored on the machine. If the node has
+        not changed since the last poll, post-parsing, cost calculation and
+        saving are skipped entirely. When `stats` is a dict, the counters of
+        skipped, updated, created and unchanged nodes are incremented. When
+        `snapshots` is a dict, the `as_dict()` of existing machines that get
+        reparsed is stored in it before any changes are applied.
+
+        """
         is_new = False
         updated = False
+        parsed = True
+        stats = stats if stats is not None else {}
         # Fetch machine mongoengine model from db, or initialize one.
         from mist.api.machines.models import Machine
         try:
-            machine = Machine.objects.get(cloud=self.cloud,
-                                          external_id=node['id'])
+            if machines_map is None:
+                machine = Machine.objects.get(cloud=self.cloud,
+                                              external_id=node['id'])
+            elif node['id'] in machines_map:
+                machine = machines_map[node['id']]
+            else:
+                raise Machine.DoesNotExist()
         except Machine.DoesNotExist:
             try:
                 machine = Machine(
@@ -525,6 +833,22 @@ class BaseComputeController(BaseController):
                 log.warn("Validation error when saving new machine: %r" %
                          exc)
                 return None, is_new
+            if machines_map is not None:
+                machines_map[node['id']] = machine
+            if tags_map is not None:
+                tags_map[machine.id] = {}
+
+        fingerprint = self._list_machines__node_fingerprint(
+            machine, node, locations_map, sizes_map, images_map,
+            tags=tags_map.get(machine.id) if tags_map is not None else None)
+        if not is_new and fingerprint and \
+                machine.node_fingerprint == fingerprint:
+            machine.last_seen = now
+            stats['skipped'] = stats.get('skipped', 0) + 1
+            return machine, is_new
+
+        if snapshots is not None and not is_new:
+            snapshots[machine.id] = machine.as_dict()
 
         if self.cloud.container_enabled:
             try:
@@ -580,15 +904,10 @@ class BaseComputeController(BaseController):
         new_private_ips.sort()
         new_public_ips.sort()
 
-        old_private_ips = machine.private_ips
-        old_public_ips = machine.public_ips
-        new_private_ips.sort()
-        new_public_ips.sort()
-
-        if json.dumps(old_private_ips) != json.dumps(new_private_ips):
+        if list(machine.private_ips) != new_private_ips:
             machine.private_ips = new_private_ips
             updated = True
-        if json.dumps(old_public_ips) != json.dumps(new_public_ips):
+        if list(machine.public_ips) != new_public_ips:
             machine.public_ips = new_public_ips
             updated = True
 
@@ -656,12 +975,14 @@ class BaseComputeController(BaseController):
 
         # Update with available machine actions.
         try:
-            from copy import deepcopy
-            actions_backup = deepcopy(machine.actions)
+            actions_backup = {action: machine.actions[action]
+                              for action in machine.actions}
             self._list_machines__machine_actions(machine, node)
-            if actions_backup != machine.actions:
+            if actions_backup != {action: machine.actions[action]
+                                  for action in machine.actions}:
                 updated = True
         except Exception as exc:
+            parsed = False
             log.exception("Error while finding machine actions "
                           "for machine %s:%s for %s \n %r",
                           machine.id, node['name'], self.cloud, exc)
@@ -671,6 +992,7 @@ class BaseComputeController(BaseController):
             updated = self._list_machines__postparse_machine(machine, node) \
                 or updated
         except Exception as exc:
+            parsed = False
             log.exception("Error while post parsing machine %s:%s for %s\n%r",
                           machine.id, node['name'], self.cloud, exc)
 
@@ -678,6 +1000,8 @@ class BaseComputeController(BaseController):
         try:
             cph, cpm = _decide_machine_cost(
                 machine,
+                tags=(tags_map.get(machine.id)
+                      if tags_map is not None else None),
                 cost=self._list_machines__cost_machine(machine, node),
             )
             if machine.cost.hourly != cph or machine.cost.monthly != cpm:
@@ -685,15 +1009,35 @@ class BaseComputeController(BaseController):
                 machine.cost.monthly = cpm
                 updated = True
         except Exception as exc:
+            parsed = False
             log.exception("Error while calculating cost "
                           "for machine %s:%s for %s \n%r",
                           machine.id, node['name'], self.cloud, exc)
         if is_new:
             machine.first_seen = now
+        # Only remember the fingerprint of nodes that were parsed without
+        # errors, so that failed nodes are retried in the next poll.
+        if not parsed:
+            fingerprint = None
+        if machine.node_fingerprint != fingerprint:
+            machine.node_fingerprint = fingerprint
+            updated = True
+        if is_new:
+            stats['created'] = stats.get('created', 0) + 1
+        elif updated:
+            stats['updated'] = stats.get('updated', 0) + 1
+        else:
+            stats['unchanged'] = stats.get('unchanged', 0) + 1
         # Save all changes to machine model on the database.
         if is_new or updated:
             try:
-                machine.save()
+                if bulk_updates is not None and not is_new:
+                    # Clean the machine like save() does, e.g. to normalize
+                    # its os_type, before queuing it for the bulk write.
+                    machine.validate()
+                    bulk_updates.append(machine)
+                else:
+                    machine.save()
             except me.ValidationError as exc:
                 log.error("Error adding %s: %s", machine.name, exc.to_dict())
                 raise BadRequestError({"msg": str(exc),
@@ -714,6 +1058,36 @@ class BaseComputeController(BaseController):
 
         return machine, is_new
 
+    def _list_machines__node_fingerprint(self, machine, node, locations_map,
+                                         sizes_map, images_map, tags=None):
+        """Return a fingerprint of everything a node's parsing depends on
+
+        Besides the node dict itself, this includes the inputs of the cost
+        calculation, i.e. the machine's `tags`, or its denormalized tags if
+        not given, and the current month, whose days the hourly and monthly
+        costs are derived from. The cached location, size and image the node
+        maps to are included too, so that newly discovered ones cause the
+        node to be reparsed.
+
+        Subclasses MAY extend this method if their post-parsing depends on
+        additional state. Returning `None` disables skipping for the node.
+
+        """
+        try:
+            location = locations_map.get(
+                self._list_machines__get_location(node))
+            size = sizes_map.get(self._list_machines__get_size(node))
+            image = images_map.get(self._list_machines__get_image(node))
+            month = datetime.datetime.utcnow().strftime('%Y-%m')
+            return _node_fingerprint(
+                node, machine.tags if tags is None else tags, month,
+                self.cloud.container_enabled, location and location.id,
+                size and size.id, image and image.id)
+        except Exception as exc:
+            log.error("Error fingerprinting node %s of %s: %r",
+                      node.get('id'), self.cloud, exc)
+            return None
+
     def _list_machines__update_generic_machine_state(self, machine):
         """Helper method to update the machine state
 
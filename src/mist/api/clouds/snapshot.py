@@ -0,0 +1,157 @@
+"""Build snapshots of the cached resources of many clouds at once
+
+The sockjs service used to fetch the cached machines, clusters, locations,
+sizes, images, networks, zones, volumes and buckets of every cloud through a
+separate request to the API. Here every resource type is loaded for all the
+clouds with a single query, RBAC is applied once and the results are grouped
+by cloud, in the same format as the respective `list_*` API endpoints.
+
+"""
+
+import datetime
+
+from mist.api.machines.models import _ref_id
+
+
+RESOURCE_TYPES = ('machines', 'clusters', 'locations', 'sizes', 'images',
+                  'networks', 'zones', 'volumes', 'buckets')
+
+# The controller each resource type is listed through.
+CONTROLLERS = {
+    'machines': 'ComputeController',
+    'clusters': 'ComputeController',
+    'locations': 'ComputeController',
+    'sizes': 'ComputeController',
+    'images': 'ComputeController',
+    'networks': 'NetworkController',
+    'zones': 'DnsController',
+    'volumes': 'StorageController',
+    'buckets': 'ObjectStorageController',
+}
+
+
+def _is_listed(cloud, rtype):
+    """Whether the cloud has resources of type `rtype` to list at all"""
+    ctl = cloud.ctl
+    if rtype == 'clusters':
+        return hasattr(ctl, 'container') and bool(cloud.container_enabled)
+    if rtype == 'networks':
+        return hasattr(ctl, 'network')
+    if rtype == 'zones':
+        return hasattr(ctl, 'dns') and bool(cloud.dns_enabled)
+    if rtype == 'volumes':
+        return hasattr(ctl, 'storage')
+    if rtype == 'buckets':
+        return hasattr(ctl, 'objectstorage') and \
+            cloud.object_storage_enabled is not False
+    return True
+
+
+def _query_resources(owner, rtype, cloud_ids):
+    """Return the cached resources of the clouds, as the controllers do"""
+    recent = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    if rtype == 'machines':
+        from mist.api.machines.models import Machine
+        return Machine.objects(cloud__in=cloud_ids, missing_since=None,
+                               last_seen__gt=recent)
+    if rtype == 'clusters':
+        from mist.api.containers.models import Cluster
+        return Cluster.objects(cloud__in=cloud_ids, missing_since=None,
+                               last_seen__gt=recent)
+    if rtype == 'locations':
+        from mist.api.clouds.models import CloudLocation
+        return CloudLocation.objects(cloud__in=cloud_ids, missing_since=None)
+    if rtype == 'sizes':
+        from mist.api.clouds.models import CloudSize
+        return CloudSize.objects(cloud__in=cloud_ids, missing_since=None)
+    if rtype == 'images':
+        from mist.api.images.models import CloudImage
+        return CloudImage.objects(cloud__in=cloud_ids, missing_since=None)
+    if rtype == 'networks':
+        from mist.api.networks.models import Network
+        return Network.objects(cloud__in=cloud_ids, missing_since=None)
+    if rtype == 'zones':
+        from mist.api.dns.models import Zone
+        return Zone.objects(cloud__in=cloud_ids, missing_since=None)
+    if rtype == 'volumes':
+        from mist.api.volumes.models import Volume
+        return Volume.objects(cloud__in=cloud_ids, missing_since=None,
+                              last_seen__gt=recent)
+    if rtype == 'buckets':
+        from mist.api.objectstorage.models import Bucket
+        return Bucket.objects(owner=owner, cloud__in=cloud_ids,
+                              missing_since=None)
+    raise ValueError("Unknown resource type '%s'" % rtype)
+
+
+def _serialize(rtype, resources, extra=False):
+    if rtype == 'machines':
+        from mist.api.machines.models import Machine
+        return Machine.as_dicts(resources)
+    if rtype in ('locations', 'sizes', 'images'):
+        return [resource.as_dict(extra=extra) for resource in resources]
+    return [resource.as_dict() for resource in resources]
+
+
+def _filter(rtype, items, allowed_resources):
+    """Filter serialized resources like the `filter_list_*` methods do"""
+    if rtype == 'sizes':
+        return items
+    allowed_ids = set(allowed_resources.get(rtype) or [])
+    items = [item for item in items if item['id'] in allowed_ids]
+    if rtype == 'zones':
+        allowed_records = set(allowed_resources.get('records') or [])
+        for zone in items:
+            for record_id in list(zone['records']):
+                if record_id not in allowed_records:
+                    zone['records'].pop(record_id)
+    return items
+
+
+def build_snapshot_section(auth_context, clouds, rtype, extra=False):
+    """Return a dict of the cached `rtype` resources of each of the clouds
+
+    Clouds whose controller cannot list `rtype` are left out, as are clouds
+    that non-Owners may not read. The resources of all remaining clouds are
+    fetched with a single query and, for non-Owners, filtered based on the
+    RBAC policy.
+
+    """
+    if rtype not in CONTROLLERS:
+        raise ValueError("Unknown resource type '%s'" % rtype)
+    clouds = [cloud for cloud in clouds
+              if getattr(cloud.ctl, CONTROLLERS[rtype])]
+    if not auth_context.is_owner():
+        allowed_resources = auth_context.get_allowed_resources('read')
+        allowed_clouds = set(allowed_resources.get('clouds') or [])
+        clouds = [cloud for cloud in clouds if cloud.id in allowed_clouds]
+    ret = {cloud.id: [] for cloud in clouds}
+    cloud_ids = [cloud.id for cloud in clouds if _is_listed(cloud, rtype)]
+    if not cloud_ids:
+        return ret
+    resources = list(_query_resources(auth_context.owner, rtype, cloud_ids))
+    for resource, item in zip(resources,
+                              _serialize(rtype, resources, extra=extra)):
+        ret[_ref_id(resource._data.get('cloud'))].append(item)
+    if not auth_context.is_owner():
+        for cloud_id in ret:
+            ret[cloud_id] = _filter(rtype, ret[cloud_id], allowed_resources)
+    return ret
+
+
+def build_snapshot(auth_context, clouds=None, resource_types=RESOURCE_TYPES):
+    """Return the clouds and the cached resources of each one of them
+
+    The result maps 'clouds' to the list of clouds and each resource type
+    to a dict of the lists of resources per cloud id.
+
+    """
+    from mist.api.clouds.methods import filter_list_clouds
+    if clouds is None:
+        clouds = [cloud for cloud in filter_list_clouds(auth_context,
+                                                        as_dict=False)
+                  if cloud.enabled]
+    ret = {'clouds': [cloud.as_dict() for cloud in clouds]}
+    for rtype in resource_types:
+        ret[rtype] = build_snapshot_section(auth_context, clouds, rtype)
+    return ret
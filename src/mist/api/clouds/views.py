@@ -18,6 +18,7 @@ from mist.api.clouds.methods import filter_list_clouds
 from mist.api.clouds.methods import add_cloud as m_add_cloud
 from mist.api.clouds.methods import rename_cloud as m_rename_cloud
 from mist.api.clouds.methods import remove_cloud as m_remove_cloud
+from mist.api.clouds.snapshot import RESOURCE_TYPES, build_snapshot
 
 from mist.api.tag.methods import add_tags_to_resource
 
@@ -47,6 +48,41 @@ def list_clouds(request):
     return filter_list_clouds(auth_context)
 
 
+@view_config(route_name='api_v1_snapshot', request_method='GET',
+             renderer='json')
+def get_snapshot(request):
+    """
+    Tags: clouds
+    ---
+    Returns all enabled clouds along with their cached resources.
+    Each resource type maps cloud ids to the resources of the cloud, as
+    returned by the respective cached list endpoints. Clouds that do not
+    support a resource type are omitted from it.
+    READ permission required on cloud.
+    READ permission required on each resource.
+    ---
+    resource_types:
+      in: query
+      type: string
+      description: Comma separated resource types, defaults to all of \
+      machines, clusters, locations, sizes, images, networks, zones, \
+      volumes and buckets
+    """
+    auth_context = auth_context_from_request(request)
+    params = params_from_request(request)
+    resource_types = params.get('resource_types')
+    if resource_types:
+        resource_types = [rtype.strip() for rtype in resource_types.split(',')
+                          if rtype.strip()]
+        invalid = set(resource_types) - set(RESOURCE_TYPES)
+        if invalid:
+            raise BadRequestError('Invalid resource types: %s' %
+                                  ', '.join(sorted(invalid)))
+    else:
+        resource_types = RESOURCE_TYPES
+    return build_snapshot(auth_context, resource_types=resource_types)
+
+
 @view_config(route_name='api_v1_clouds',
              request_method='POST', renderer='json')
 @require_cc
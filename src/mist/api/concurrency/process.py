@@ -0,0 +1,148 @@
+"""Per-process background threads and caches
+
+Caches, write buffers and clients that keep state in memory need a daemon
+thread of their own, e.g. to flush buffered writes or to receive cache
+invalidations. Since threads don't survive forking, as done by uwsgi and
+dramatiq, `ProcessThread` starts them lazily, once in every process.
+
+`InvalidatedCache` is an LRU with a TTL, whose entries are dropped from the
+cache of all processes by broadcasting invalidation messages through a
+RabbitMQ fanout exchange. If the broker is unreachable, stale entries expire
+after `ttl` seconds.
+
+"""
+
+import os
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+class ProcessThread(object):
+    """A daemon thread that runs `target` in the current process"""
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive() and \
+            self.pid == os.getpid()
+
+    def ensure(self, on_start=None):
+        """Start the thread, unless it's running in this process already
+
+        `on_start` is called right before starting a new thread, e.g. to
+        reset the state inherited from a parent process.
+
+        """
+        if self.is_running():
+            return
+        with self.lock:
+            if self.is_running():
+                return
+            if on_start is not None:
+                on_start()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.target,
+                                           name=self.name, daemon=True)
+            self.thread.start()
+
+
+class InvalidatedCache(object):
+    """An LRU cache with a TTL, invalidated through a fanout exchange
+
+    Subclasses set the `exchange` to broadcast invalidations to and handle
+    the messages received from it in `_on_invalidate`.
+
+    """
+
+    exchange = None
+    retry_interval = 5
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.listener = ProcessThread(self._listen,
+                                      '%sListener' % type(self).__name__)
+
+    @property
+    def enabled(self):
+        return bool(self.ttl and self.size)
+
+    def _lookup(self, key):
+        """Return the value of an unexpired entry, holding the lock"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def _store(self, key, value):
+        """Add or replace an entry and evict the oldest, holding the lock"""
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            return self._lookup(key)
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        self._ensure_listener()
+        with self.lock:
+            self._store(key, value)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def broadcast(self, message):
+        """Send an invalidation message to all processes"""
+        from mist.api.helpers import amqp_publish
+        try:
+            amqp_publish(self.exchange, '', message, ex_declare=True)
+        except Exception as exc:
+            log.error("Error broadcasting to %s: %r", self.exchange, exc)
+
+    def _on_invalidate(self, message):
+        raise NotImplementedError()
+
+    def _ensure_listener(self):
+        # Entries inherited from the parent may have missed broadcasts.
+        self.listener.ensure(on_start=self.clear)
+
+    def _listen(self):
+        from mist.api.helpers import amqp_subscribe
+
+        def callback(body, msg):
+            self._on_invalidate(body)
+
+        while True:
+            try:
+                amqp_subscribe(self.exchange, callback)
+            except Exception as exc:
+                log.error("Error listening to %s, clearing the cache: %r",
+                          self.exchange, exc)
+                self.clear()
+            time.sleep(self.retry_interval)
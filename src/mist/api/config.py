@@ -189,6 +189,12 @@ VAULT_SECRET_ENGINE_PATHS = {}
 VAULT_KV_VERSION = 2  # 1 or 2
 VAULT_CLOUDS_PATH = 'mist/clouds/'
 VAULT_KEYS_PATH = 'mist/keys/'
+# Max number of KV v2 secrets cached in memory by each process and seconds to
+# cache them for. Set either to 0 to read secrets from Vault every time.
+VAULT_SECRET_CACHE_SIZE = 1000
+VAULT_SECRET_CACHE_TTL = 60
+# Max number of authenticated Vault clients kept by each process.
+VAULT_CLIENT_POOL_SIZE = 100
 
 
 # Policy for Organization specific Vault client.
@@ -1288,6 +1294,15 @@ GRAPHITE_URI = "http://graphite"
 VICTORIAMETRICS_URI = "http://vmselect:8481/select/<org_id>/prometheus"
 VICTORIAMETRICS_WRITE_URI = ("http://vminsert:8480/insert/<org_id>/"
                              "prometheus")
+# Max length of the URL of queries that fetch the series of many machines at
+# once, e.g. when evaluating rules. Longer machine_id matchers are chunked.
+VICTORIAMETRICS_MAX_URL_LENGTH = 4000
+# Max number of connections to the monitoring backends kept alive per process,
+# and max number of concurrent requests of each process. Requests that don't
+# set a timeout give up after MONITORING_HTTP_TIMEOUT seconds.
+MONITORING_HTTP_POOL_SIZE = 100
+MONITORING_HTTP_CONCURRENCY = 20
+MONITORING_HTTP_TIMEOUT = 30
 
 GRAPHITE_TO_VICTORIAMETRICS_METRICS_MAP = {}
 
@@ -3189,8 +3204,89 @@ ENABLE_R12N = False
 ENABLE_MONITORING = True
 ENABLE_SHELL_CAPTURE = False
 MACHINE_PATCHES = True
+# Number of machines loaded & serialized at a time by streaming list endpoints
+LIST_MACHINES_BATCH_SIZE = 500
+# Max number of clouds queried in parallel when listing fresh machines across
+# all clouds, and max seconds to wait for each of them.
+LIST_MACHINES_FAN_OUT_CONCURRENCY = 8
+LIST_MACHINES_FAN_OUT_TIMEOUT = 60
+# Seconds between bulk writes of buffered session access times. Set to 0 to
+# save sessions on every request.
+SESSION_TOUCH_FLUSH_INTERVAL = 10
+# Produce machine patches only from the machines that changed during a poll,
+# instead of diffing the whole cloud, and only if anyone will consume them.
+INCREMENTAL_MACHINE_PATCHES = True
+# Seconds to buffer and merge model patches before sending them to sockjs
+# connections.
+SOCKJS_PATCH_FLUSH_INTERVAL = 1
+# Reload only the schedules that changed, as reported by MongoDB change
+# streams, and all of them every SCHEDULER_FULL_RELOAD_INTERVAL seconds.
+SCHEDULER_INCREMENTAL_RELOAD = True
+SCHEDULER_FULL_RELOAD_INTERVAL = 600
+# Max number of ping probes run by a single task, grouped by the scheduler
+# every POLLING_BATCH_INTERVAL seconds, and max number of hosts pinged at once
+# by each task. Set PING_PROBE_BATCH_SIZE to 0 to ping each machine in its own
+# task.
+PING_PROBE_BATCH_SIZE = 500
+PING_PROBE_CONCURRENCY = 1000
+POLLING_BATCH_INTERVAL = 5
+# Max number of tokens & users kept in the in-process auth cache of each
+# process and seconds to keep them for. Set AUTH_CACHE_TTL to 0 to disable.
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 60
+# Max number of resources whose denormalized tags are rebuilt by a single task
+# after tagging many resources at once.
+TAGS_BULK_BATCH_SIZE = 1000
+# Number of parsed list_resources search expressions cached by each process.
+LIST_RESOURCES_PLAN_CACHE_SIZE = 1024
+# Number of resource counts cached by each process, and seconds to cache them
+# for, when listing resources with an estimated total.
+LIST_RESOURCES_COUNT_CACHE_SIZE = 1024
+LIST_RESOURCES_COUNT_CACHE_TTL = 60
+# Max number of pooled connections to Elasticsearch per process.
+ELASTICSEARCH_POOL_SIZE = 25
+# Also index events from the API with the _bulk API, instead of relying only
+# on the consumers of the RabbitMQ events exchange. Events are indexed in
+# batches of LOG_EVENTS_BULK_SIZE or every LOG_EVENTS_BULK_INTERVAL seconds,
+# into indices named after LOG_EVENTS_ES_INDEX formatted with strftime.
+LOG_EVENTS_DIRECT_TO_ES = False
+LOG_EVENTS_BULK_SIZE = 500
+LOG_EVENTS_BULK_INTERVAL = 2
+LOG_EVENTS_ES_INDEX = 'app-logs-%Y'
+# List stories from the `stories` collection, maintained by the
+# story-materializer process, instead of aggregating logs in Elasticsearch.
+# Events are consumed and written in batches of STORIES_BATCH_SIZE or every
+# STORIES_BATCH_INTERVAL seconds. Only the first STORIES_MAX_LOGS logs of each
+# story are kept in it.
+STORIES_MATERIALIZED = False
+STORIES_BATCH_SIZE = 500
+STORIES_BATCH_INTERVAL = 1
+STORIES_MAX_LOGS = 50
+# Keep SSH connections to machines open for SSH_POOL_IDLE_TTL seconds after
+# use, sending keepalives every SSH_POOL_KEEPALIVE seconds, and reuse them for
+# probes, scripts & shells. Each connection is shared by up to
+# SSH_POOL_MAX_SESSIONS shells at a time and at most SSH_POOL_MAX_PER_HOST
+# connections are kept per host. Set SSH_POOL_IDLE_TTL to 0 to disable.
+SSH_POOL_IDLE_TTL = 300
+SSH_POOL_KEEPALIVE = 30
+SSH_POOL_MAX_PER_HOST = 4
+SSH_POOL_MAX_SESSIONS = 8
+# Keep up to SCRIPTS_CACHE_SIZE bytes of downloaded GitHub & URL scripts in
+# SCRIPTS_CACHE_DIR, shared by the processes of each host. The commit of a
+# GitHub ref, or the ETag of a URL, is checked again after
+# SCRIPTS_CACHE_REF_TTL seconds. Set SCRIPTS_CACHE_SIZE to 0 to disable. The
+# dir is created private to the user running the API. The cache is disabled
+# if it exists and anyone else may access it.
+SCRIPTS_CACHE_DIR = '/tmp/mist-scripts-cache'
+SCRIPTS_CACHE_SIZE = 512 * 1024 * 1024
+SCRIPTS_CACHE_REF_TTL = 60
 DEFAULT_CLOUD_POLLING_INTERVAL = 30 * 60
 PROCESS_POOL_WORKERS = 0
+# Number of nodes sent to a process pool worker at a time.
+PROCESS_POOL_CHUNK_SIZE = 500
+# Prefetch all machines & tags of a cloud and write back changes with a single
+# bulk_write when reconciling the nodes returned by the provider.
+BULK_MACHINE_RECONCILE = False
 PLUGINS = []
 PRE_ACTION_HOOKS = {}
 POST_ACTION_HOOKS = {}
@@ -3266,16 +3362,34 @@ FROM_ENV_STRINGS = [
     'DOCKER_PORT', 'DOCKER_TLS_KEY', 'DOCKER_TLS_CERT', 'DOCKER_TLS_CA',
     'UI_TEMPLATE_URL', 'LANDING_TEMPLATE_URL', 'THEME',
     'DEFAULT_MONITORING_METHOD', 'LICENSE_KEY', 'AWS_ACCESS_KEY',
-    'AWS_SECRET_KEY', 'AWS_MONGO_BUCKET', 'VAULT_ADDR', 'VAULT_TOKEN'
+    'AWS_SECRET_KEY', 'AWS_MONGO_BUCKET', 'VAULT_ADDR', 'VAULT_TOKEN',
+    'SCRIPTS_CACHE_DIR',
 ] + PLUGIN_ENV_STRINGS
 FROM_ENV_INTS = [
     'SHARD_MANAGER_MAX_SHARD_PERIOD', 'SHARD_MANAGER_MAX_SHARD_CLAIMS',
-    'SHARD_MANAGER_INTERVAL',
+    'SHARD_MANAGER_INTERVAL', 'PROCESS_POOL_WORKERS',
+    'PROCESS_POOL_CHUNK_SIZE', 'LIST_MACHINES_FAN_OUT_CONCURRENCY',
+    'LIST_MACHINES_FAN_OUT_TIMEOUT', 'SESSION_TOUCH_FLUSH_INTERVAL',
+    'AUTH_CACHE_SIZE', 'AUTH_CACHE_TTL', 'PING_PROBE_BATCH_SIZE',
+    'PING_PROBE_CONCURRENCY', 'POLLING_BATCH_INTERVAL',
+    'SCHEDULER_FULL_RELOAD_INTERVAL', 'TAGS_BULK_BATCH_SIZE',
+    'LIST_RESOURCES_PLAN_CACHE_SIZE', 'LIST_RESOURCES_COUNT_CACHE_SIZE',
+    'LIST_RESOURCES_COUNT_CACHE_TTL', 'ELASTICSEARCH_POOL_SIZE',
+    'LOG_EVENTS_BULK_SIZE', 'LOG_EVENTS_BULK_INTERVAL', 'STORIES_BATCH_SIZE',
+    'STORIES_BATCH_INTERVAL', 'STORIES_MAX_LOGS',
+    'VICTORIAMETRICS_MAX_URL_LENGTH', 'MONITORING_HTTP_POOL_SIZE',
+    'MONITORING_HTTP_CONCURRENCY', 'MONITORING_HTTP_TIMEOUT',
+    'VAULT_SECRET_CACHE_SIZE', 'VAULT_SECRET_CACHE_TTL',
+    'VAULT_CLIENT_POOL_SIZE', 'SSH_POOL_IDLE_TTL', 'SSH_POOL_KEEPALIVE',
+    'SSH_POOL_MAX_PER_HOST', 'SSH_POOL_MAX_SESSIONS', 'SCRIPTS_CACHE_SIZE',
+    'SCRIPTS_CACHE_REF_TTL',
 ] + PLUGIN_ENV_INTS
 FROM_ENV_BOOLS = [
     'SSL_VERIFY', 'ALLOW_CONNECT_LOCALHOST', 'ALLOW_CONNECT_PRIVATE',
     'ALLOW_LIBVIRT_LOCALHOST', 'JS_BUILD', 'VERSION_CHECK', 'USAGE_SURVEY',
-    'CHECK_PERIODIC_TASKS',
+    'CHECK_PERIODIC_TASKS', 'BULK_MACHINE_RECONCILE',
+    'SCHEDULER_INCREMENTAL_RELOAD', 'LOG_EVENTS_DIRECT_TO_ES',
+    'STORIES_MATERIALIZED',
 ] + PLUGIN_ENV_BOOLS
 FROM_ENV_ARRAYS = [
     'PLUGINS'
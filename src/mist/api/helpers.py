@@ -1204,24 +1204,45 @@ def view_config(*args, **kwargs):
                                **kwargs)
 
 
+_es_clients = {}  # (pid, asynchronous) -> client
+
+
+def _es_client_kwargs():
+    return {
+        'port': config.ELASTICSEARCH['elastic_port'],
+        'http_auth': (config.ELASTICSEARCH['elastic_username'],
+                      config.ELASTICSEARCH['elastic_password']),
+        'use_ssl': config.ELASTICSEARCH['elastic_use_ssl'],
+        'verify_certs': config.ELASTICSEARCH['elastic_verify_certs'],
+        # Keep the connections of the pool alive and never sniff, since all
+        # requests go through a single endpoint.
+        'maxsize': config.ELASTICSEARCH_POOL_SIZE,
+        'sniff_on_start': False,
+        'sniff_on_connection_fail': False,
+        'sniffer_timeout': None,
+    }
+
+
 def es_client(asynchronous=False):
-    """Returns an initialized Elasticsearch client."""
-    if not asynchronous:
-        return Elasticsearch(
-            config.ELASTICSEARCH['elastic_host'],
-            port=config.ELASTICSEARCH['elastic_port'],
-            http_auth=(config.ELASTICSEARCH['elastic_username'],
-                       config.ELASTICSEARCH['elastic_password']),
-            use_ssl=config.ELASTICSEARCH['elastic_use_ssl'],
-            verify_certs=config.ELASTICSEARCH['elastic_verify_certs'],
-        )
-    else:
-        method = 'https' if config.ELASTICSEARCH['elastic_use_ssl'] else 'http'
-        from elasticsearch import AsyncElasticsearch
-        return AsyncElasticsearch(
-            config.ELASTICSEARCH['elastic_host'],
-            port=config.ELASTICSEARCH['elastic_port'], method=method,
-        )
+    """Returns an initialized Elasticsearch client.
+
+    The client, along with its connection pool, is shared by the whole
+    process and must not be closed by callers. A new one is created in
+    forked processes.
+
+    """
+    key = (os.getpid(), asynchronous)
+    client = _es_clients.get(key)
+    if client is None:
+        if not asynchronous:
+            client = Elasticsearch(config.ELASTICSEARCH['elastic_host'],
+                                   **_es_client_kwargs())
+        else:
+            from elasticsearch import AsyncElasticsearch
+            client = AsyncElasticsearch(config.ELASTICSEARCH['elastic_host'],
+                                        **_es_client_kwargs())
+        client = _es_clients.setdefault(key, client)
+    return client
 
 
 def get_file(url, filename, update=True):
@@ -0,0 +1,87 @@
+"""Write events to Elasticsearch in batches
+
+Events are normally published to RabbitMQ and indexed by an external
+consumer. When `LOG_EVENTS_DIRECT_TO_ES` is set, `log_event` also hands them
+to the `EventBulkWriter` of the process, which buffers them and indexes
+them with the `_bulk` API, either once `LOG_EVENTS_BULK_SIZE` events have
+been buffered or every `LOG_EVENTS_BULK_INTERVAL` seconds.
+
+"""
+
+import time
+import atexit
+import logging
+import datetime
+import threading
+
+from elasticsearch.helpers import bulk
+
+from mist.api.helpers import es_client
+
+from mist.api.concurrency.process import ProcessThread
+
+from mist.api import config
+
+
+log = logging.getLogger(__name__)
+
+
+class EventBulkWriter(object):
+
+    def __init__(self, size, interval, index=None):
+        self.size = size
+        self.interval = interval
+        self.index = index
+        self.events = []
+        self.lock = threading.Lock()
+        self.thread = ProcessThread(self._run, 'EventBulkWriter')
+
+    def add(self, event):
+        self.thread.ensure(on_start=self._on_start)
+        with self.lock:
+            self.events.append(event)
+            full = len(self.events) >= self.size
+        if full:
+            self.flush()
+
+    def _action(self, event):
+        source = dict(event)
+        source.setdefault('@timestamp', int(event['time'] * 1000))
+        index = self.index or datetime.datetime.utcfromtimestamp(
+            event['time']).strftime(config.LOG_EVENTS_ES_INDEX)
+        return {'_index': index, '_id': event['log_id'], '_source': source}
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+        if not events:
+            return 0
+        try:
+            indexed, errors = bulk(es_client(),
+                                   [self._action(event) for event in events],
+                                   raise_on_error=False)
+        except Exception as exc:
+            log.error("Error indexing %d events: %r", len(events), exc)
+            return 0
+        if errors:
+            log.error("Failed to index %d events, first error: %s",
+                      len(errors), errors[0])
+        return indexed
+
+    def _on_start(self):
+        with self.lock:
+            # Events inherited from the parent are flushed by the parent.
+            self.events = []
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as exc:
+                log.error("Error flushing events: %r", exc)
+
+
+event_writer = EventBulkWriter(config.LOG_EVENTS_BULK_SIZE,
+                               config.LOG_EVENTS_BULK_INTERVAL)
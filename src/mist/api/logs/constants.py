@@ -119,3 +119,12 @@ EXCLUDED_BUCKETS = (
     'opens',
     'closes',
     'updates', ) + tuple(TYPES.keys())
+
+# Fields of logs, on top of `FIELDS`, that are kept in materialized stories, in
+# order to be able to filter stories by them, e.g. when closing incidents.
+STORY_FIELDS = FIELDS + (
+    'zone_id',
+    'record_id',
+    'subnet_id',
+    'network_id',
+)
@@ -1,7 +1,9 @@
 import uuid
 import json
 import time
+import asyncio
 import logging
+import functools
 import elasticsearch.exceptions as eexc
 
 from mist.api import config
@@ -15,7 +17,11 @@ from mist.api.exceptions import ServiceUnavailableError
 
 from mist.api.users.models import User
 
+from mist.api.auth.cache import auth_cache
+
 from mist.api.logs.helpers import _filtered_query
+from mist.api.logs.bulk import event_writer
+from mist.api.logs.stories import list_stories, delete_stories
 
 from mist.api.logs.constants import FIELDS, JOBS
 from mist.api.logs.constants import EXCLUDED_BUCKETS, TYPES
@@ -168,6 +174,18 @@ def log_observations(owner_id, cloud_id, resource_type, patch,
     return
 
 
+def get_user_email(user_id):
+    """Return the email of a user to enrich events with, or None"""
+    email = auth_cache.get_user_email(user_id)
+    if email is None:
+        user = User.objects(id=user_id).only('email').first()
+        if user is None:
+            return None
+        email = user.email
+        auth_cache.set_user_email(user_id, email)
+    return email
+
+
 def log_event(owner_id, event_type, action, error=None, **kwargs):
     """Log a new event.
 
@@ -210,9 +228,10 @@ def log_event(owner_id, event_type, action, error=None, **kwargs):
             event['story_id'] = kwargs.pop('story_id')
 
         if 'user_id' in event:
-            try:
-                event['email'] = User.objects.get(id=event['user_id']).email
-            except User.DoesNotExist:
+            email = get_user_email(event['user_id'])
+            if email is not None:
+                event['email'] = email
+            else:
                 log.debug('User %s does not exist', event['user_id'])
 
         # Associate event with relevant stories.
@@ -256,6 +275,9 @@ def log_event(owner_id, event_type, action, error=None, **kwargs):
         amqp_publish('events', routing_key, event,
                      ex_type='topic', ex_declare=True, auto_delete=False)
 
+        if config.LOG_EVENTS_DIRECT_TO_ES:
+            event_writer.add(dict(event))
+
         event.pop('extra')
         event.update(kwargs)
         return event
@@ -420,7 +442,17 @@ def get_stories(story_type='', owner_id='', user_id='', sort_order=-1, limit=0,
     close, or update stories of type job, shell, session, or incident. Each log
     should also specify the `story_id` of the story it refers to.
 
+    If `STORIES_MATERIALIZED` is set, the stories are instead fetched from the
+    `stories` collection, which is kept up to date by the story-materializer.
+
     """
+    if config.STORIES_MATERIALIZED:
+        return _get_materialized_stories(
+            story_type=story_type, owner_id=owner_id, user_id=user_id,
+            sort_order=sort_order, limit=limit, error=error, range=range,
+            pending=pending, expand=expand, callback=callback,
+            es_async=es_async, **kwargs)
+
     # Do not return fully detailed stories, unless specified, especially when
     # in Tornado context. If the short version is requested, return only the
     # absolute necessary fields needed to create the story.
@@ -550,6 +582,34 @@ def get_stories(story_type='', owner_id='', user_id='', sort_order=-1, limit=0,
         return _on_request_callback(query)
 
 
+def _get_materialized_stories(callback=None, es_async=False, **kwargs):
+    """Fetch stories from the `stories` collection.
+
+    The arguments are those of `get_stories`. If `es_async` is provided, the
+    query runs in the default executor of the current event loop, in order
+    not to block it, and a coroutine is returned.
+
+    """
+    if kwargs.get('story_type'):
+        assert kwargs['story_type'] in TYPES
+
+    def _on_stories_callback(stories):
+        if callback is not None:
+            return callback(stories)
+        return stories
+
+    if es_async is False:
+        return _on_stories_callback(list_stories(**kwargs))
+
+    assert not kwargs.get('expand')
+
+    async def list_async():
+        stories = await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(list_stories, **kwargs))
+        return _on_stories_callback(stories)
+    return list_async()
+
+
 def process_stories(buckets, type=None, callback=None):
     """Process fetched logs.
 
@@ -790,6 +850,7 @@ def delete_story(owner_id, story_id):
     }
     # Delete all documents matching the above query.
     result = es().delete_by_query(index=index, body=query, conflicts='proceed')
+    delete_stories(owner_id, story_id)
     if not result['deleted']:
         raise NotFoundError('story_id %s' % story_id)
     # Report results.
@@ -0,0 +1,32 @@
+import mongoengine as me
+
+
+class Story(me.DynamicDocument):
+    """A story materialized from the logs that refer to it
+
+    Stories are maintained by the `StoryMaterializer` as events are logged,
+    so that they may be listed with a simple query instead of aggregating
+    logs in Elasticsearch. Besides the fields below, each story has the
+    `STORY_FIELDS` of its logs, such as `owner_id` or `machine_id`.
+
+    """
+
+    id = me.StringField(primary_key=True)
+    type = me.StringField(required=True)
+    error = me.DynamicField(default=False)
+    started_at = me.FloatField()
+    finished_at = me.FloatField(default=0)
+    updated_at = me.FloatField()
+    # Compact versions of the first `STORIES_MAX_LOGS` logs, sorted by time.
+    logs = me.ListField(me.DictField())
+
+    meta = {
+        'collection': 'stories',
+        'strict': False,
+        'indexes': [
+            ('owner_id', 'type', '-started_at'),
+            ('owner_id', 'type', 'finished_at', '-started_at'),
+            ('owner_id', 'updated_at'),
+            'user_id', 'cloud_id', 'machine_id', 'rule_id', 'script_id',
+        ],
+    }
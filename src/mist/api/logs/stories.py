@@ -0,0 +1,298 @@
+"""Materialize stories out of logged events
+
+Stories used to be rebuilt on every request, by aggregating all logs of
+`app-logs-*` on their `stories` field. The `StoryMaterializer` consumes the
+RabbitMQ events exchange instead and keeps a compact `Story` document per
+story_id up to date, with its state, its first and last timestamps, its
+error and its first logs. When `STORIES_MATERIALIZED` is set, `get_stories`
+lists stories from these documents with an indexed query.
+
+Every update is idempotent, so events may be redelivered or replayed from
+Elasticsearch with `backfill_stories` without corrupting the stories.
+
+"""
+
+import json
+import time
+import logging
+
+import kombu
+import kombu.mixins
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from elasticsearch.helpers import scan
+
+from mist.api import config
+
+from mist.api.helpers import es_client as es
+
+from mist.api.logs.models import Story
+from mist.api.logs.constants import FIELDS, STORY_FIELDS
+
+
+log = logging.getLogger(__name__)
+
+# The log fields returned in compact stories, as when aggregating logs.
+COMPACT_LOG_FIELDS = ('log_id', 'stories', 'error', 'time', 'job')
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _parse_extra(event):
+    try:
+        extra = json.loads(event.get('extra') or '{}')
+    except Exception as exc:
+        log.error('Error parsing log %s: %s', event.get('log_id'), exc)
+        return {}
+    return extra if isinstance(extra, dict) else {}
+
+
+def _compact_log(event, story_type, extra):
+    """Return the log of `event` the way compact stories include it"""
+    body = {key: event[key] for key in COMPACT_LOG_FIELDS if key in event}
+    # Incidents are shown along with their logs.
+    if story_type == 'incident':
+        for key in FIELDS + ('action', ):
+            if key in event:
+                body[key] = event[key]
+        body.update(extra)
+    return body
+
+
+def story_updates(event):
+    """Return the operations that apply `event` to the stories it refers to
+
+    The story is created if missing. Its fields that are not set yet, its
+    error, if it had none, and its timestamps are updated, and the log is
+    added to its first `STORIES_MAX_LOGS` logs, unless already there. None
+    of the operations depends on the others being applied first.
+
+    """
+    stories = event.get('stories') or []
+    if not stories or not event.get('log_id'):
+        return []
+    extra = _parse_extra(event)
+    fields = {}
+    for key in STORY_FIELDS:
+        value = event[key] if key in event else extra.get(key)
+        if value not in (None, ''):
+            fields[key] = value
+    updated_at = event['time']
+    ops = []
+    for action, story_type, story_id in stories:
+        if not story_id:
+            continue
+        on_insert = dict(fields, type=story_type,
+                         error=event.get('error') or False)
+        update = {
+            '$setOnInsert': on_insert,
+            '$min': {'started_at': updated_at},
+            '$max': {'updated_at': updated_at},
+            '$push': {'logs': {
+                '$each': [_compact_log(event, story_type, extra)],
+                '$sort': {'time': 1},
+                '$slice': config.STORIES_MAX_LOGS,
+            }},
+        }
+        if action == 'closes':
+            update['$max']['finished_at'] = updated_at
+        else:
+            on_insert['finished_at'] = 0
+        # If the log has already been added, the filter won't match and the
+        # upsert will fail with a duplicate key error, which is ignored.
+        ops.append(UpdateOne({'_id': story_id,
+                              'logs.log_id': {'$ne': event['log_id']}},
+                             update, upsert=True))
+        for key, value in fields.items():
+            ops.append(UpdateOne({'_id': story_id, key: None},
+                                 {'$set': {key: value}}))
+        if event.get('error'):
+            ops.append(UpdateOne({'_id': story_id, 'error': False},
+                                 {'$set': {'error': event['error']}}))
+    return ops
+
+
+def write_story_updates(ops):
+    """Apply the operations returned by `story_updates` in bulk"""
+    collection = Story._get_collection()
+    for retry in (True, False):
+        try:
+            collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as exc:
+            errors = exc.details['writeErrors']
+            failed = [error for error in errors
+                      if error['code'] != DUPLICATE_KEY_ERROR]
+            if failed:
+                raise
+            # Upserts of the same new story may race with another process.
+            # They are retried once, to tell them apart from logs that were
+            # already added.
+            ops = [ops[error['index']] for error in errors]
+            if not retry:
+                break
+        else:
+            break
+
+
+def _stories_query(story_type='', owner_id='', user_id='', error=None,
+                   range=None, pending=None, **kwargs):
+    query = {}
+    if story_type:
+        query['type'] = story_type
+    if owner_id:
+        query['owner_id'] = owner_id
+    if user_id:
+        query['user_id'] = user_id
+    if pending is True:
+        query['finished_at'] = 0
+    elif pending is False:
+        query['finished_at'] = {'$gt': 0}
+    if error:
+        query['error'] = {'$ne': False}
+    elif error is False:
+        query['error'] = False
+    # Stories with logs in the time range given in milliseconds.
+    timestamp = (range or {}).get('@timestamp') or {}
+    if isinstance(timestamp.get('gte'), (int, float)):
+        query['updated_at'] = {'$gte': timestamp['gte'] / 1000.0}
+    if isinstance(timestamp.get('lte'), (int, float)):
+        query['started_at'] = {'$lte': timestamp['lte'] / 1000.0}
+    for key, value in kwargs.items():
+        if value in (None, ''):
+            log.debug('Got key "%s" with empty value', key)
+            continue
+        query['_id' if key == 'stories' else key] = value
+    return query
+
+
+def _expand_logs(stories):
+    """Replace the compact logs of stories with the logs in Elasticsearch"""
+    log_ids = [body['log_id'] for story in stories for body in story['logs']]
+    if not log_ids:
+        return
+    query = {
+        'query': {'bool': {'filter': {'terms': {'log_id': log_ids}}}},
+        '_source': {'excludes': ['@version', 'tags', '_traceback', '_exc']},
+        'size': len(log_ids),
+    }
+    result = es().search(index='app-logs-*', body=query)
+    logs = {}
+    for hit in result['hits']['hits']:
+        body = hit['_source']
+        if 'extra' in body:
+            body.update(_parse_extra(body))
+            body.pop('extra')
+        logs[body['log_id']] = body
+    for story in stories:
+        story['logs'] = [logs[body['log_id']] for body in story['logs']
+                         if body['log_id'] in logs]
+
+
+def list_stories(story_type='', owner_id='', user_id='', sort_order=-1,
+                 limit=0, error=None, range=None, pending=None, expand=False,
+                 **kwargs):
+    """List materialized stories, with the arguments of `get_stories`"""
+    query = _stories_query(story_type=story_type, owner_id=owner_id,
+                           user_id=user_id, error=error, range=range,
+                           pending=pending, **kwargs)
+    cursor = Story._get_collection().find(query).sort(
+        'started_at', -1 if sort_order == -1 else 1).limit(limit or 10000)
+    stories = []
+    for doc in cursor:
+        doc.pop('updated_at', None)
+        doc['story_id'] = doc.pop('_id')
+        stories.append(doc)
+    if expand:
+        _expand_logs(stories)
+    return stories
+
+
+def delete_stories(owner_id, story_id):
+    """Delete the materialized story with the given id, if any"""
+    Story._get_collection().delete_one({'_id': story_id,
+                                        'owner_id': owner_id})
+
+
+def backfill_stories(since, batch_size=config.STORIES_BATCH_SIZE):
+    """Materialize the stories of the logs in Elasticsearch since `since`"""
+    query = {
+        'query': {
+            'bool': {
+                'filter': [
+                    {'exists': {'field': 'stories'}},
+                    {'range': {'@timestamp': {'gte': int(since * 1000)}}},
+                ]
+            }
+        }
+    }
+    Story.ensure_indexes()
+    ops, count = [], 0
+    for hit in scan(es(), index='app-logs-*', query=query, size=batch_size):
+        ops.extend(story_updates(hit['_source']))
+        count += 1
+        if len(ops) >= batch_size:
+            write_story_updates(ops)
+            ops = []
+    if ops:
+        write_story_updates(ops)
+    log.info('Backfilled stories of %d logs', count)
+    return count
+
+
+class StoryMaterializer(kombu.mixins.ConsumerMixin):
+    """Consume the events exchange and update stories in batches
+
+    Messages are acknowledged once their stories have been written, so that
+    they are redelivered if the materializer stops in the meantime.
+
+    """
+
+    def __init__(self, connection=None, queue='mist-stories',
+                 batch_size=config.STORIES_BATCH_SIZE,
+                 interval=config.STORIES_BATCH_INTERVAL):
+        self.connection = connection or kombu.Connection(config.BROKER_URL)
+        self.exchange = kombu.Exchange('events', type='topic', durable=False,
+                                       auto_delete=False)
+        self.queue = kombu.Queue(queue, self.exchange, routing_key='#',
+                                 durable=True, auto_delete=False)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.ops = []
+        self.messages = []
+        self.flushed_at = time.time()
+        self.event_count = 0
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer([self.queue], callbacks=[self.on_message],
+                         accept=['json'], prefetch_count=self.batch_size)]
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        # Unacknowledged messages are redelivered after reconnecting.
+        self.ops, self.messages = [], []
+        Story.ensure_indexes()
+        log.info('Materializing stories from queue %s', self.queue.name)
+
+    def on_message(self, body, message):
+        try:
+            self.ops.extend(story_updates(body))
+        except Exception as exc:
+            log.error('Skipped event %r: %r', body, exc)
+        self.messages.append(message)
+        if len(self.messages) >= self.batch_size:
+            self.flush()
+
+    def on_iteration(self):
+        if self.messages and time.time() - self.flushed_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.ops:
+            write_story_updates(self.ops)
+        for message in self.messages:
+            message.ack()
+        self.event_count += len(self.messages)
+        log.debug('Materialized stories of %d events', len(self.messages))
+        self.ops, self.messages = [], []
+        self.flushed_at = time.time()
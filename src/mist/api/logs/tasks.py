@@ -1,9 +1,8 @@
 import logging
-import requests
 
 from mist.api.dramatiq_app import dramatiq
 
-from mist.api import config
+from mist.api.helpers import es_client
 from datetime import datetime
 
 log = logging.getLogger(__name__)
@@ -35,42 +34,22 @@ forcemerge_policy = {
 
 
 def delete(index):
-    method = 'https' if config.ELASTICSEARCH['elastic_use_ssl'] else 'http'
-    result = requests.delete(
-        (f"{method}://{config.ELASTICSEARCH['elastic_host']}"
-            f":{config.ELASTICSEARCH['elastic_port']}/{index}"),
-        params={"timeout": "1m"}, auth=(
-            config.ELASTICSEARCH['elastic_username'],
-            config.ELASTICSEARCH['elastic_password']),
-        verify=config.ELASTICSEARCH['elastic_verify_certs'])
-    print(f"* Delete index '{index}': {result.json()}")
+    result = es_client().indices.delete(index=index, timeout='1m',
+                                        ignore=[404], request_timeout=120)
+    print(f"* Delete index '{index}': {result}")
 
 
 def forcemerge(index):
-    method = 'https' if config.ELASTICSEARCH['elastic_use_ssl'] else 'http'
-    result = requests.post(
-        (f"{method}://{config.ELASTICSEARCH['elastic_host']}"
-            f":{config.ELASTICSEARCH['elastic_port']}/{index}/_forcemerge"),
-        params={"max_num_segments": "1", "flush": "true"},
-        auth=(
-            config.ELASTICSEARCH['elastic_username'],
-            config.ELASTICSEARCH['elastic_password']
-        ),
-        verify=config.ELASTICSEARCH['elastic_verify_certs'])
-    print(f"* Force merge for index '{index}': {result.json()}")
+    # Force merges may take long, don't let the client time out.
+    result = es_client().indices.forcemerge(index=index, max_num_segments=1,
+                                            flush=True, ignore=[404],
+                                            request_timeout=3600)
+    print(f"* Force merge for index '{index}': {result}")
 
 
 def merge_stats():
-    method = 'https' if config.ELASTICSEARCH['elastic_use_ssl'] else 'http'
-    result = requests.get(
-        (f"{method}://{config.ELASTICSEARCH['elastic_host']}"
-            f":{config.ELASTICSEARCH['elastic_port']}/_stats/merge"),
-        auth=(
-            config.ELASTICSEARCH['elastic_username'],
-            config.ELASTICSEARCH['elastic_password']
-        ),
-        verify=config.ELASTICSEARCH['elastic_verify_certs'])
-    print(f"* Stats: {(result.json())['_all']['total']}")
+    result = es_client().indices.stats(metric='merge')
+    print(f"* Stats: {result['_all']['total']}")
 
 
 @dramatiq.actor
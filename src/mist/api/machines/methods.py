@@ -8,6 +8,10 @@ import json
 import hmac
 import hashlib
 import ipaddress
+import itertools
+import jsonpatch
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from random import randrange
 from datetime import datetime
@@ -35,7 +39,10 @@ from mist.api.networks.models import Subnet
 from mist.api.users.models import Owner, Organization
 from mist.api.auth.models import AuthToken
 
+from mist.api.exceptions import MistError
 from mist.api.exceptions import PolicyUnauthorizedError
+from mist.api.exceptions import CloudUnavailableError
+from mist.api.exceptions import CloudUnauthorizedError
 from mist.api.exceptions import MachineNameValidationError
 from mist.api.exceptions import BadRequestError, MachineCreationError
 from mist.api.exceptions import InternalServerError
@@ -222,7 +229,7 @@ def list_machines(owner, cloud_id, cached=False, as_dict=True):
         machines = cloud.ctl.compute.list_machines()
     if not as_dict:
         return machines
-    return [machine.as_dict() for machine in machines]
+    return Machine.as_dicts(machines)
 
 
 def create_machine(auth_context, cloud_id, key_id, machine_name, location_id,
@@ -2334,6 +2341,165 @@ def filter_list_machines(auth_context, cloud_id, machines=None, perm='read',
             if machine.id in allowed_machine_ids]
 
 
+# SEC
+def filter_iter_machines(auth_context, cloud_id, cached=True,
+                         batch_size=config.LIST_MACHINES_BATCH_SIZE):
+    """Yield the machines of a cloud as dicts, one batch at a time
+
+    Cached machines are read with a cursor over the db, so at most
+    `batch_size` machines are loaded and serialized at a time. Fresh
+    machines are fetched from the provider first and then serialized in
+    batches. Non-Owners only get machines allowed by the RBAC Mappings.
+    """
+    assert cloud_id
+    cloud = Cloud.objects.get(owner=auth_context.owner, id=cloud_id,
+                              deleted=None)
+    if cached:
+        machines = iter(cloud.ctl.compute.list_cached_machines().batch_size(
+            batch_size))
+    else:
+        machines = iter(cloud.ctl.compute.list_machines())
+    while True:
+        batch = list(itertools.islice(machines, batch_size))
+        if not batch:
+            break
+        allowed_machine_ids = filter_machine_ids(
+            auth_context, cloud_id, [machine.id for machine in batch])
+        yield from Machine.as_dicts([machine for machine in batch
+                                     if machine.id in allowed_machine_ids])
+
+
+def cloud_error_dict(exc):
+    """Describe why the machines of a cloud couldn't be listed
+
+    Returns a dict with the `type`, `msg` and `http_code` of the error.
+    Errors other than `MistError` are reported as `CloudUnavailableError`.
+    """
+    if not isinstance(exc, MistError):
+        exc = CloudUnavailableError(exc=exc)
+    return {'type': exc.__class__.__name__, 'msg': str(exc),
+            'http_code': exc.http_code}
+
+
+def fan_out_list_machines(auth_context, cloud_ids, concurrency=None,
+                          timeout=None):
+    """Fetch the fresh machines of many clouds in parallel
+
+    At most `concurrency` clouds are queried at the same time. Clouds that
+    haven't completed within `timeout` seconds since the call, including
+    any that never got to start because other queries hung, are given up on.
+    Yields `(cloud_id, machines, error)` tuples in the order the clouds
+    complete. If a cloud failed or timed out, `machines` is None and `error`
+    is a dict with the `type`, `msg` and `http_code` of the error, which is a
+    `CloudUnavailableError` for timeouts and provider failures, or a
+    `CloudUnauthorizedError` for invalid credentials.
+    """
+    concurrency = concurrency or config.LIST_MACHINES_FAN_OUT_CONCURRENCY
+    timeout = timeout or config.LIST_MACHINES_FAN_OUT_TIMEOUT
+    deadline = time.time() + timeout
+
+    def list_cloud_machines(cloud_id):
+        return filter_list_machines(auth_context, cloud_id, cached=False)
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        pending = {executor.submit(list_cloud_machines, cloud_id): cloud_id
+                   for cloud_id in cloud_ids}
+        while pending:
+            done, _ = wait(pending, timeout=max(deadline - time.time(), 0),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                cloud_id = pending.pop(future)
+                try:
+                    yield cloud_id, future.result(), None
+                except Exception as exc:
+                    if not isinstance(exc, (CloudUnavailableError,
+                                            CloudUnauthorizedError)):
+                        log.exception("Error listing machines of cloud %s",
+                                      cloud_id)
+                    yield cloud_id, None, cloud_error_dict(exc)
+            if pending and time.time() >= deadline:
+                for future, cloud_id in list(pending.items()):
+                    log.warning("Listing machines of cloud %s timed out",
+                                cloud_id)
+                    pending.pop(future)
+                    error = CloudUnavailableError(
+                        "Timed out after %d seconds" % timeout)
+                    yield cloud_id, None, cloud_error_dict(error)
+    finally:
+        # Cancel the queries that haven't started and don't wait for any
+        # timed out ones to complete.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def ping_probe_machines(machine_ids, pkts=10):
+    """Ping probe many machines at once
+
+    All hosts are pinged concurrently by `mist.api.ping.ping_hosts`. The
+    probes are stored with a single bulk write and a patch is published
+    for each cloud with machines whose probe changed.
+
+    """
+    from pymongo import UpdateOne
+    from mist.api.ping import ping_hosts
+    from mist.api.methods import format_ping_result
+    from mist.api.helpers import amqp_publish_user
+    from mist.api.machines.models import PingProbe, _ref_id
+
+    machines = list(Machine.objects(id__in=machine_ids,
+                                    state__nin=['stopped', 'error'],
+                                    machine_type__ne='container'))
+    cloud_ids = {_ref_id(machine._data.get('cloud')) for machine in machines}
+    clouds = {cloud.id: cloud for cloud in Cloud.objects(
+        id__in=list(cloud_ids), enabled=True, deleted=None).only('id',
+                                                                 'owner')}
+    hosts = {}
+    for machine in machines:
+        if _ref_id(machine._data.get('cloud')) not in clouds:
+            continue
+        try:
+            host = machine.ctl.get_host()
+        except MistError:
+            continue
+        if host in ['localhost', '127.0.0.1']:
+            continue
+        hosts[machine.id] = host
+    results = ping_hosts(list(hosts.values()), pkts=pkts)
+
+    operations = []
+    patches = {}
+    for machine in machines:
+        if machine.id not in hosts:
+            continue
+        key = '%s-%s' % (machine.id, machine.external_id)
+        old_data = machine.ping_probe.as_dict() \
+            if machine.ping_probe is not None else {}
+        result = results.get(hosts[machine.id])
+        if result is not None:
+            probe = PingProbe()
+            probe.update_from_dict(format_ping_result(result))
+        elif machine.ping_probe is not None:
+            probe = machine.ping_probe
+            probe.unreachable_since = datetime.now()
+        else:
+            continue
+        operations.append(UpdateOne(
+            {'_id': machine.id}, {'$set': {'ping_probe': probe.to_mongo()}}))
+        patch = jsonpatch.JsonPatch.from_diff(
+            {key: {'probe': {'ping': old_data}}},
+            {key: {'probe': {'ping': probe.as_dict()}}}).patch
+        if patch:
+            cloud_id = _ref_id(machine._data.get('cloud'))
+            patches.setdefault(cloud_id, []).extend(patch)
+    if operations:
+        Machine._get_collection().bulk_write(operations, ordered=False)
+    for cloud_id, patch in patches.items():
+        amqp_publish_user(_ref_id(clouds[cloud_id]._data.get('owner')),
+                          routing_key='patch_machines',
+                          data={'cloud_id': cloud_id, 'patch': patch})
+    return len(operations)
+
+
 def run_pre_action_hooks(machine, action, user):
     # Look for configured post action hooks for this cloud
     cloud_id = machine.cloud.id
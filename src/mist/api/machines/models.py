@@ -6,6 +6,8 @@ import logging
 import datetime
 import mongoengine as me
 
+from bson import DBRef
+
 from mist.api.tag.models import Tag
 
 from future.utils import string_types
@@ -250,6 +252,34 @@ class SSHProbe(me.EmbeddedDocument):
         return data
 
 
+def _ref_id(value):
+    """Return the id of a reference field value without dereferencing it"""
+    if value is None:
+        return None
+    if isinstance(value, DBRef):
+        return value.id
+    return getattr(value, 'pk', value)
+
+
+def _expiration_as_dict(schedule, reminder=None):
+    """Return the expiration dict of a machine given its expiration schedule
+
+    `reminder` may be given if the reminder schedule has been preloaded.
+
+    """
+    if not schedule:
+        return None
+    reminder = reminder or schedule.reminder
+    return {
+        'id': schedule.id,
+        'action': schedule.actions[0].action,
+        'date': schedule.when.entry.isoformat(),
+        'notify': reminder and int((
+            schedule.when.entry - reminder.when.entry
+        ).total_seconds()) or 0,
+    }
+
+
 class Machine(OwnershipMixin, me.Document, TagMixin):
     """The basic machine model"""
 
@@ -321,6 +351,10 @@ class Machine(OwnershipMixin, me.Document, TagMixin):
     # Number of machines contained in this machine
     children = me.IntField(default=0)
 
+    # Hash of the libcloud node this machine was last updated from. It is
+    # used to skip reparsing nodes that haven't changed since the last poll.
+    node_fingerprint = me.StringField()
+
     meta = {
         'collection': 'machines',
         'indexes': [
@@ -502,18 +536,7 @@ class Machine(OwnershipMixin, me.Document, TagMixin):
 
     def as_dict(self):
         try:
-            if self.expiration:
-                expiration = {
-                    'id': self.expiration.id,
-                    'action': self.expiration.actions[0].action,
-                    'date': self.expiration.when.entry.isoformat(),
-                    'notify': self.expiration.reminder and int((
-                        self.expiration.when.entry -
-                        self.expiration.reminder.when.entry
-                    ).total_seconds()) or 0,
-                }
-            else:
-                expiration = None
+            expiration = _expiration_as_dict(self.expiration)
         except Exception as exc:
             log.error("Error getting expiration for machine %s: %r" % (
                 self.id, exc))
@@ -521,6 +544,107 @@ class Machine(OwnershipMixin, me.Document, TagMixin):
             self.save()
             expiration = None
 
+        return self._as_dict(
+            expiration=expiration,
+            tags={
+                tag.key: tag.value
+                for tag in Tag.objects(
+                    owner=self.owner,
+                    resource_id=self.id,
+                    resource_type='machine').only('key', 'value')
+            },
+            key_associations={
+                str(ka.id): ka.as_dict()
+                for ka in KeyMachineAssociation.objects(machine=self)
+            },
+            cloud=self.cloud,
+            size=self.size,
+        )
+
+    @classmethod
+    def as_dicts(cls, machines):
+        """Return the `as_dict()` of many machines without N+1 queries
+
+        `machines` may be a queryset or a list of machines. Tags, key
+        associations and the referenced documents that `as_dict` needs are
+        preloaded with one `$in` query per collection. Other references are
+        only ever used by their ids, which are read without dereferencing.
+        The output is identical to calling `as_dict()` on every machine.
+
+        """
+        from mist.api.clouds.models import Cloud, CloudSize
+        machines = list(machines)
+        if not machines:
+            return []
+
+        tags = {}
+        for tag in Tag.objects(
+                resource_type='machine',
+                resource_id__in=[machine.id for machine in machines]).only(
+                    'owner', 'resource_id', 'key', 'value').as_pymongo():
+            tags.setdefault((tag['resource_id'], _ref_id(tag['owner'])),
+                            {})[tag['key']] = tag.get('value')
+
+        key_associations = {}
+        for ka in KeyMachineAssociation.objects(
+                machine__in=[machine.id for machine in machines]):
+            ka_dict = ka.as_dict()
+            key_associations.setdefault(ka_dict['machine'],
+                                        {})[str(ka.id)] = ka_dict
+
+        def prefetch(model, field):
+            ids = set(_ref_id(machine._data.get(field))
+                      for machine in machines) - {None}
+            if not ids:
+                return {}
+            return {doc.id: doc for doc in model.objects(id__in=ids)}
+
+        clouds = prefetch(Cloud, 'cloud')
+        sizes = prefetch(CloudSize, 'size')
+        schedules = prefetch(Schedule, 'expiration')
+        reminder_ids = set(_ref_id(schedule._data.get('reminder'))
+                           for schedule in schedules.values()) - {None}
+        reminders = {
+            schedule.id: schedule
+            for schedule in Schedule.objects(id__in=reminder_ids)
+        } if reminder_ids else {}
+
+        ret = []
+        for machine in machines:
+            expiration_id = _ref_id(machine._data.get('expiration'))
+            try:
+                expiration = None
+                if expiration_id:
+                    schedule = schedules[expiration_id]
+                    reminder_id = _ref_id(schedule._data.get('reminder'))
+                    expiration = _expiration_as_dict(
+                        schedule, reminders.get(reminder_id) or reminder_id)
+            except Exception as exc:
+                log.error("Error getting expiration for machine %s: %r" % (
+                    machine.id, exc))
+                machine.expiration = None
+                machine.save()
+                expiration = None
+            size_id = _ref_id(machine._data.get('size'))
+            ret.append(machine._as_dict(
+                expiration=expiration,
+                tags=tags.get(
+                    (machine.id, _ref_id(machine._data.get('owner'))), {}),
+                key_associations=key_associations.get(machine.id, {}),
+                cloud=clouds.get(_ref_id(machine._data.get('cloud'))) or
+                machine.cloud,
+                size=sizes.get(size_id) or machine._data.get('size'),
+            ))
+        return ret
+
+    def _as_dict(self, expiration, tags, key_associations, cloud, size):
+        """Build the `as_dict()` of a machine out of preloaded data
+
+        References other than `cloud` and `size` are only used by their id,
+        so they are read from the raw document data, which avoids
+        dereferencing them.
+
+        """
         try:
             from bson import json_util
             extra = json.loads(json.dumps(self.extra,
@@ -530,6 +654,9 @@ class Machine(OwnershipMixin, me.Document, TagMixin):
                 self, self.extra, exc))
             extra = {}
 
+        def ref_id(field):
+            return _ref_id(self._data.get(field)) or ''
+
         return {
             'id': self.id,
             'hostname': self.hostname,
@@ -545,24 +672,16 @@ class Machine(OwnershipMixin, me.Document, TagMixin):
             'extra': extra,
             'cost': self.cost.as_dict(),
             'state': self.state,
-            'tags': {
-                tag.key: tag.value
-                for tag in Tag.objects(
-                    owner=self.owner,
-                    resource_id=self.id,
-                    resource_type='machine').only('key', 'value')
-            },
+            'tags': tags,
             'monitoring':
                 self.monitoring.as_dict() if self.monitoring and
                 self.monitoring.hasmonitoring else '',
-            'key_associations':
-                {str(ka.id): ka.as_dict()
-                 for ka in KeyMachineAssociation.objects(machine=self)},
-            'cloud': self.cloud.id,
-            'location': self.location.id if self.location else '',
-            'size': self.size.name if self.size else '',
-            'image': self.image.id if self.image else '',
-            'cloud_title': self.cloud.name,
+            'key_associations': key_associations,
+            'cloud': cloud.id,
+            'location': ref_id('location'),
+            'size': getattr(size, 'name', '') if size else '',
+            'image': ref_id('image'),
+            'cloud_title': cloud.name,
             'last_seen': str(self.last_seen.replace(tzinfo=None)
                              if self.last_seen else ''),
             'missing_since': str(self.missing_since.replace(tzinfo=None)
@@ -573,7 +692,7 @@ class Machine(OwnershipMixin, me.Document, TagMixin):
             'created': str(self.created.replace(tzinfo=None)
                            if self.created else ''),
             'machine_type': self.machine_type,
-            'parent': self.parent.id if self.parent is not None else '',
+            'parent': ref_id('parent'),
             'probe': {
                 'ping': (self.ping_probe.as_dict()
                          if self.ping_probe is not None
@@ -583,13 +702,13 @@ class Machine(OwnershipMixin, me.Document, TagMixin):
                         else SSHProbe().as_dict()),
             },
             'cores': self.cores,
-            'network': self.network.id if self.network else '',
-            'subnet': self.subnet.id if self.subnet else '',
-            'owned_by': self.owned_by.id if self.owned_by else '',
-            'created_by': self.created_by.id if self.created_by else '',
+            'network': ref_id('network'),
+            'subnet': ref_id('subnet'),
+            'owned_by': ref_id('owned_by'),
+            'created_by': ref_id('created_by'),
             'expiration': expiration,
-            'provider': self.cloud.ctl.provider,
-            'cluster': self.cluster.id if self.cluster else '',
+            'provider': cloud.ctl.provider,
+            'cluster': ref_id('cluster'),
         }
 
     def __str__(self):
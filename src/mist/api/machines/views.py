@@ -46,16 +46,23 @@ OK = Response("OK", 200)
 
 
 @view_config(route_name='api_v1_machines',
-             request_method='GET', renderer='json')
+             request_method='GET', renderer='json_stream')
 def list_machines(request):
     """
     Tags: machines
     ---
     Gets machines and their metadata from all clouds.
-    Check Permissions take place in filter_list_machines.
+    When fresh is true, clouds are queried in parallel. For every cloud that
+    fails or times out, an item like {"cloud": <id>, "error": {"type",
+    "msg", "http_code"}} is included instead of its machines.
+    Check Permissions take place in filter_iter_machines.
     READ permission required on cloud.
     READ permission required on location.
     READ permission required on machine.
+    ---
+    fresh:
+      in: query
+      type: boolean
     """
     auth_context = auth_context_from_request(request)
     params = params_from_request(request)
@@ -64,16 +71,36 @@ def list_machines(request):
     # to prevent iterate throw every cloud
     auth_context.check_perm("cloud", "read", None)
     clouds = filter_list_clouds(auth_context)
-    machines = []
-    for cloud in clouds:
-        if cloud.get('enabled'):
-            try:
-                cloud_machines = methods.filter_list_machines(
-                    auth_context, cloud.get('id'), cached=cached)
-                machines.extend(cloud_machines)
-            except (CloudUnavailableError, CloudUnauthorizedError):
-                pass
-    return machines
+
+    def iter_fresh_machines():
+        for cloud_id, machines, error in methods.fan_out_list_machines(
+                auth_context, [cloud['id'] for cloud in clouds
+                               if cloud.get('enabled')]):
+            if error:
+                yield {'cloud': cloud_id, 'error': error}
+            else:
+                yield from machines
+
+    if not cached:
+        return iter_fresh_machines()
+
+    # The response is streamed while each cloud's machines are serialized,
+    # so errors can't change its status anymore. A cloud that fails is
+    # replaced by an item describing the error, like with fresh=true.
+    def iter_machines():
+        for cloud in clouds:
+            if cloud.get('enabled'):
+                try:
+                    yield from methods.filter_iter_machines(
+                        auth_context, cloud.get('id'), cached=cached)
+                except (CloudUnavailableError, CloudUnauthorizedError):
+                    pass
+                except Exception as exc:
+                    log.exception("Error listing machines of cloud %s",
+                                  cloud.get('id'))
+                    yield {'cloud': cloud.get('id'),
+                           'error': methods.cloud_error_dict(exc)}
+    return iter_machines()
 
 
 @view_config(route_name='api_v1_cloud_machines',
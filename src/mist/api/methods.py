@@ -1,8 +1,10 @@
 import re
+import base64
 import urllib
 import subprocess
 import distutils.util
 import json
+import threading
 
 import pingparsing
 
@@ -10,7 +12,11 @@ import mongoengine as me
 
 from mongoengine import DoesNotExist, Q, BooleanField
 
+from bson import json_util
+
 from time import time
+from collections import OrderedDict
+from functools import lru_cache, reduce
 
 from libcloud.common.types import InvalidCredsError
 from libcloud.utils.networking import is_private_subnet
@@ -35,8 +41,6 @@ from mist.api.clouds.models import Cloud
 from mist.api.machines.models import Machine
 from mist.api.users.models import User
 
-from mist.api.tag.methods import get_tags_for_resource
-
 from mist.api.selectors.models import FieldSelector, ResourceSelector
 from mist.api.selectors.models import TaggingSelector, AgeSelector
 
@@ -344,8 +348,11 @@ def ping(owner, host, pkts=10):
         result = _ping_host(host, pkts=pkts)
 
     # In both cases, the returned dict is formatted by pingparsing.
+    return format_ping_result(result)
+
 
-    # Rename keys.
+def format_ping_result(result):
+    """Rename the keys of a result formatted by pingparsing"""
     final = {}
     for key, newkey in (('packet_transmit', 'packets_tx'),
                         ('packet_receive', 'packets_rx'),
@@ -536,56 +543,143 @@ def create_dns_a_record(owner, domain_name, ip_addr):
     return record
 
 
-def filter_resources_by_tags(resources, tags):
+def filter_resources_by_tags(resources, tags, owner=None):
+    """Filter a QuerySet of resources to those that have all given tags
+
+    The resources are matched with a single aggregation on the Tag
+    collection, instead of fetching the tags of every resource.
+
+    """
     if not tags:
         return resources
-    filtered_ids = []
-    for resource in resources:
-        resource_tags = get_tags_for_resource(resource.owner, resource)
-        if tags.items() <= resource_tags.items():
-            filtered_ids.append(resource.id)
-    return resources.filter(id__in=filtered_ids)
+    from mist.api.tag.models import Tag
+    resource_model = resources._document
+    resource_type = resource_model._get_collection_name().rstrip('s')
+    query = Q(resource_type=resource_type) & reduce(
+        lambda q1, q2: q1 | q2,
+        [Q(key=key, value=value) for key, value in tags.items()])
+    if owner is not None:
+        query &= Q(owner=owner)
+    pipeline = [
+        {'$match': Tag.objects(query)._query},
+        {'$group': {'_id': '$resource_id', 'keys': {'$addToSet': '$key'}}},
+        {'$match': {'keys': {'$size': len(tags)}}},
+        {'$project': {'_id': 1}},
+    ]
+    resource_ids = [doc['_id'] for doc in Tag._get_collection().aggregate(
+        pipeline, allowDiskUse=True)]
+    return resources.filter(id__in=resource_ids)
+
+
+def _parse_match_value(v):
+    """Return the (mongo operator, value) of a `:` or `=` term's value"""
+    if startsandendswith(v, '"'):
+        return '', v
+    if v.startswith('^'):
+        return '__startswith', v[1:]
+    if v.endswith('$'):
+        return '__endswith', v[:-1]
+    if v.startswith('r') and (startsandendswith(v[1:], '"') or
+                              startsandendswith(v[1:], "'")):
+        return '', re.compile(v[2:-1])
+    return '__contains', v
+
+
+def _parse_search_term(term):
+    """Return the (field, mongo operator, value, implicit) of a search term
+
+    Returns None for terms that should be skipped.
 
+    """
+    implicit = False
+    if ':' in term:
+        k, v = term.split(':')
+        mongo_operator, v = _parse_match_value(v)
+    elif '!=' in term:
+        k, v = term.split('!=')
+        mongo_operator = '__ne'
+    elif '<=' in term:
+        k, v = term.split('<=')
+        mongo_operator = '__lte'
+    elif '>=' in term:
+        k, v = term.split('>=')
+        mongo_operator = '__gte'
+    elif '>' in term:
+        k, v = term.split('>')
+        mongo_operator = '__gt'
+    elif '<' in term:
+        k, v = term.split('<')
+        mongo_operator = '__lt'
+    elif '=' in term:
+        k, v = term.split('=')
+        mongo_operator, v = _parse_match_value(v)
+    # TODO: support OR keyword
+    elif term.lower() in ['and', 'or'] or not term:
+        return None
+    else:
+        implicit = True
+        k, v = 'id', term
+        mongo_operator = '' if startsandendswith(v, '"') else '__icontains'
+
+    if getattr(v, 'strip', None):
+        v = v.strip('"')
+    return k, mongo_operator, v, implicit
+
+
+@lru_cache(maxsize=config.LIST_RESOURCES_PLAN_CACHE_SIZE)
+def compile_search(search):
+    """Parse a search expression into a tuple of search terms
+
+    Each term is a (field, mongo operator, value, implicit) tuple. Parsed
+    expressions are cached, since the same searches are run over and over.
 
-def list_resources(auth_context, resource_type, search='', cloud='', tags='',
-                   only='', sort='', start=0, limit=100, deref='', at=''):
     """
-    List resources of any type.
+    terms = []
+    for term in search_parser(search):
+        parsed = _parse_search_term(term)
+        if parsed is not None:
+            terms.append(parsed)
+    return tuple(terms)
 
-    Supports filtering, sorting, pagination. Enforces RBAC.
 
-    Parameters:
-        auth_context(AuthContext): The AuthContext of the user
-            to list resources for.
-        resource_type(str): One of Mist resources:
-            cloud, bucket, machine, zone, record, script, key,
-            schedule, network, subnet, volume, location, image,
-            rule, size, team, template, stack, tunnel.
-        search(str): The pattern to search for, can contain one or both of:
-            a) key(field)-value pairs separated by one of the operators:
-                :, =, >, <, <=, >=, !=
-            b) a single value that will be set to resource_type's ID or name.
-            Example:
-            >>> 't2.nano cpus>1 ram>=1024'
-        cloud(str): List resources from these clouds only,
-            with the same pattern as `search`.
-        tags(str or dict): List resources which satisfy these tags:
-            Examples:
-            >>> '{"dev": "", "server": "east"}'
-            >>> 'dev,server=east'
-        only(str): The fields to load from the resource_type's document,
-            comma-seperated.
-        sort(str): The field to order the query results by; field may be
-            prefixed with "+" or a "-" to determine the ordering direction.
-        start(int): The index of the first item to return.
-        limit(int): Return up to this many items.
-        deref(str):
-        at(str): Return resources created at or before a specific datetime
-            (irrespectively of deleted or missing_since status after it)
+def _filter_allowed_resources(auth_context, resource_type, result):
+    """Limit a QuerySet to the resources the user may read"""
+    try:
+        from mist.rbac.models import PERMISSIONS
+    except ImportError:
+        return result
+    if not auth_context.is_owner() and resource_type in PERMISSIONS.keys():
+        # get_allowed_resources uses plural
+        rtype = resource_type if resource_type.endswith(
+            's') else resource_type + 's'
+        allowed_resources = auth_context.get_allowed_resources(rtype=rtype)
+        result = result.filter(id__in=allowed_resources)
+    return result
+
+
+def _subquery_ids(auth_context, resource_type, subqueries, search='',
+                  cloud=''):
+    """Return the ids of all readable resources that match the filters"""
+    result = _query_resources(auth_context, resource_type, search=search,
+                              cloud=cloud, subqueries=subqueries)
+    if result is None:
+        return []
+    result = _filter_allowed_resources(auth_context, resource_type, result)
+    if subqueries is not None:
+        subqueries.append({'resource_type': resource_type,
+                           'query': result._query})
+    return list(result.scalar('id'))
+
+
+def _query_resources(auth_context, resource_type, search='', cloud='',
+                     tags='', at='', subqueries=None):
+    """Compile the filters of `list_resources` into a single QuerySet
+
+    Filters on other collections, like the cloud, location, key associations
+    and tags of the resources, are resolved with a single query each into
+    `$in` or `$nin` clauses. If `subqueries` is a list, a description of
+    each of these queries is appended to it.
 
-    Returns:
-        tuple(A mongoengine QuerySet containing the objects found,
-             the total number of items found)
     """
     from mist.api.helpers import get_resource_model
     from mist.api.clouds.models import CLOUDS
@@ -619,13 +713,11 @@ def list_resources(auth_context, resource_type, search='', cloud='', tags='',
             query &= Q(missing_since=None)
 
         if cloud and hasattr(resource_model, "zone"):
-            zones, _ = list_resources(
-                auth_context, 'zone', cloud=cloud, only='id')
-            query &= Q(zone__in=zones)
+            query &= Q(zone__in=_subquery_ids(auth_context, 'zone',
+                                              subqueries, cloud=cloud))
         else:
-            clouds, _ = list_resources(
-                auth_context, 'cloud', search=cloud, only='id')
-            query &= Q(cloud__in=clouds)
+            query &= Q(cloud__in=_subquery_ids(auth_context, 'cloud',
+                                               subqueries, search=cloud))
 
     # filter organizations
     # if user is not an admin
@@ -637,74 +729,8 @@ def list_resources(auth_context, resource_type, search='', cloud='', tags='',
     if resource_type in {'user', 'users'} and not auth_context.is_owner():
         query = Q(id__in=[auth_context.user.id])
 
-    search = search or ''
-    sort = sort or ''
-    only = only or ''
-    postfilters = []
-    id_implicit = False
-    # search filter contains space separated terms
-    # if the term contains :,=,<,>,!=, <=, >= then assume key/value query
-    # otherwise search for objects with id or name matching the term
-    terms = search_parser(search)
-    for term in terms:
-        if ':' in term:
-            k, v = term.split(':')
-            if startsandendswith(v, '"'):
-                mongo_operator = ''
-            elif v.startswith('^'):
-                mongo_operator = '__startswith'
-                v = v[1:]
-            elif v.endswith('$'):
-                mongo_operator = '__endswith'
-                v = v[:-1]
-            elif v.startswith('r') and (startsandendswith(v[1:], '"') or
-                                        startsandendswith(v[1:], "'")):
-                v = re.compile(v[2:-1])
-                mongo_operator = ''
-            else:
-                mongo_operator = '__contains'
-        elif '!=' in term:
-            k, v = term.split('!=')
-            mongo_operator = '__ne'
-        elif '<=' in term:
-            k, v = term.split('<=')
-            mongo_operator = '__lte'
-        elif '>=' in term:
-            k, v = term.split('>=')
-            mongo_operator = '__gte'
-        elif '>' in term:
-            k, v = term.split('>')
-            mongo_operator = '__gt'
-        elif '<' in term:
-            k, v = term.split('<')
-            mongo_operator = '__lt'
-        elif '=' in term:
-            k, v = term.split('=')
-            if startsandendswith(v, '"'):
-                mongo_operator = ''
-            elif v.startswith('^'):
-                mongo_operator = '__startswith'
-                v = v[1:]
-            elif v.endswith('$'):
-                mongo_operator = '__endswith'
-                v = v[:-1]
-            elif v.startswith('r') and (startsandendswith(v[1:], '"') or
-                                        startsandendswith(v[1:], "'")):
-                v = re.compile(v[2:-1])
-                mongo_operator = ''
-            else:
-                mongo_operator = '__contains'
-        # TODO: support OR keyword
-        elif term.lower() in ['and', 'or'] or not term:
-            continue
-        else:
-            id_implicit = True
-            k, v = 'id', term
-            mongo_operator = '' if startsandendswith(v, '"') else '__icontains'
-
-        if getattr(v, 'strip', None):
-            v = v.strip('"')
-
+    key_associations = None
+    for k, mongo_operator, v, implicit in compile_search(search or ''):
         attr = getattr(resource_model, k, None)
         if isinstance(attr, BooleanField):
             try:
@@ -718,36 +744,27 @@ def list_resources(auth_context, resource_type, search='', cloud='', tags='',
             try:
                 query &= Q(_cls=CLOUDS[v]()._cls)
             except KeyError:
-                return Cloud.objects.none(), 0
+                return None
 
         # TODO: only allow terms on indexed fields
         # TODO: support additional operators: >, <, !=, ~
         elif k == 'cloud':
             # exact match
             if not mongo_operator and not isinstance(v, re.Pattern):
-                resources, _ = list_resources(auth_context, k,
-                                              search=f'"{v}"',
-                                              only='id')
+                subsearch = f'"{v}"'
             else:
-                resources, _ = list_resources(auth_context, k, search=v,
-                                              only='id')
-            query &= Q(**{f'{k}__in': resources})
+                subsearch = v
+            query &= Q(**{f'{k}__in': _subquery_ids(
+                auth_context, k, subqueries, search=subsearch)})
         elif k == 'location':
             # exact match
-            if not mongo_operator:
-                resources, _ = list_resources(auth_context, k,
-                                              search=f'"{v}"',
-                                              only='id,location_type')
-            else:
-                resources, _ = list_resources(auth_context, k, search=v,
-                                              only='id,location_type')
+            subsearch = f'"{v}"' if not mongo_operator else v
+            location_ids = _subquery_ids(auth_context, k, subqueries,
+                                         search=subsearch)
             # Also include the locations' children if any
-            regions = resources.filter(location_type='region')
-            locations = [zone.id for region in regions
-                         for zone in region.children
-                         if zone not in resources]
-            locations += [resource.id for resource in resources]
-            query &= Q(**{f'{k}__in': locations})
+            location_ids += list(cloud_models.CloudLocation.objects(
+                parent__in=location_ids).scalar('id'))
+            query &= Q(**{f'{k}__in': location_ids})
         elif k in ['owned_by', 'created_by']:
             if not v or v.lower() in ['none', 'nobody']:
                 query &= Q(**{k: None})
@@ -759,8 +776,9 @@ def list_resources(auth_context, resource_type, search='', cloud='', tags='',
                 query &= Q(**{k: user.id})
             except User.DoesNotExist:
                 query &= Q(**{k: v})
-        elif k in ['key_associations', ]:  # Looks like a postfilter
-            postfilters.append((k, v))
+        elif k in ['key_associations', ]:
+            # Resolved after all other filters, among the matching machines.
+            key_associations = v
         elif k == 'tag':
             try:
                 key, val = v.split(',')
@@ -774,7 +792,7 @@ def list_resources(auth_context, resource_type, search='', cloud='', tags='',
             elif val:
                 query &= Q(__raw__={'$text': {'$search': f"\":{val}\""}})
         elif k == 'id':
-            if id_implicit is True:
+            if implicit:
                 implicit_query = Q(id=v)
                 implicit_search_fields = {
                     'name', 'domain', 'title',
@@ -791,66 +809,283 @@ def list_resources(auth_context, resource_type, search='', cloud='', tags='',
         else:
             query &= Q(**{f'{k}{mongo_operator}': v})
 
+    if key_associations is not None:
+        from mist.api.machines.models import KeyMachineAssociation
+        v = key_associations
+        association_query = Q(machine__in=list(
+            resource_model.objects(query).scalar('id')))
+        if v and v.lower() in ['sudo']:
+            association_query &= Q(sudo=True)
+        elif v and v.lower() in ['root']:
+            association_query &= Q(ssh_user='root')
+        association_query = KeyMachineAssociation.objects(
+            association_query)._query
+        if subqueries is not None:
+            subqueries.append({'resource_type': 'key_association',
+                               'query': association_query})
+        machine_ids = KeyMachineAssociation._get_collection().distinct(
+            'machine', association_query)
+        if not v or v.lower() in ['0', 'false', 'none']:
+            query &= Q(id__nin=machine_ids)
+        else:
+            query &= Q(id__in=machine_ids)
+
     result = resource_model.objects(query)
-    if only:
-        only_list = [field for field in only.split(',')
-                     if field in resource_model._fields]
-        result = result.only(*only_list)
-
-    for (k, v) in postfilters:
-        if k == 'key_associations':
-            from mist.api.machines.models import KeyMachineAssociation
-            if not v or v.lower() in ['0', 'false', 'none']:
-                ids = [machine.id for machine in result
-                       if not KeyMachineAssociation.objects(
-                           machine=machine).count()]
-            elif v.lower() in ['sudo']:
-                ids = [machine.id for machine in result
-                       if KeyMachineAssociation.objects(
-                           machine=machine, sudo=True).count()]
-            elif v.lower() in ['root']:
-                ids = [machine.id for machine in result
-                       if KeyMachineAssociation.objects(
-                           machine=machine, ssh_user='root').count()]
-            else:
-                ids = [machine.id for machine in result
-                       if KeyMachineAssociation.objects(
-                           machine=machine).count()]
-            query &= Q(id__in=ids)
-            result = resource_model.objects(query)
 
-    try:
-        if tags:
-            if not isinstance(tags, dict):
-                try:
-                    tags = json.loads(tags)
-                except json.JSONDecodeError:
-                    tags = dict((key, value[0] if value else '')
-                                for key, *value in (pair.split('=')
-                                                    for pair in tags.split(
-                                                        ',')))
-            result = filter_resources_by_tags(result, tags)
+    if tags:
+        if not isinstance(tags, dict):
+            try:
+                tags = json.loads(tags)
+            except json.JSONDecodeError:
+                tags = dict((key, value[0] if value else '')
+                            for key, *value in (pair.split('=')
+                                                for pair in tags.split(
+                                                    ',')))
+        result = filter_resources_by_tags(result, tags,
+                                          owner=auth_context.owner)
+    return result
 
-        try:
-            from mist.rbac.models import PERMISSIONS
-        except ImportError:
-            return result[start:start + limit], result.count()
-
-        if result.count():
-            if not auth_context.is_owner() \
-                    and resource_type in PERMISSIONS.keys():
-                # get_allowed_resources uses plural
-                rtype = resource_type if resource_type.endswith(
-                    's') else resource_type + 's'
-                allowed_resources = auth_context.get_allowed_resources(
-                    rtype=rtype)
-                result = result.filter(id__in=allowed_resources)
+
+def list_resources(auth_context, resource_type, search='', cloud='', tags='',
+                   only='', sort='', start=0, limit=100, deref='', at=''):
+    """
+    List resources of any type.
+
+    Supports filtering, sorting, pagination. Enforces RBAC.
+
+    Parameters:
+        auth_context(AuthContext): The AuthContext of the user
+            to list resources for.
+        resource_type(str): One of Mist resources:
+            cloud, bucket, machine, zone, record, script, key,
+            schedule, network, subnet, volume, location, image,
+            rule, size, team, template, stack, tunnel.
+        search(str): The pattern to search for, can contain one or both of:
+            a) key(field)-value pairs separated by one of the operators:
+                :, =, >, <, <=, >=, !=
+            b) a single value that will be set to resource_type's ID or name.
+            Example:
+            >>> 't2.nano cpus>1 ram>=1024'
+        cloud(str): List resources from these clouds only,
+            with the same pattern as `search`.
+        tags(str or dict): List resources which satisfy these tags:
+            Examples:
+            >>> '{"dev": "", "server": "east"}'
+            >>> 'dev,server=east'
+        only(str): The fields to load from the resource_type's document,
+            comma-seperated.
+        sort(str): The field to order the query results by; field may be
+            prefixed with "+" or a "-" to determine the ordering direction.
+        start(int): The index of the first item to return.
+        limit(int): Return up to this many items.
+        deref(str):
+        at(str): Return resources created at or before a specific datetime
+            (irrespectively of deleted or missing_since status after it)
+
+    Returns:
+        tuple(A mongoengine QuerySet containing the objects found,
+             the total number of items found)
+    """
+    try:
+        result = _query_resources(auth_context, resource_type, search=search,
+                                  cloud=cloud, tags=tags, at=at)
+        if result is None:
+            return Cloud.objects.none(), 0
+        if only:
+            only_list = [field for field in only.split(',')
+                         if field in result._document._fields]
+            result = result.only(*only_list)
+        result = _filter_allowed_resources(auth_context, resource_type,
+                                           result)
+        if sort:
             result = result.order_by(sort)
-    except me.errors.InvalidQueryError:
-        log.warn(f'Invalid query: {query}')
+        return result[start:start + limit], result.count()
+    except me.errors.InvalidQueryError as exc:
+        log.warn(f'Invalid query for {resource_type}: {exc}')
         return [], 0
 
-    return result[start:start + limit], result.count()
+
+def explain_list_resources(auth_context, resource_type, search='', cloud='',
+                           tags='', sort='', at=''):
+    """Show how `list_resources` would query the resources
+
+    Returns the compiled search terms, the queries run to resolve filters
+    on other collections, the final query and the names of the indexes the
+    query planner chose for it. This is not exposed by the API, it is meant
+    to be called from a shell when looking into slow listings.
+
+    """
+    subqueries = []
+    result = _query_resources(auth_context, resource_type, search=search,
+                              cloud=cloud, tags=tags, at=at,
+                              subqueries=subqueries)
+    if result is None:
+        return {'resource_type': resource_type, 'query': None}
+    result = _filter_allowed_resources(auth_context, resource_type, result)
+    if sort:
+        result = result.order_by(sort)
+    plan = result.explain()
+    winning_plan = plan.get('queryPlanner', {}).get('winningPlan', {})
+    return {
+        'resource_type': resource_type,
+        'terms': [{'field': k, 'operator': op or '__exact',
+                   'value': v.pattern if isinstance(v, re.Pattern) else v}
+                  for k, op, v, _ in compile_search(search or '')],
+        'subqueries': subqueries,
+        'query': result._query,
+        'sort': sort,
+        'indexes': sorted(_plan_indexes(winning_plan)),
+        'plan': winning_plan,
+    }
+
+
+def _plan_indexes(stage):
+    """Return the names of the indexes used by a query plan stage"""
+    indexes = set()
+    if stage.get('indexName'):
+        indexes.add(stage['indexName'])
+    for child in [stage.get('inputStage')] + stage.get('inputStages', []):
+        if child:
+            indexes |= _plan_indexes(child)
+    return indexes
+
+
+def _encode_cursor(sort, value, resource_id):
+    data = json_util.dumps({'sort': sort, 'value': value, 'id': resource_id})
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor, sort):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json_util.loads(data.decode())
+        value, resource_id = data['value'], data['id']
+    except (ValueError, TypeError, KeyError):
+        raise BadRequestError('Invalid cursor')
+    if data.get('sort') != sort:
+        raise BadRequestError('Cursor was issued for a different sort order')
+    return value, resource_id
+
+
+def _keyset_query(db_field, descending, value, resource_id):
+    """Return a raw query for the documents after a cursor
+
+    Documents are ordered by `db_field` and then by `_id`, in the same
+    direction. Missing and null values sort before any other value.
+
+    """
+    op = '$lt' if descending else '$gt'
+    if db_field == '_id':
+        return {'_id': {op: resource_id}}
+    same_value = {db_field: value, '_id': {op: resource_id}}
+    if value is None:
+        if descending:
+            return same_value
+        return {'$or': [same_value, {db_field: {'$ne': None}}]}
+    query = {'$or': [{db_field: {op: value}}, same_value]}
+    if descending:
+        query['$or'].append({db_field: None})
+    return query
+
+
+_count_cache = OrderedDict()  # (resource type, query) -> (expires_at, count)
+_count_cache_lock = threading.Lock()
+
+
+def _estimated_count(resource_type, result):
+    """Return the count of a QuerySet, cached for a while"""
+    key = (resource_type, json_util.dumps(result._query, sort_keys=True))
+    with _count_cache_lock:
+        cached = _count_cache.get(key)
+        if cached is not None and cached[0] > time():
+            _count_cache.move_to_end(key)
+            return cached[1]
+    count = result.count()
+    with _count_cache_lock:
+        _count_cache[key] = (time() + config.LIST_RESOURCES_COUNT_CACHE_TTL,
+                             count)
+        _count_cache.move_to_end(key)
+        while len(_count_cache) > config.LIST_RESOURCES_COUNT_CACHE_SIZE:
+            _count_cache.popitem(last=False)
+    return count
+
+
+def list_resources_page(auth_context, resource_type, search='', cloud='',
+                        tags='', only='', sort='', cursor='', limit=100,
+                        total='exact', at=''):
+    """
+    List a page of resources of any type, using keyset pagination.
+
+    Accepts the same filters as `list_resources`. Instead of skipping the
+    preceding documents, each page continues right after the last resource
+    of the previous one, based on the sort field and the resource id.
+
+    Parameters:
+        sort(str): A single field to order the results by, optionally
+            prefixed with "+" or "-". Resources are also ordered by id.
+        cursor(str): The opaque `next_cursor` returned along with the
+            previous page, or empty for the first page.
+        limit(int): Return up to this many items.
+        total(str): One of 'exact', 'estimate' or 'none'. An estimate is
+            an exact count cached for LIST_RESOURCES_COUNT_CACHE_TTL seconds.
+
+    Returns:
+        tuple(A list of the resources found,
+              a dict with the `total` and the `next_cursor`, which is None
+              on the last page)
+    """
+    if total not in ('exact', 'estimate', 'none'):
+        raise BadRequestError("total must be one of exact, estimate, none")
+    sort = sort or ''
+    descending = sort.startswith('-')
+    field = sort.lstrip('+-') or 'id'
+    if ',' in field:
+        raise BadRequestError('Cursors support sorting by a single field')
+    try:
+        result = _query_resources(auth_context, resource_type, search=search,
+                                  cloud=cloud, tags=tags, at=at)
+        if result is None:
+            return [], {'total': 0, 'next_cursor': None}
+        model = result._document
+        if field not in model._fields:
+            raise BadRequestError(f'Cannot sort by {field}')
+        db_field = model._fields[field].db_field
+        if only:
+            only_list = [name for name in only.split(',')
+                         if name in model._fields]
+            result = result.only(*set(only_list + [field]))
+        result = _filter_allowed_resources(auth_context, resource_type,
+                                           result)
+
+        if total == 'exact':
+            count = result.count()
+        elif total == 'estimate':
+            count = _estimated_count(resource_type, result)
+        else:
+            count = None
+
+        page = result
+        if cursor:
+            value, resource_id = _decode_cursor(cursor, sort)
+            page = page.filter(__raw__=_keyset_query(
+                db_field, descending, value, resource_id))
+        direction = '-' if descending else '+'
+        if field == 'id':
+            page = page.order_by(f'{direction}id')
+        else:
+            page = page.order_by(f'{direction}{field}', f'{direction}id')
+        # Fetch one more resource to know whether there is a next page.
+        resources = list(page.limit(limit + 1))
+    except me.errors.InvalidQueryError as exc:
+        log.warn(f'Invalid query for {resource_type}: {exc}')
+        return [], {'total': 0, 'next_cursor': None}
+
+    next_cursor = None
+    if len(resources) > limit:
+        resources = resources[:limit]
+        last = resources[-1].to_mongo()
+        next_cursor = _encode_cursor(sort, last.get(db_field), last['_id'])
+    return resources, {'total': count, 'next_cursor': next_cursor}
 
 
 def get_console_proxy_uri(auth_context, machine):
@@ -1,5 +1,5 @@
 import mongoengine as me
-from mist.api.tag.tasks import update_tags, delete_tags
+from mist.api.tag.tasks import sync_tagged_resources
 
 
 class MistDictField(me.DictField):
@@ -21,19 +21,17 @@ class TagQuerySet(me.QuerySet):
                signal_kwargs=None):
 
         if doc_or_docs:
-            doc_as_dict = [x.as_dict() for x in doc_or_docs]
-            update_tags.send(doc_as_dict)
-
-            return super().insert(doc_or_docs, load_bulk,
-                                  write_concern, signal_kwargs)
+            ret = super().insert(doc_or_docs, load_bulk,
+                                 write_concern, signal_kwargs)
+            sync_tagged_resources(doc_or_docs)
+            return ret
 
     def delete(self, write_concern=None, _from_doc_delete=False,
                cascade_refs=None):
-        if self:
-            tag_objs = [x.as_dict() for x in self]
-            delete_tags.send(tag_objs)
-
-        return super().delete(write_concern, _from_doc_delete, cascade_refs)
+        tags = list(self.only('resource_type', 'resource_id'))
+        ret = super().delete(write_concern, _from_doc_delete, cascade_refs)
+        sync_tagged_resources(tags)
+        return ret
 
 
 def sanitize_dict(value):
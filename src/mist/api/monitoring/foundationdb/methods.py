@@ -1,11 +1,11 @@
 import logging
-import requests
 import time
 import urllib.parse
 import json
 
 from mist.api.exceptions import ForbiddenError
 from mist.api.exceptions import ServiceUnavailableError
+from mist.api.monitoring.httpclient import client as http_client
 from mist.api import config
 
 
@@ -21,18 +21,19 @@ def get_stats(machine, start="", stop="", step="", metrics=None):
                     ', start=\"{start}\", stop=\"{stop}\"' +
                     ', step=\"{step}\")')]
 
+    urls = []
     for metric in metrics:
         query = metric.format(id=machine.id, start=start, stop=stop, step=step)
-        try:
-            raw_machine_data = requests.get(
-                "%s/v1/datapoints?query=%s"
-                % (config.TSFDB_URI, urllib.parse.quote(query)),
-                headers={'x-org-id': machine.owner.id}, timeout=20
-            )
-        except Exception as exc:
+        urls.append("%s/v1/datapoints?query=%s"
+                    % (config.TSFDB_URI, urllib.parse.quote(query)))
+    responses = http_client.get_many(
+        urls, headers={'x-org-id': machine.owner.id}, timeout=20)
+
+    for raw_machine_data in responses:
+        if isinstance(raw_machine_data, Exception):
             log.error(
                 'Got %r on get_stats for resource %s'
-                % (exc, machine.id))
+                % (raw_machine_data, machine.id))
             raise ServiceUnavailableError()
 
         if not raw_machine_data.ok:
@@ -91,7 +92,7 @@ def get_load(org, machines, start, stop, step):
         step,
     )
     try:
-        raw_machine_data = requests.get(
+        raw_machine_data = http_client.get(
             "%s/v1/datapoints?query=%s" % (config.TSFDB_URI, query),
             headers={'x-org-id': org.id,
                      'x-allowed-resources': json.dumps(machines)},
@@ -134,7 +135,7 @@ def get_cores(org, machines, start, stop, step):
         step,
     )
     try:
-        raw_machine_data = requests.get(
+        raw_machine_data = http_client.get(
             "%s/v1/datapoints?query=%s" % (config.TSFDB_URI, query),
             headers={'x-org-id': org.id,
                      'x-allowed-resources': json.dumps(machines)},
@@ -175,9 +176,9 @@ def find_metrics(machine):
     if not machine.monitoring.hasmonitoring:
         raise ForbiddenError("Machine doesn't have monitoring enabled.")
     try:
-        data = requests.get("%s/v1/resources/%s" %
-                            (config.TSFDB_URI, machine.id),
-                            headers={'x-org-id': machine.owner.id}, timeout=5)
+        data = http_client.get(
+            "%s/v1/resources/%s" % (config.TSFDB_URI, machine.id),
+            headers={'x-org-id': machine.owner.id}, timeout=5)
     except Exception as exc:
         log.error(
             'Got %r on find_metrics for resource %s'
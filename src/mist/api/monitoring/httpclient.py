@@ -0,0 +1,134 @@
+"""A shared asynchronous HTTP client for fetching monitoring data
+
+Fetching stats used to create a new asyncio event loop on every call and
+send a blocking `requests.get`, over a new connection, for every metric.
+Instead, every process runs a single event loop in a daemon thread, with an
+aiohttp session that keeps up to `MONITORING_HTTP_POOL_SIZE` connections
+alive. The blocking `get` and `get_many` methods may be called from any
+thread, e.g. by Pyramid views and dramatiq actors alike. Requests are sent
+concurrently, up to `MONITORING_HTTP_CONCURRENCY` at a time per process.
+
+"""
+
+import json
+import atexit
+import asyncio
+import logging
+import concurrent.futures
+
+import aiohttp
+
+from mist.api.concurrency.process import ProcessThread
+
+from mist.api import config
+
+
+log = logging.getLogger(__name__)
+
+
+class Response(object):
+    """The parts of a `requests.Response` the monitoring backends use"""
+
+    def __init__(self, url, status_code, content):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class HTTPClient(object):
+
+    def __init__(self, pool_size, concurrency, timeout):
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.loop = None
+        # Only used from the loop, which creates them on its first request.
+        self.session = None
+        self.semaphore = None
+        self.thread = ProcessThread(self._run, 'MonitoringHTTPClient')
+
+    def _on_start(self):
+        # The session and semaphore of a parent process belong to its loop.
+        self.loop = asyncio.new_event_loop()
+        self.session = self.semaphore = None
+        atexit.register(self.close)
+
+    def _run(self):
+        self.loop.run_forever()
+
+    def close(self):
+        if not self.thread.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_session(),
+                                             self.loop).result(timeout=5)
+        except Exception as exc:
+            log.error("Error closing monitoring HTTP session: %r", exc)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _close_session(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _fetch(self, url, params, headers):
+        async with self.semaphore:
+            async with self.session.get(url, params=params,
+                                        headers=headers) as resp:
+                return Response(url, resp.status, await resp.read())
+
+    async def _fetch_many(self, urls, params, headers, timeout):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*[
+            asyncio.wait_for(self._fetch(url, params, headers), timeout)
+            for url in urls
+        ], return_exceptions=True)
+
+    def get_many(self, urls, params=None, headers=None, timeout=None):
+        """Send a GET request to each one of `urls` concurrently
+
+        Return a list with the `Response`, or the exception raised, of each
+        request, in the order of `urls`. Requests time out after `timeout`
+        seconds, or `MONITORING_HTTP_TIMEOUT` if not set, including the time
+        they wait for other requests of the process to finish.
+
+        """
+        if not urls:
+            return []
+        timeout = timeout or self.timeout
+        self.thread.ensure(on_start=self._on_start)
+        future = asyncio.run_coroutine_threadsafe(
+            self._fetch_many(urls, params, headers, timeout), self.loop)
+        try:
+            # Requests time out by themselves, unless the loop is stuck.
+            return future.result(timeout=timeout + 5)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        """Send a GET request and return its `Response`"""
+        result = self.get_many([url], params=params, headers=headers,
+                               timeout=timeout)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+client = HTTPClient(config.MONITORING_HTTP_POOL_SIZE,
+                    config.MONITORING_HTTP_CONCURRENCY,
+                    config.MONITORING_HTTP_TIMEOUT)
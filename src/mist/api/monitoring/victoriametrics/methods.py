@@ -1,11 +1,15 @@
+import re
 import logging
-import requests
 import time
-import asyncio
+
+from urllib.parse import quote
+
+from mist.api import config
 
 from mist.api.exceptions import ForbiddenError
 from mist.api.exceptions import ServiceUnavailableError
 from mist.api.helpers import get_victoriametrics_uri
+from mist.api.monitoring.httpclient import client as http_client
 from mist.api.monitoring.victoriametrics.helpers import (
     generate_metric_mist, calculate_time_args,
     parse_value, round_base, inject_promql_machine_id)
@@ -25,17 +29,7 @@ def get_stats(machine, start="", stop="", step="", metrics=None,
         metrics = [metrics]
     if not metering:
         metrics = ['{metering!="true"}']
-    raw_machine_data_list = []
-    try:
-        loop = asyncio.get_event_loop()
-        if loop.is_closed():
-            raise RuntimeError('loop is closed')
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    raw_machine_data_list = loop.run_until_complete(
-        _async_fetch_queries(metrics, machine, time_args, loop))
-    loop.close()
+    raw_machine_data_list = _fetch_queries(metrics, machine, time_args)
     exceptions = 0
     for item in raw_machine_data_list:
         if isinstance(item, Exception):
@@ -78,29 +72,117 @@ def get_stats(machine, start="", stop="", step="", metrics=None,
     return data
 
 
-def _fetch_query(metric, machine, time_args):
-    try:
-        query = inject_promql_machine_id(metric, machine.id)
-        uri = get_victoriametrics_uri(machine.owner)
-        raw_machine_data = requests.get(
-            f"{uri}/api/v1/query_range"
-            f"?query={query}{time_args}", timeout=20)
-    except Exception as exc:
-        log.error(
-            'Got %r on get_stats for resource %s'
-            % (exc, machine.id))
-        raise ServiceUnavailableError()
-    if not raw_machine_data.ok:
-        log.error('Got %d on get_stats: %s',
-                  raw_machine_data.status_code, raw_machine_data.content)
-        raise ServiceUnavailableError()
-    return (raw_machine_data.json(), metric)
+def _fetch_queries(metrics, machine, time_args):
+    """Fetch the series of `metrics` concurrently
+
+    Return a (data, metric) tuple for each metric, or the exception raised
+    while fetching it.
 
+    """
+    results = [None] * len(metrics)
+    urls, indexes = [], []
+    for index, metric in enumerate(metrics):
+        try:
+            query = inject_promql_machine_id(metric, machine.id)
+            uri = get_victoriametrics_uri(machine.owner)
+        except Exception as exc:
+            log.error(
+                'Got %r on get_stats for resource %s'
+                % (exc, machine.id))
+            results[index] = ServiceUnavailableError()
+            continue
+        urls.append(f"{uri}/api/v1/query_range"
+                    f"?query={quote(query)}{time_args}")
+        indexes.append(index)
+    responses = http_client.get_many(urls, timeout=20)
+    for index, raw_machine_data in zip(indexes, responses):
+        if isinstance(raw_machine_data, Exception):
+            log.error(
+                'Got %r on get_stats for resource %s'
+                % (raw_machine_data, machine.id))
+            results[index] = ServiceUnavailableError()
+        elif not raw_machine_data.ok:
+            log.error('Got %d on get_stats: %s',
+                      raw_machine_data.status_code, raw_machine_data.content)
+            results[index] = ServiceUnavailableError()
+        else:
+            results[index] = (raw_machine_data.json(), metrics[index])
+    return results
 
-async def _async_fetch_queries(metrics, machine, time_args, loop):
-    return await asyncio.gather(*[loop.run_in_executor(
-        None, _fetch_query, metric, machine, time_args
-    ) for metric in metrics], return_exceptions=True)
+
+# Injected in queries in place of a machine id, then replaced by a matcher of
+# many machine ids.
+BATCH_MACHINE_ID = 'mist_batch_machine_id'
+BATCH_MATCHER_RE = re.compile(r'machine_id\s*=\s*"%s"' % BATCH_MACHINE_ID)
+
+
+def _chunk_machine_ids(machine_ids, url_parts, max_length):
+    """Split `machine_ids` in chunks whose queries fit in `max_length`"""
+    count = len(url_parts) - 1
+    length = sum(len(part) for part in url_parts)
+    length += count * len(quote('machine_id=~""'))
+    chunks, chunk, chunk_length = [], [], length
+    for machine_id in machine_ids:
+        cost = count * len(quote('%s|' % machine_id))
+        if chunk and chunk_length + cost > max_length:
+            chunks.append(chunk)
+            chunk, chunk_length = [], length
+        chunk.append(machine_id)
+        chunk_length += cost
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def get_stats_batch(org, machine_ids, metric, start="", stop="", step=""):
+    """Fetch the series of `metric` for many machines at once
+
+    The query is sent with a `machine_id=~"id1|id2|..."` matcher instead of
+    once per machine, split in as few requests as fit in
+    `VICTORIAMETRICS_MAX_URL_LENGTH`. Return a dict of machine ids to their
+    series, in the format of `get_stats`.
+
+    Raise ValueError if the returned series cannot be told apart by machine,
+    e.g. when the query aggregates the series of different machines.
+
+    """
+    query = inject_promql_machine_id(metric, BATCH_MACHINE_ID)
+    query_parts = BATCH_MATCHER_RE.split(query)
+    if len(query_parts) < 2:
+        raise ValueError("Could not inject machine ids in %s" % metric)
+    uri = get_victoriametrics_uri(org)
+    time_args = calculate_time_args(start, stop, step)
+    url_parts = [quote(part) for part in query_parts]
+    url_parts[0] = f"{uri}/api/v1/query_range?query={url_parts[0]}"
+    url_parts[-1] = f"{url_parts[-1]}{time_args}"
+    data = {machine_id: {} for machine_id in machine_ids}
+    for chunk in _chunk_machine_ids(machine_ids, url_parts,
+                                    config.VICTORIAMETRICS_MAX_URL_LENGTH):
+        matcher = quote('machine_id=~"%s"' % '|'.join(chunk))
+        try:
+            raw_data = http_client.get(matcher.join(url_parts), timeout=20)
+        except Exception as exc:
+            log.error('Got %r on get_stats_batch for %d machines',
+                      exc, len(chunk))
+            raise ServiceUnavailableError()
+        if not raw_data.ok:
+            log.error('Got %d on get_stats_batch: %s',
+                      raw_data.status_code, raw_data.content)
+            raise ServiceUnavailableError()
+        for result in raw_data.json().get('data', {}).get('result', []):
+            machine_id = result['metric'].get('machine_id')
+            if machine_id not in data:
+                raise ValueError("Got series of unknown machine %s for %s" %
+                                 (machine_id, metric))
+            name = generate_metric_mist(result['metric'], metric)
+            data[machine_id][name] = {
+                "name": name,
+                "datapoints": [[parse_value(val), str(dt)]
+                               for dt, val in result.get("values")],
+                "metric": result["metric"],
+                "target": metric
+            }
+    return data
 
 
 def find_metrics(machine):
@@ -108,7 +190,7 @@ def find_metrics(machine):
         raise ForbiddenError("Machine doesn't have monitoring enabled.")
     try:
         uri = get_victoriametrics_uri(machine.owner)
-        data = requests.get(
+        data = http_client.get(
             f"{uri}/api/v1/series",
             params={"match[]": f"{{machine_id=\"{machine.id}\"}}"})
     except Exception as exc:
@@ -139,7 +221,7 @@ def get_load(org, machines, start, stop, step):
     time_args = calculate_time_args(start, stop, step)
     try:
         uri = get_victoriametrics_uri(org)
-        raw_load_data = requests.get(
+        raw_load_data = http_client.get(
             f"{uri}/api/v1/query_range?query="
             f"{{__name__=\"system_load1\"}}{time_args}", timeout=20)
     except Exception as exc:
@@ -178,7 +260,7 @@ def get_cores(org, machines, start, stop, step):
     promql_machine_ids = promql_machine_ids[:-1]
     try:
         uri = get_victoriametrics_uri(org)
-        raw_machine_data = requests.get(
+        raw_machine_data = http_client.get(
             f"{uri}/api/v1/query_range?query="
             f"count({{__name__=\"cpu_usage_idle\", cpu=~\"cpu[0-9]*\","
             f" machine_id=~\"{promql_machine_ids}\"}}) by (machine_id)"
@@ -0,0 +1,264 @@
+"""Ping many hosts concurrently from a single process
+
+`ping_hosts` sends ICMP echo requests to all given hosts at once, using
+asyncio and one ICMP socket per host. Unprivileged ICMP datagram sockets
+are preferred and raw sockets are used when allowed instead. If neither
+may be opened, `fping` is used to ping many hosts per process and, as a
+last resort, the `ping` command is run for each host from a thread pool.
+
+The results are formatted like those of `pingparsing.PingParsing`, so they
+can be handled by `mist.api.methods.ping` just like a single host's.
+
+"""
+
+import os
+import math
+import time
+import errno
+import random
+import socket
+import shutil
+import struct
+import asyncio
+import logging
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mist.api import config
+
+
+log = logging.getLogger(__name__)
+
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+PING_INTERVAL = 0.4
+PING_TIMEOUT = 1
+
+FPING_MAX_HOSTS = 256
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _echo_request(family, ident, seq):
+    request_type = ICMP_ECHO_REQUEST if family == socket.AF_INET \
+        else ICMPV6_ECHO_REQUEST
+    payload = struct.pack('!d', time.time()) + b'mist.io ping'.ljust(48)
+    header = struct.pack('!BBHHH', request_type, 0, 0, ident, seq)
+    checksum = _checksum(header + payload)
+    return struct.pack('!BBHHH', request_type, 0, checksum, ident,
+                       seq) + payload
+
+
+def _echo_reply(family, sock_type, data):
+    """Return the (ident, seq) of an ICMP echo reply, else None"""
+    if family == socket.AF_INET and sock_type == socket.SOCK_RAW:
+        # Raw IPv4 sockets also receive the IP header.
+        data = data[(data[0] & 0x0f) * 4:]
+    if len(data) < 8:
+        return None
+    reply_type, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+    if reply_type != (ICMP_ECHO_REPLY if family == socket.AF_INET
+                      else ICMPV6_ECHO_REPLY):
+        return None
+    return ident, seq
+
+
+def _ping_result(host, transmitted, rtts, duplicates=0):
+    """Format ping statistics like `pingparsing.PingStats.as_dict`"""
+    received = len(rtts)
+    loss_count = transmitted - received
+    result = {
+        'destination': host,
+        'packet_transmit': transmitted,
+        'packet_receive': received,
+        'packet_loss_count': loss_count,
+        'packet_loss_rate': (100.0 * loss_count / transmitted
+                             if transmitted else None),
+        'rtt_min': None,
+        'rtt_avg': None,
+        'rtt_max': None,
+        'rtt_mdev': None,
+        'packet_duplicate_count': duplicates,
+        'packet_duplicate_rate': (100.0 * duplicates / received
+                                  if received else None),
+    }
+    if rtts:
+        avg = sum(rtts) / received
+        variance = sum(rtt * rtt for rtt in rtts) / received - avg * avg
+        result.update({
+            'rtt_min': round(min(rtts), 3),
+            'rtt_avg': round(avg, 3),
+            'rtt_max': round(max(rtts), 3),
+            'rtt_mdev': round(math.sqrt(max(variance, 0)), 3),
+        })
+    return result
+
+
+def icmp_socket_type():
+    """Return the type of ICMP sockets this process may open, else None"""
+    for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            sock = socket.socket(socket.AF_INET, sock_type,
+                                 socket.IPPROTO_ICMP)
+        except OSError:
+            continue
+        sock.close()
+        return sock_type
+    return None
+
+
+async def _ping_host_async(host, pkts, sock_type, semaphore):
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        try:
+            addrinfo = await loop.getaddrinfo(host, None,
+                                              type=socket.SOCK_DGRAM)
+        except socket.gaierror as exc:
+            log.warning("Cannot resolve %s: %r", host, exc)
+            return _ping_result(host, pkts, [])
+        family, _, _, _, address = addrinfo[0]
+        proto = socket.IPPROTO_ICMP if family == socket.AF_INET \
+            else socket.IPPROTO_ICMPV6
+        sock = socket.socket(family, sock_type, proto)
+        try:
+            sock.setblocking(False)
+            # Connected sockets only receive replies from the host itself.
+            sock.connect(address)
+            # The kernel replaces the identifier of datagram ICMP sockets.
+            ident = random.randint(0, 0xffff)
+            sent = {}
+            rtts = []
+            duplicates = 0
+
+            async def receive():
+                nonlocal duplicates
+                received = set()
+                while True:
+                    data = await loop.sock_recv(sock, 2048)
+                    reply = _echo_reply(family, sock_type, data)
+                    if reply is None:
+                        continue
+                    reply_ident, seq = reply
+                    if sock_type == socket.SOCK_RAW and reply_ident != ident:
+                        continue
+                    if seq not in sent:
+                        continue
+                    if seq in received:
+                        duplicates += 1
+                        continue
+                    received.add(seq)
+                    rtts.append((time.time() - sent[seq]) * 1000)
+                    if len(received) == pkts:
+                        return
+
+            receiver = asyncio.ensure_future(receive())
+            try:
+                for seq in range(pkts):
+                    sent[seq] = time.time()
+                    try:
+                        sock.send(_echo_request(family, ident, seq))
+                    except OSError as exc:
+                        if exc.errno not in (errno.EHOSTUNREACH,
+                                             errno.ENETUNREACH,
+                                             errno.EAGAIN):
+                            raise
+                    if seq < pkts - 1:
+                        await asyncio.sleep(PING_INTERVAL)
+                await asyncio.wait([receiver], timeout=PING_TIMEOUT)
+            finally:
+                receiver.cancel()
+                try:
+                    await receiver
+                except (asyncio.CancelledError, OSError):
+                    pass
+        finally:
+            sock.close()
+    return _ping_result(host, pkts, rtts, duplicates)
+
+
+async def _ping_hosts_async(hosts, pkts, sock_type, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[
+        _ping_host_async(host, pkts, sock_type, semaphore) for host in hosts
+    ], return_exceptions=True)
+    ret = {}
+    for host, result in zip(hosts, results):
+        if isinstance(result, Exception):
+            log.error("Error pinging %s: %r", host, result)
+            continue
+        ret[host] = result
+    return ret
+
+
+def _fping_hosts(hosts, pkts):
+    """Ping hosts with `fping`, which reports the rtt of every packet"""
+    ret = {}
+    for i in range(0, len(hosts), FPING_MAX_HOSTS):
+        chunk = hosts[i:i + FPING_MAX_HOSTS]
+        fping = subprocess.run(
+            ['fping', '-q', '-C', str(pkts),
+             '-p', str(int(PING_INTERVAL * 1000)),
+             '-t', str(PING_TIMEOUT * 1000)] + chunk,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Each line looks like `host : 0.10 0.12 - 0.11`
+        for line in fping.stderr.decode().splitlines():
+            host, sep, rtts = line.partition(' : ')
+            if not sep:
+                continue
+            values = rtts.split()
+            ret[host.strip()] = _ping_result(
+                host.strip(), len(values),
+                [float(value) for value in values if value != '-'])
+    return ret
+
+
+def _ping_hosts_serially(hosts, pkts, concurrency):
+    from mist.api.methods import _ping_host
+
+    ret = {}
+    with ThreadPoolExecutor(max_workers=min(concurrency, 32)) as executor:
+        futures = {host: executor.submit(_ping_host, host, pkts)
+                   for host in hosts}
+        for host, future in futures.items():
+            try:
+                ret[host] = future.result()
+            except Exception as exc:
+                log.error("Error pinging %s: %r", host, exc)
+    return ret
+
+
+def ping_hosts(hosts, pkts=10, concurrency=None):
+    """Ping all hosts concurrently
+
+    Returns a dict mapping each host to its results, formatted like those of
+    `pingparsing`. Hosts that could not be pinged at all are omitted.
+
+    """
+    hosts = list(dict.fromkeys(hosts))
+    if not hosts:
+        return {}
+    if concurrency is None:
+        concurrency = config.PING_PROBE_CONCURRENCY
+    sock_type = icmp_socket_type()
+    if sock_type is not None:
+        return asyncio.run(_ping_hosts_async(hosts, pkts, sock_type,
+                                             concurrency))
+    if shutil.which('fping'):
+        log.info("Cannot open ICMP sockets as uid %s, will use fping.",
+                 os.getuid())
+        return _fping_hosts(hosts, pkts)
+    log.warning("Cannot open ICMP sockets and fping is missing, will ping "
+                "%d hosts one by one.", len(hosts))
+    return _ping_hosts_serially(hosts, pkts, concurrency)
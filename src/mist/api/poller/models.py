@@ -95,6 +95,18 @@ class PollingSchedule(ShardedScheduleMixin, me.Document):
         """Return task args for this schedule"""
         return [str(self.id)]
 
+    @property
+    def batch_task(self):
+        """Return the task that may run many due schedules at once
+
+        If defined, the scheduler collects the ids of due schedules and
+        sends them to this task in lists of up to `batch_size` ids, instead
+        of sending each one of them to `task`.
+        """
+        return None
+
+    batch_size = 0
+
     @property
     def kwargs(self):
         """Return task kwargs for this schedule"""
@@ -453,6 +465,13 @@ class PingProbeMachinePollingSchedule(MachinePollingSchedule):
 
     task = 'mist.api.poller.tasks.ping_probe'
 
+    batch_size = config.PING_PROBE_BATCH_SIZE
+
+    @property
+    def batch_task(self):
+        if self.batch_size:
+            return 'mist.api.poller.tasks.ping_probe_batch'
+
 
 class SSHProbeMachinePollingSchedule(MachinePollingSchedule):
 
@@ -21,6 +21,7 @@ __all__ = [
     'list_volumes',
     'list_buckets',
     'ping_probe',
+    'ping_probe_batch',
     'ssh_probe'
 ]
 
@@ -278,6 +279,37 @@ def ping_probe(schedule_id):
             sched.machine, exc)
 
 
+@dramatiq.actor(queue_name='dramatiq_ping_probe',
+                time_limit=120_000,
+                max_age=30_000,
+                max_retries=0)
+def ping_probe_batch(schedule_ids):
+    """Perform the ping probes of many schedules at once"""
+
+    # FIXME: resolve circular deps error
+    from mist.api import config
+    from mist.api.poller.models import PingProbeMachinePollingSchedule
+    from mist.api.machines.methods import ping_probe_machines
+    if config.HAS_VPN:
+        # Hosts may only be reachable through the VPN, so ping them one by
+        # one with `super_ping`.
+        for schedule_id in schedule_ids:
+            ping_probe.send(schedule_id)
+        return
+    schedules = PingProbeMachinePollingSchedule.objects(
+        id__in=schedule_ids).only('machine_id')
+    machine_ids = [sched.machine_id for sched in schedules]
+    try:
+        count = ping_probe_machines(machine_ids)
+    except Exception as exc:
+        ping_probe_batch.logger.error(
+            "Error while ping-probing %d machines: %r",
+            len(machine_ids), exc)
+    else:
+        ping_probe_batch.logger.info(
+            "Ping-probed %d of %d machines", count, len(machine_ids))
+
+
 @dramatiq.actor(queue_name='dramatiq_ssh_probe',
                 time_limit=45_000,
                 max_age=30_000,
@@ -1,8 +1,9 @@
 """
-    CSV renderer for API results
+    CSV and streaming JSON renderers for API results
 """
 import json
 import csv
+import itertools
 
 from future.utils import string_types
 
@@ -52,6 +53,74 @@ def flattenjson(obj, delim="__"):
     return val
 
 
+def prefetch(items):
+    """Pull the first item of an iterable before it is streamed
+
+    Errors raised before the view yields anything are then still raised
+    while rendering, so that they are mapped to error responses instead of
+    breaking a response that was already sent with a 200 status.
+    """
+    items = iter(items)
+    try:
+        first = next(items)
+    except StopIteration:
+        return iter(())
+    return itertools.chain([first], items)
+
+
+def iter_json_array(items, chunk_size=65536):
+    """Encode an iterable of objects as a JSON array, chunk by chunk
+
+    Objects are encoded one at a time and yielded in chunks of about
+    `chunk_size` bytes, so only one chunk is ever held in memory. Objects
+    that can't be JSON encoded are converted to strings, like the default
+    json renderer does.
+    """
+    chunk = [b'[']
+    size = 1
+    for i, item in enumerate(items):
+        data = json.dumps(item, default=str).encode()
+        if i:
+            data = b',' + data
+        chunk.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk, size = [], 0
+    chunk.append(b']')
+    yield b''.join(chunk)
+
+
+def iter_csv(rows, columns):
+    """Encode an iterable of JSON objects in CSV format, row by row
+
+    Unlike `json2csv`, the columns must be known beforehand.
+    """
+    columns = ['cost__monthly' if col == 'cost' else col for col in columns]
+    columns = list(set(columns))
+    fout = StringIO()
+    writer = csv.writer(fout, delimiter=',', quotechar='"',
+                        quoting=csv.QUOTE_MINIMAL)
+    # ',' is necessary, otherwise output is wrong
+    fout.write(',')
+    writer.writerow(columns)
+    for row in rows:
+        row = flattenjson(row, "__")
+        writer.writerow([row.get(x, "") for x in columns])
+        yield fout.getvalue().encode()
+        fout.seek(0)
+        fout.truncate()
+    data = fout.getvalue()
+    if data:
+        yield data.encode()
+
+
+def is_stream(value):
+    """Return True if value is an iterator to be rendered incrementally"""
+    return not isinstance(value, (dict, list, tuple, string_types, bytes,
+                                  int, float, bool, type(None)))
+
+
 def json2csv(value, columns=None):
     """
     Transforms a serialized JSON object to CSV format
@@ -97,8 +166,38 @@ class CSVRenderer(object):
                 params = params_from_request(request)
                 columns = params.get('columns', '')
                 columns = columns and columns.split(',') or []
+                if is_stream(value):
+                    if columns:
+                        response.app_iter = iter_csv(prefetch(value), columns)
+                        return
+                    # All rows are needed to find out the columns.
+                    value = list(value)
                 # ',' is necessary, otherwise output is wrong
                 response.text = ',' + json2csv(value, columns)
             else:
                 response.content_type = 'application/json'
+                if is_stream(value):
+                    response.app_iter = iter_json_array(prefetch(value))
+                    return
                 response.json_body = value
+
+
+class StreamingJSONRenderer(object):
+    """
+    Pyramid renderer that encodes the iterable returned by a view as a JSON
+    array incrementally, while the view's generator is being consumed.
+    Views using it can yield their results one by one, so that the whole
+    result never has to be held in memory. Non iterable results are
+    rendered as plain JSON.
+    """
+    def __init__(self, info):
+        pass
+
+    def __call__(self, value, system):
+        request = system.get('request')
+        response = request.response
+        response.content_type = 'application/json'
+        if is_stream(value):
+            response.app_iter = iter_json_array(prefetch(value))
+            return
+        return json.dumps(value, default=str)
@@ -1,5 +1,4 @@
 import logging
-import asyncio
 
 from mist.api.rules.plugins import base
 from mist.api.rules.plugins import methods
@@ -9,17 +8,77 @@ from mist.api.monitoring.victoriametrics import methods as victoria_methods
 log = logging.getLogger(__name__)
 
 
+def _is_activated(machine):
+    istatus = machine.monitoring.installation_status
+    return bool(istatus and istatus.activated_at)
+
+
 class VictoriaMetricsBackendPlugin(base.BaseBackendPlugin):
 
-    def execute(self, query, rid=None):
-        # Request data given a simple target expression.
+    def __init__(self, rule, rids=None):
+        super(VictoriaMetricsBackendPlugin, self).__init__(rule, rids)
+        self._machines = None
+        self._batches = {}  # query target -> {rid: data} or exception
+
+    def get_machine(self, rid):
+        """Return the Machine with id `rid`
+
+        The machines of all `self.rids` are loaded with a single query.
+
+        """
         from mist.api.models import Machine
-        m = Machine.objects.get(id=rid)
-        data = victoria_methods.get_stats(machine=m,
+        if self._machines is None:
+            self._machines = {
+                machine.id: machine for machine in
+                Machine.objects(id__in=[rid for rid in self.rids if rid])
+            }
+        try:
+            return self._machines[rid]
+        except KeyError:
+            raise Machine.DoesNotExist('Machine %s not found' % rid)
+
+    def get_data(self, query, rid):
+        """Return the series of `query.target` for the machine `rid`
+
+        The series of all machines are fetched together, with as few queries
+        as possible, the first time a target is requested. Machines that have
+        not sent data yet, as well as queries that cannot be split by machine,
+        are evaluated with a query per machine through `get_stats`, which also
+        marks the machine's monitoring as activated when data arrive.
+
+        """
+        machine = self.get_machine(rid)
+        if _is_activated(machine):
+            if query.target not in self._batches:
+                self._batches[query.target] = self._fetch_batch(query)
+            batch = self._batches[query.target]
+            if isinstance(batch, Exception):
+                raise batch
+            if batch is not None:
+                return batch[rid]
+        return victoria_methods.get_stats(machine=machine,
                                           start=self.start,
                                           stop=self.stop,
                                           metrics=[query.target])
 
+    def _fetch_batch(self, query):
+        machine_ids = [machine.id for machine in self._machines.values()
+                       if _is_activated(machine)]
+        try:
+            return victoria_methods.get_stats_batch(
+                self.rule.org, machine_ids, query.target,
+                start=self.start, stop=self.stop)
+        except (ValueError, RuntimeError) as exc:
+            log.warning('Cannot evaluate %s for all machines at once: %r',
+                        query.target, exc)
+            return None
+        except Exception as exc:
+            return exc
+
+    def execute(self, query, rid=None):
+        # Request data given a simple target expression.
+        data = self.get_data(query, rid)
+
         # If response is empty, then data is absent for the given interval.
         if not len(data):
             log.warning('No datapoints for %s.%s', rid, query.target)
@@ -62,16 +121,14 @@ class VictoriaMetricsBackendPlugin(base.BaseBackendPlugin):
         # assert len(rule.queries) is 1
         assert not rule.queries[0].filters
 
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_closed():
-                raise RuntimeError('loop is closed')
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        results = loop.run_until_complete(
-            rule._backend_plugin(rule)._async_execute_queries(rule, loop))
-        loop.close()
+        plugin = rule._backend_plugin(rule)
+        results = []
+        for query in rule.queries:
+            for rid in plugin.rids:
+                try:
+                    results.append(plugin.execute(query, rid))
+                except Exception as exc:
+                    results.append(exc)
 
         exceptions = 0
         for result in results:
@@ -92,15 +149,6 @@ class VictoriaMetricsBackendPlugin(base.BaseBackendPlugin):
             return ''
         return '%d%s' % (self.rule.window.stop, self.rule.window.period_short)
 
-    async def _async_execute_queries(self, rule, loop):
-        queries_list = []
-        for query in rule.queries:
-            print(rule._backend_plugin(rule).rids)
-            for rid in rule._backend_plugin(rule).rids:
-                queries_list.append(loop.run_in_executor(
-                    None, rule._backend_plugin(rule).execute, query, rid))
-        return await asyncio.gather(*queries_list, return_exceptions=True)
-
 
 class VictoriaMetricsNoDataPlugin(base.NoDataMixin,
                                   VictoriaMetricsBackendPlugin):
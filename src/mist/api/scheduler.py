@@ -4,9 +4,9 @@ import importlib
 import pytz
 import threading
 import os
-from time import sleep
+import atexit
+from time import sleep, time
 
-import mongoengine as me
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.jobstores.base import JobLookupError
@@ -15,6 +15,8 @@ from mist.api import config
 from mist.api.models import Schedule
 from mist.api.poller.models import PollingSchedule
 from mist.api.rules.models import Rule
+from mist.api.sharding.models import ShardMember
+from mist.api.sharding.methods import assign_shard
 try:
     from mist.billing.models import BillingUpdateSchedule  # noqa
 except ImportError:
@@ -26,8 +28,55 @@ log.setLevel('DEBUG')
 RELOAD_INTERVAL = 5
 
 
+class BatchSender(object):
+    """Collect the ids of due schedules and send them to an actor in batches
+
+    It stands in for the actor of schedules that define a `batch_task`, so
+    that their jobs call `send` as usual. The collected ids are sent by
+    `flush`, which runs every `config.POLLING_BATCH_INTERVAL` seconds.
+
+    """
+
+    def __init__(self, actor, batch_size):
+        self.actor = actor
+        self.batch_size = batch_size
+        self.schedule_ids = {}
+        self.lock = threading.Lock()
+
+    def send(self, schedule_id):
+        with self.lock:
+            self.schedule_ids[schedule_id] = None
+
+    def flush(self):
+        with self.lock:
+            schedule_ids = list(self.schedule_ids)
+            self.schedule_ids = {}
+        for i in range(0, len(schedule_ids), self.batch_size):
+            self.actor.send(schedule_ids[i:i + self.batch_size])
+
+
+_batch_senders = {}
+
+
+def flush_batch_senders():
+    for sender in list(_batch_senders.values()):
+        try:
+            sender.flush()
+        except Exception as exc:
+            log.error('Failed to send batch to %s: %r', sender.actor, exc)
+
+
 def schedule_to_actor(schedule):
     task_path = None
+    batch_task = getattr(schedule, 'batch_task', None)
+    if isinstance(schedule, PollingSchedule) and batch_task:
+        if batch_task not in _batch_senders:
+            task_path = batch_task.split('.')
+            actor = getattr(importlib.import_module('.'.join(task_path[:-1])),
+                            task_path[-1])
+            _batch_senders[batch_task] = BatchSender(actor,
+                                                     schedule.batch_size)
+        return _batch_senders[batch_task]
     if isinstance(schedule, PollingSchedule) or isinstance(schedule, Rule):
         task_path = schedule.task.split('.')
     else:
@@ -203,57 +252,236 @@ def load_config_schedules(scheduler):
             actor.send, trigger='interval', seconds=interval, name=sched)
 
 
-def load_schedules_from_db(scheduler, schedules, first_run=False,
-                           old_schedule_ids=[]):
-    """ Load schedules from db """
-    new_schedule_ids = []
-    for schedule in schedules:
-        if not schedule.enabled:
-            continue
+def load_schedule(scheduler, schedule, first_run=False):
+    """Add or update the job of a schedule, return False if disabled"""
+    if not schedule.enabled:
+        return False
+    existing = scheduler.get_job(str(schedule.id))
+    actor = schedule_to_actor(schedule)
+
+    if existing:  # Update existing job
+        update_job(scheduler, schedule, actor, existing)
+    else:  # Add new job
+        add_job(scheduler, schedule, actor, first_run=first_run)
+    return True
+
+
+def remove_job(scheduler, schedule_id):
+    try:
+        scheduler.remove_job(schedule_id)
+    except JobLookupError as e:
+        print('Error cleaning up job: %r' % e)
+
+
+class ScheduleReloader(object):
+    """Keep the jobs of a collection of schedules in sync with the db
 
-        new_schedule_ids.append(str(schedule.id))
-        existing = scheduler.get_job(str(schedule.id))
-        actor = schedule_to_actor(schedule)
+    Every schedule used to be loaded every `RELOAD_INTERVAL` seconds. If
+    incremental reloads are enabled and the db supports change streams, a
+    thread follows the changes of the collection instead, and only the
+    schedules that changed since the last reload get loaded again. Changes
+    to `ignored_fields` only, which are updated by the scheduler and the
+    shard manager themselves, are ignored. Schedules are also loaded again
+    when they expire, or when an override interval of theirs does.
 
-        if existing:  # Update existing job
-            update_job(scheduler, schedule, actor, existing)
-        else:  # Add new job
-            add_job(scheduler, schedule, actor, first_run=first_run)
+    Schedules are still fully reloaded every
+    `config.SCHEDULER_FULL_RELOAD_INTERVAL` seconds, since `enabled` also
+    depends on other documents, such as the cloud or machine of the
+    schedule, and whenever the change stream had to be restarted.
 
-    # Cleanup deleted schedules
-    for sid in old_schedule_ids:
-        if sid not in new_schedule_ids:
+    """
+
+    # Fields updated all the time by the scheduler and shard manager, which
+    # don't affect jobs.
+    ignored_fields = ('shard_update_at', 'last_run_at', 'total_run_count')
+
+    def __init__(self, name, scheduler, get_schedules,
+                 pass_first_run=True, ignored_fields=None):
+        self.name = name
+        self.scheduler = scheduler
+        self.get_schedules = get_schedules
+        self.pass_first_run = pass_first_run
+        if ignored_fields is not None:
+            self.ignored_fields = ignored_fields
+        self.schedule_ids = []
+        self.changed_ids = set()
+        self.expiring = {}  # schedule id -> when it has to be loaded again
+        self.lock = threading.Lock()
+        self.resync = True
+        self.watching = False
+        self.thread = None
+        self.last_full_reload = 0
+        self.reload_count = 0
+        self.full_reload_count = 0
+        self.last_reload_seconds = 0
+        self.last_touched_count = 0
+
+    def reload(self, first_run=False):
+        if config.SCHEDULER_INCREMENTAL_RELOAD and self.thread is None:
+            self.thread = threading.Thread(target=self._watch,
+                                           name='%sWatcher' % self.name,
+                                           daemon=True)
+            self.thread.start()
+        started_at = time()
+        with self.lock:
+            full = self.resync or not self.watching or \
+                started_at - self.last_full_reload >= \
+                config.SCHEDULER_FULL_RELOAD_INTERVAL
+            self.resync = False
+            changed_ids, self.changed_ids = self.changed_ids, set()
+        kwargs = {'first_run': first_run} if self.pass_first_run else {}
+        if full:
+            log.info('Reloading %s', self.name)
+            self.expiring = {}
+            touched = 0
+            schedule_ids = []
+            for schedule in self.get_schedules():
+                touched += 1
+                if load_schedule(self.scheduler, schedule, **kwargs):
+                    schedule_ids.append(str(schedule.id))
+                self._track_expiry(schedule)
+            new_ids = set(schedule_ids)
+            for sid in self.schedule_ids:
+                if sid not in new_ids:
+                    remove_job(self.scheduler, sid)
+            self.schedule_ids = schedule_ids
+            self.last_full_reload = started_at
+            self.full_reload_count += 1
+        else:
+            now = datetime.datetime.now()
+            for sid, expires in list(self.expiring.items()):
+                if expires <= now:
+                    changed_ids.add(sid)
+                    del self.expiring[sid]
+            touched = self._reload_changed(changed_ids, kwargs)
+        self.reload_count += 1
+        self.last_reload_seconds = time() - started_at
+        self.last_touched_count = touched
+        log.log(logging.INFO if full or touched else logging.DEBUG,
+                'Reloaded %s %s in %.3fs, %d documents touched',
+                'all' if full else 'changed', self.name,
+                self.last_reload_seconds, touched)
+
+    def _reload_changed(self, changed_ids, kwargs):
+        if not changed_ids:
+            return 0
+        loaded_ids = set()
+        touched = 0
+        for schedule in self.get_schedules().filter(id__in=list(changed_ids)):
+            touched += 1
+            sid = str(schedule.id)
+            self._track_expiry(schedule)
+            if load_schedule(self.scheduler, schedule, **kwargs):
+                loaded_ids.add(sid)
+        # Schedules that were deleted, disabled or claimed by another shard
+        schedule_ids = set(self.schedule_ids)
+        for sid in changed_ids - loaded_ids:
+            if sid in schedule_ids:
+                remove_job(self.scheduler, sid)
+        self.schedule_ids = list((schedule_ids - changed_ids) | loaded_ids)
+        return touched
+
+    def _track_expiry(self, schedule):
+        """Reload schedules when they expire or reach their `start_after`
+
+        Polling schedules are also reloaded when an override interval of
+        theirs expires.
+
+        """
+        now = datetime.datetime.now()
+        expires = [interval.expires
+                   for interval in getattr(schedule, 'override_intervals',
+                                           None) or []
+                   if interval.expires and not interval.expired()]
+        expires += [date for date in (getattr(schedule, 'expires', None),
+                                      getattr(schedule, 'start_after', None))
+                    if date and date >= now]
+        if expires:
+            self.expiring[str(schedule.id)] = min(expires)
+        else:
+            self.expiring.pop(str(schedule.id), None)
+
+    def _pipeline(self):
+        relevant_fields = {'$filter': {
+            'input': {'$objectToArray': '$updateDescription.updatedFields'},
+            'cond': {'$not': [{'$in': ['$$this.k',
+                                       list(self.ignored_fields)]}]},
+        }}
+        return [{'$match': {'$or': [
+            {'operationType': {'$ne': 'update'}},
+            {'updateDescription.removedFields.0': {'$exists': True}},
+            {'$expr': {'$gt': [{'$size': relevant_fields}, 0]}},
+        ]}}]
+
+    def _watch(self):
+        from pymongo.errors import PyMongoError, OperationFailure
+        collection = self.get_schedules()._document._get_collection()
+        while True:
             try:
-                scheduler.remove_job(sid)
-            except JobLookupError as e:
-                print('Error cleaning up job: %r' % e)
-    return new_schedule_ids
+                with collection.watch(self._pipeline()) as stream:
+                    with self.lock:
+                        # Changes may have been missed before the stream
+                        # was opened.
+                        self.watching = True
+                        self.resync = True
+                    log.info('Watching changes of %s', self.name)
+                    for change in stream:
+                        doc_id = change.get('documentKey', {}).get('_id')
+                        with self.lock:
+                            if doc_id is not None:
+                                self.changed_ids.add(str(doc_id))
+                            else:
+                                self.resync = True
+            except OperationFailure as exc:
+                if exc.code == 40573:  # Not a replica set
+                    log.warning('Cannot watch changes of %s, will fully '
+                                'reload them every time: %r', self.name, exc)
+                    with self.lock:
+                        self.watching = False
+                    return
+                log.error('Error watching changes of %s: %r', self.name, exc)
+            except PyMongoError as exc:
+                log.error('Error watching changes of %s: %r', self.name, exc)
+            with self.lock:
+                self.watching = False
+            sleep(RELOAD_INTERVAL)
+
+    def metrics(self):
+        return {
+            'watching': self.watching,
+            'schedules': len(self.schedule_ids),
+            'reloads': self.reload_count,
+            'full_reloads': self.full_reload_count,
+            'last_reload_seconds': self.last_reload_seconds,
+            'last_touched': self.last_touched_count,
+        }
 
 
 def _start_shard_manager(schedule_cls, current_shard_id):
     """Start the sharding process."""
 
-    # The time-frame for which a shard assignment is considered valid. If a
-    # document's `shard_update_at` field is not touched/renewed within this
-    # period of time, then the document may be re-assigned to a different
-    # shard.
+    # The time-frame for which a member of the shard group is considered
+    # alive. If a scheduler process doesn't renew its heartbeat within this
+    # period of time, then its documents are re-assigned to the other shards.
     max_shard_period = config.SHARD_MANAGER_MAX_SHARD_PERIOD
 
-    # The maximum number of documents that may be assigned to a single shard
-    # at a time. This should be set to a meaningful value to not delay shard
-    # assignment, but also prevent the majority of the documents from being
-    # assigned to the same shard.
+    # The maximum number of documents that are claimed with a single bulk
+    # update.
     max_shard_claims = config.SHARD_MANAGER_MAX_SHARD_CLAIMS
 
-    # The amount of time the sharding thread may sleep in between checks. We
-    # set this to a meaningful value to not delay shard assignment, but also
-    # give time to other processes of the scheduler to claim their piece of
-    # the pie.
+    # The amount of time the sharding thread may sleep in between checks.
+    # Membership changes are noticed and documents are moved within this
+    # period of time.
     manager_interval = config.SHARD_MANAGER_INTERVAL
 
     assert current_shard_id
     assert manager_interval < max_shard_period
 
+    group = schedule_cls._get_collection_name()
+    ShardMember.heartbeat(group, current_shard_id)
+    atexit.register(_leave_shard_group, schedule_cls, group,
+                    current_shard_id)
+
     # Perform the sharding in a separate thread.
     t = threading.Thread(target=_do_sharding,
                          args=(schedule_cls,
@@ -266,43 +494,73 @@ def _start_shard_manager(schedule_cls, current_shard_id):
     t.start()
 
 
+def _leave_shard_group(schedule_cls, group, current_shard_id):
+    """Hand over the documents of this shard when the process exits"""
+    ShardMember.leave(group, current_shard_id)
+    schedule_cls.objects(shard_id=current_shard_id).update(
+        shard_id=None, shard_update_at=None)
+
+
 def _do_sharding(schedule_cls, current_shard_id, max_shard_period,
                  max_shard_claims, manager_interval):
     """Shard the schedules' collection.
 
     This function is executed in a separate thread and is responsible for
-    sharding the respective collection. Documents, whose shard identifier
-    has not been set or renewed within a given timeframe, may be assigned
-    to another shard.
+    sharding the respective collection. Every scheduler process renews its
+    heartbeat in the `ShardMember` registry and each document belongs to the
+    live member picked for its id by rendezvous hashing.
 
-    Each running thread attempts to claim as many documents as possible,
-    until all documents have been assigned to a specific shard.
+    Each running thread claims the documents that belong to its own shard
+    with bulk updates, so processes joining or leaving only move about 1/N
+    of the documents, and don't need to wait for any other process to
+    release them.
 
-    Every time a new sharding thread starts, all shard identifiers reset
-    and re-sharding occurs.
+    All documents are checked when the live members change and every
+    `max_shard_period` seconds. Otherwise only new documents and those of
+    members that are gone are.
 
     """
-
-    schedule_cls.objects.update(shard_id=None, shard_update_at=None)
+    group = schedule_cls._get_collection_name()
+    collection = schedule_cls._get_collection()
+    members = []
+    last_full_check = 0
 
     while True:
-        now = datetime.datetime.utcnow()
-
-        # Touch existing documents to renew the sharding period.
-        objects = schedule_cls.objects(shard_id=current_shard_id)
-        renewed = objects.update(shard_update_at=now)
-        log.debug('%s renewed %s docs', current_shard_id, renewed)
-
-        # Fetch documents which have either not been claimed or renewed.
-        d = now - datetime.timedelta(seconds=max_shard_period)
-        q = (me.Q(shard_update_at__lt=d) | me.Q(shard_update_at=None))
-        q &= me.Q(shard_id__ne=current_shard_id)
-
-        # Claim some of the documents. Note that we have to iterate the
-        # limited cursor, instead of applying a bulk update.
-        for doc in schedule_cls.objects(q).limit(max_shard_claims):
-            doc.update(shard_id=current_shard_id, shard_update_at=now)
-            log.debug('%s claimed %s', current_shard_id, doc.name)
+        try:
+            ShardMember.heartbeat(group, current_shard_id)
+            live_members = ShardMember.live_members(group, max_shard_period)
+            if current_shard_id not in live_members:
+                live_members = sorted(live_members + [current_shard_id])
+
+            full_check = live_members != members or \
+                time() - last_full_check >= max_shard_period
+            if full_check:
+                if live_members != members:
+                    log.info('%s shard members: %s', current_shard_id,
+                             ', '.join(live_members))
+                query = {}
+                last_full_check = time()
+            else:
+                query = {'shard_id': {'$nin': live_members}}
+            members = live_members
+
+            claims = [
+                doc['_id'] for doc in collection.find(
+                    query, {'_id': 1, 'shard_id': 1})
+                if doc.get('shard_id') != current_shard_id and
+                assign_shard(str(doc['_id']), members) == current_shard_id
+            ]
+            now = datetime.datetime.utcnow()
+            for i in range(0, len(claims), max_shard_claims):
+                collection.update_many(
+                    {'_id': {'$in': claims[i:i + max_shard_claims]}},
+                    {'$set': {'shard_id': current_shard_id,
+                              'shard_update_at': now}})
+            if claims:
+                log.info('%s claimed %d docs', current_shard_id, len(claims))
+        except Exception as exc:
+            log.error('%s failed to shard %s: %r', current_shard_id, group,
+                      exc)
 
         sleep(manager_interval)
 
@@ -321,43 +579,36 @@ def start(**kwargs):
     if kwargs.get('builtin'):
         load_config_schedules(scheduler)
 
+    # Send the runs of batched polling schedules collected since last time
+    if kwargs.get('polling'):
+        scheduler.add_job(flush_batch_senders, trigger='interval',
+                          seconds=config.POLLING_BATCH_INTERVAL,
+                          name='flush_batch_senders')
+
     try:  # Start scheduler
         scheduler.start()
         first_run = True
-        old_schedules = {}
+        reloaders = []
+        if kwargs.get('user'):
+            # User schedules are disabled once they reach their
+            # max_run_count.
+            reloaders.append(ScheduleReloader(
+                'user schedules', scheduler,
+                lambda: Schedule.objects(deleted=False),
+                ignored_fields=('shard_update_at', 'last_run_at')))
+        if kwargs.get('polling'):
+            current_shard_id = os.getenv('HOSTNAME', '')
+            _start_shard_manager(PollingSchedule, current_shard_id)
+            reloaders.append(ScheduleReloader(
+                'polling schedules', scheduler,
+                lambda: PollingSchedule.objects(shard_id=current_shard_id)))
+        if kwargs.get('rules'):
+            reloaders.append(ScheduleReloader(
+                'rules', scheduler, lambda: Rule.objects(),
+                pass_first_run=False))
         while True:  # Start main loop
-            if kwargs.get('user'):
-                log.info('Reloading user schedules')
-                if not old_schedules.get('user', None):
-                    old_schedules['user'] = []
-                old_schedules['user'] = load_schedules_from_db(
-                    scheduler,
-                    Schedule.objects(deleted=False),
-                    first_run=first_run,
-                    old_schedule_ids=old_schedules['user']
-                )
-            if kwargs.get('polling'):
-                if first_run is True:
-                    current_shard_id = os.getenv('HOSTNAME', '')
-                    _start_shard_manager(PollingSchedule, current_shard_id)
-                log.info('Reloading polling schedules')
-                if not old_schedules.get('polling', None):
-                    old_schedules['polling'] = []
-                old_schedules['polling'] = load_schedules_from_db(
-                    scheduler,
-                    PollingSchedule.objects(shard_id=current_shard_id),
-                    first_run=first_run,
-                    old_schedule_ids=old_schedules['polling']
-                )
-            if kwargs.get('rules'):
-                log.info('Reloading rules')
-                if not old_schedules.get('rules', None):
-                    old_schedules['rules'] = []
-                old_schedules['rules'] = load_schedules_from_db(
-                    scheduler,
-                    Rule.objects(),
-                    old_schedule_ids=old_schedules['rules']
-                )
+            for reloader in reloaders:
+                reloader.reload(first_run=first_run)
             sleep(RELOAD_INTERVAL)
             first_run = False
     except KeyboardInterrupt:
@@ -14,6 +14,7 @@ from mist.api.exceptions import BadRequestError
 from mist.api.helpers import trigger_session_update, mac_sign
 from mist.api.helpers import RabbitMQStreamConsumer
 from mist.api.exceptions import ScriptNameExistsError
+from mist.api.scripts.cache import artifact_cache, iter_file
 
 from mist.api import config
 
@@ -133,83 +134,36 @@ class BaseScriptController(object):
             self.script.delete()
         trigger_session_update(self.script.owner, ['scripts'])
 
-    def _url(self):
-        redirect_url = ''
-        if self.script.location.type == 'github':
-            token = config.GITHUB_BOT_TOKEN
-            if token:
-                headers = {'Authorization': 'token %s' % token}
-            else:
-                headers = {}
-
-            path = self.script.location.repo.replace(
-                'https://github.com/', '')
-
-            if '/tree/' in path:
-                [path, branch] = path.split('/tree/')
-            else:
-                api_url = 'https://api.github.com/repos/%s' % path
-                resp = requests.get(api_url, headers=headers,
-                                    allow_redirects=False)
-                if resp.ok:
-                    branch = resp.json().get('default_branch')
-                else:
-                    log.error('Failed to fetch default branch %r', resp)
-                    branch = 'master'
-
-            api_url = 'https://api.github.com/repos/%s/tarball/%s' % (
-                path, branch)
+    def get_file(self):
+        """Return a file along with HTTP response parameters.
 
-            resp = requests.get(api_url, headers=headers,
-                                allow_redirects=False)
-            if resp.ok and resp.is_redirect and 'location' in resp.headers:
-                redirect_url = resp.headers['location']
-            else:
-                log.error('%d: Could not retrieve your file: %s',
-                          resp.status_code, resp.content)
-                raise BadRequestError('%d: Could not retrieve your file: %s'
-                                      % (resp.status_code, resp.content))
-        else:
-            redirect_url = self.script.location.url
-        return redirect_url
+        The files of GitHub and URL scripts are streamed from the script
+        artifact cache, downloading them first if needed.
 
-    def get_file(self):
-        """Return a file along with HTTP response parameters."""
+        """
 
         if self.script.location.type == 'inline':
             return dict(content_type='text/plain', charset='utf-8',
                         body=self.script.location.source_code)
+        elif self.script.location.type == 'github':
+            meta, file = artifact_cache.github_file(
+                self.script.location.repo, token=config.GITHUB_BOT_TOKEN)
         else:
-            # Download a file over HTTP
-            url = self._url()
-            log.debug("Downloading %s.", url)
-            try:
-                r = requests.get(url)
-                r.raise_for_status()
-            except requests.exceptions.HTTPError as err:
-                raise BadRequestError(err.msg)
-
-            if 'gzip' in r.headers['Content-Type']:
-                if r.headers.get('content-disposition', ''):
-                    filename = r.headers.get(
-                        'content-disposition').split("=", 1)[1]
-                else:
-                    filename = "script.tar.gz"
-
-                return dict(content_type=r.headers['Content-Type'],
-                            content_disposition='attachment; '
-                            'filename=%s' %
-                            filename,
-                            charset='utf8',
-                            pragma='no-cache',
-                            body=r.content)
+            meta, file = artifact_cache.url_file(self.script.location.url)
+
+        if 'gzip' in meta['content_type']:
+            if meta['content_disposition']:
+                filename = meta['content_disposition'].split("=", 1)[1]
             else:
-                return dict(content_type=r.headers['Content-Type'],
-                            content_disposition='attachment; '
-                            'filename="script.gzip"',
-                            charset='utf8',
-                            pragma='no-cache',
-                            body=r.content)
+                filename = "script.tar.gz"
+        else:
+            filename = '"script.gzip"'
+        return dict(content_type=meta['content_type'],
+                    content_disposition='attachment; filename=%s' % filename,
+                    content_length=meta['size'],
+                    charset='utf8',
+                    pragma='no-cache',
+                    app_iter=iter_file(file))
 
     def generate_signed_url(self):
         # build HMAC and inject into the `curl` command
@@ -0,0 +1,350 @@
+"""An on-disk cache of the files of GitHub and URL scripts
+
+Every machine that runs a GitHub or URL script fetches its file from the API,
+which used to query the GitHub API and download the tarball again, so running
+a script on hundreds of machines could hit GitHub's rate limits. Instead,
+downloaded files are kept in `SCRIPTS_CACHE_DIR`, shared by all processes of
+a host, and streamed from there:
+
+- The tarball of a GitHub repo is keyed by the commit its ref resolves to.
+- A file downloaded from a URL is keyed by its URL and revalidated with its
+  ETag, if any.
+
+Refs and ETags are checked again after `SCRIPTS_CACHE_REF_TTL` seconds. Each
+key is fetched while holding a file lock, so that concurrent workers download
+it only once. The least recently used files are evicted once they take up
+more than `SCRIPTS_CACHE_SIZE` bytes, and the metadata & locks of keys that
+haven't been used for `STALE_FILE_AGE` seconds are removed.
+
+Anyone who may write to the cache dir could replace the scripts run on
+machines, so it is created private to the current user and the cache is
+disabled if an existing dir isn't.
+
+"""
+
+import os
+import json
+import stat
+import time
+import fcntl
+import hashlib
+import logging
+import tempfile
+import contextlib
+
+import requests
+
+from mist.api import config
+from mist.api.exceptions import BadRequestError
+
+
+log = logging.getLogger(__name__)
+
+
+GITHUB_API_URL = 'https://api.github.com'
+
+# Seconds to wait for GitHub or a script's server to connect or send data.
+DOWNLOAD_TIMEOUT = 60
+
+# Seconds after which the metadata & locks of unused keys, and leftovers of
+# interrupted downloads, are removed.
+STALE_FILE_AGE = 24 * 60 * 60
+
+
+def iter_file(file, block_size=256 * 1024):
+    """Yield the contents of a file object in blocks and then close it"""
+    with file:
+        data = file.read(block_size)
+        while data:
+            yield data
+            data = file.read(block_size)
+
+
+class ScriptArtifactCache(object):
+
+    def __init__(self, path, size, ref_ttl, github_api_url=GITHUB_API_URL):
+        self.path = path
+        self.size = size
+        self.ref_ttl = ref_ttl
+        self.github_api_url = github_api_url
+        self._private = None
+
+    @property
+    def enabled(self):
+        return bool(self.path and self.size) and self._check_path()
+
+    def _check_path(self):
+        """Create the cache dir, or check that it is private to this user"""
+        # Check it again if it was removed meanwhile, e.g. by a tmp cleaner.
+        if self._private is None or \
+                self._private and not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path, mode=0o700, exist_ok=True)
+                path_stat = os.lstat(self.path)
+            except OSError as exc:
+                log.error('Cannot create script cache dir %s, the cache is '
+                          'disabled: %r', self.path, exc)
+                self._private = False
+                return False
+            self._private = bool(stat.S_ISDIR(path_stat.st_mode) and
+                                 path_stat.st_uid == os.geteuid() and
+                                 not path_stat.st_mode & 0o077)
+            if not self._private:
+                log.error('Script cache dir %s must be a dir that only uid '
+                          '%d may access, the cache is disabled.',
+                          self.path, os.geteuid())
+        return self._private
+
+    def github_file(self, repo, token=''):
+        """Return the metadata & file object of a GitHub repo's tarball
+
+        `repo` is a GitHub URL or an `owner/repo` path, optionally followed by
+        `/tree/<ref>`. The default branch is used if no ref is given.
+
+        """
+        path = repo.replace('https://github.com/', '')
+        ref = 'HEAD'
+        if '/tree/' in path:
+            path, ref = path.split('/tree/', 1)
+        headers = {'Authorization': 'token %s' % token} if token else {}
+        sha = self._resolve_github_ref(path, ref, headers)
+        url = '%s/repos/%s/tarball/%s' % (self.github_api_url, path, sha)
+        return self._fetch(('github', path, sha), url, headers=headers)
+
+    def url_file(self, url):
+        """Return the metadata & file object of the file at `url`"""
+        return self._fetch(('url', url), url, revalidate=True)
+
+    def _resolve_github_ref(self, path, ref, headers):
+        """Return the sha of the commit a ref of a GitHub repo points to"""
+        key = ('github-ref', path, ref)
+        with self._lock(key):
+            meta = self._read_meta(key) or {}
+            if meta.get('sha') and \
+                    time.time() - meta['checked_at'] < self.ref_ttl:
+                return meta['sha']
+            headers = dict(headers, Accept='application/vnd.github.sha')
+            if meta.get('etag'):
+                # Conditional requests don't count against rate limits.
+                headers['If-None-Match'] = meta['etag']
+            url = '%s/repos/%s/commits/%s' % (self.github_api_url, path, ref)
+            try:
+                resp = requests.get(url, headers=headers,
+                                    timeout=DOWNLOAD_TIMEOUT)
+            except requests.exceptions.RequestException as exc:
+                resp = None
+                error = repr(exc)
+            else:
+                error = '%d: %s' % (resp.status_code, resp.content)
+            if resp is not None and resp.status_code == 304 and meta:
+                pass
+            elif resp is not None and resp.ok:
+                meta = {'sha': resp.text.strip(),
+                        'etag': resp.headers.get('ETag')}
+            elif meta.get('sha'):
+                log.error('Failed to resolve %s of %s, using %s: %s',
+                          ref, path, meta['sha'], error)
+                return meta['sha']
+            else:
+                log.error('Failed to resolve %s of %s: %s', ref, path, error)
+                raise BadRequestError('Could not retrieve your file: %s'
+                                      % error)
+            meta['checked_at'] = time.time()
+            if self.enabled:
+                self._write_meta(key, meta)
+            return meta['sha']
+
+    def _fetch(self, key, url, headers=None, revalidate=False):
+        """Return the metadata & file object of the response to GET `url`
+
+        The response is downloaded only if it isn't cached yet, or if
+        `revalidate` is True and it changed since it was last checked.
+
+        """
+        path = self._key_path(key, '.bin')
+        with self._lock(key):
+            meta = self._read_meta(key)
+            if meta and os.path.exists(path):
+                if not revalidate or \
+                        time.time() - meta['checked_at'] < self.ref_ttl:
+                    return meta, self._open(path)
+                if meta.get('etag'):
+                    headers = dict(headers or {},
+                                   **{'If-None-Match': meta['etag']})
+            else:
+                meta = None
+            log.debug("Downloading %s.", url)
+            try:
+                resp = requests.get(url, headers=headers, stream=True,
+                                    timeout=DOWNLOAD_TIMEOUT)
+            except requests.exceptions.RequestException as exc:
+                raise BadRequestError('Could not retrieve your file: %r'
+                                      % exc)
+            with resp:
+                if resp.status_code == 304 and meta:
+                    meta['checked_at'] = time.time()
+                    self._write_meta(key, meta)
+                    return meta, self._open(path)
+                if not resp.ok:
+                    log.error('%d: Could not retrieve your file: %s',
+                              resp.status_code, resp.content)
+                    raise BadRequestError('%d: Could not retrieve your file: '
+                                          '%s' % (resp.status_code,
+                                                  resp.content))
+                meta = {
+                    'url': url,
+                    'etag': resp.headers.get('ETag'),
+                    'content_type': resp.headers.get('Content-Type', ''),
+                    'content_disposition': resp.headers.get(
+                        'Content-Disposition', ''),
+                    'checked_at': time.time(),
+                }
+                if not self.enabled:
+                    file = tempfile.TemporaryFile()
+                    meta['size'] = self._download(resp, file)
+                    file.seek(0)
+                    return meta, file
+                with tempfile.NamedTemporaryFile(dir=self.path, suffix='.tmp',
+                                                 delete=False) as file:
+                    try:
+                        meta['size'] = self._download(resp, file)
+                    except Exception:
+                        os.remove(file.name)
+                        raise
+                os.replace(file.name, path)
+            self._write_meta(key, meta)
+            file = self._open(path)
+        self._evict()
+        return meta, file
+
+    @staticmethod
+    def _download(resp, file):
+        size = 0
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            file.write(chunk)
+            size += len(chunk)
+        return size
+
+    def _open(self, path):
+        # Keep track of when files were last used, to evict the oldest ones.
+        os.utime(path)
+        return open(path, 'rb')
+
+    def _evict(self):
+        """Remove the least recently used files over the size limit
+
+        Also removes the metadata & locks of keys without a file, like the
+        commits of GitHub refs, once they haven't been used for a while.
+
+        """
+        files, total = [], 0
+        last_used = {}
+        stale_before = time.time() - STALE_FILE_AGE
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            digest, ext = os.path.splitext(name)
+            try:
+                file_stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if ext == '.bin':
+                files.append((file_stat.st_mtime, file_stat.st_size, digest))
+                total += file_stat.st_size
+            elif ext == '.tmp':
+                if file_stat.st_mtime < stale_before:
+                    self._remove(path)
+            else:
+                last_used[digest] = max(last_used.get(digest, 0),
+                                        file_stat.st_mtime)
+        files.sort()
+        for _, _, digest in files:
+            last_used.pop(digest, None)
+        while files and total > self.size:
+            _, size, digest = files.pop(0)
+            if self._remove_key(digest, ('.bin', '.json')):
+                log.info('Evicted script file %s from the cache', digest)
+                total -= size
+        for digest, mtime in last_used.items():
+            if mtime < stale_before:
+                self._remove_key(digest, ('.json', ))
+
+    def _remove_key(self, digest, exts):
+        """Remove the files & lock of a key, unless it is locked
+
+        Returns True if the files were removed.
+
+        """
+        lock_path = os.path.join(self.path, digest + '.lock')
+        try:
+            lock_file = open(lock_path, 'a')
+        except OSError:
+            return False
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            for ext in exts:
+                self._remove(os.path.join(self.path, digest + ext))
+            # Removed while locked, so that `_lock` won't use it anymore.
+            self._remove(lock_path)
+            return True
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _key_path(self, key, ext):
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.path, digest + ext)
+
+    @contextlib.contextmanager
+    def _lock(self, key):
+        """Hold an exclusive lock on `key` across processes & threads"""
+        if not self.enabled:
+            yield
+            return
+        path = self._key_path(key, '.lock')
+        while True:
+            lock_file = open(path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Retry if the lock file was removed by `_remove_key` meanwhile.
+            try:
+                if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        with lock_file:
+            # Keep track of when keys were last used, to remove stale ones.
+            os.utime(lock_file.fileno())
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_meta(self, key):
+        if not self.enabled:
+            return None
+        try:
+            with open(self._key_path(key, '.json')) as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            return None
+        except ValueError as exc:
+            log.error('Invalid script cache metadata for %r: %r', key, exc)
+            return None
+
+    def _write_meta(self, key, meta):
+        with tempfile.NamedTemporaryFile('w', dir=self.path, suffix='.tmp',
+                                         delete=False) as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_file.name, self._key_path(key, '.json'))
+
+
+artifact_cache = ScriptArtifactCache(config.SCRIPTS_CACHE_DIR,
+                                     config.SCRIPTS_CACHE_SIZE,
+                                     config.SCRIPTS_CACHE_REF_TTL)
@@ -135,6 +135,7 @@ $(command -v sudo) /opt/mistio/telegraf/usr/bin/telegraf -test -config %s
         # Deploy the test configuration and the plugin.
         sftp.putfo(StringIO(exec_conf), test_conf)
         sftp.putfo(StringIO(self.script.location.source_code), test_plugin)
+        sftp.close()
 
         # Run the test code to verify the plugin is working.
         retval, test_out, test_err = shell.command(test_code, pty=False)
@@ -0,0 +1,83 @@
+"""In-process cache of the KV v2 secrets read from Vault
+
+Every `SecretValue.value` access used to read the whole secret from Vault,
+so resolving the credentials of a cloud or running a script could read the
+same secret several times. `SecretCache` keeps recently read secrets in a
+small LRU with a TTL, in memory only, along with their KV v2 version.
+
+Secrets written or deleted through the secrets controllers, as well as the
+secrets of an organization polled by `list_vault_secrets`, are dropped from
+the cache of all processes through a RabbitMQ fanout exchange. When a secret
+is written, its new version is broadcast too and any older version read
+concurrently is not cached anymore. If the broker is unreachable, stale
+entries expire after `VAULT_SECRET_CACHE_TTL`.
+
+"""
+
+import copy
+
+from mist.api.concurrency.process import InvalidatedCache
+
+from mist.api import config
+
+
+SECRET_CACHE_EXCHANGE = 'secret_cache_invalidation'
+
+
+class SecretCache(InvalidatedCache):
+
+    # Values are (version, data) tuples. Entries with no data only hold the
+    # min version to be cached. Keys are (vault url, mount point, name).
+    exchange = SECRET_CACHE_EXCHANGE
+
+    def get(self, key):
+        """Return a copy of the cached data of a secret, or None"""
+        with self.lock:
+            value = self._lookup(key)
+            if value is None or value[1] is None:
+                return None
+            return copy.deepcopy(value[1])
+
+    def set(self, key, version, data):
+        """Cache version `version` of a secret, unless a newer one is known"""
+        if not self.enabled:
+            return
+        self._ensure_listener()
+        with self.lock:
+            value = self._lookup(key)
+            if value is not None and (value[0] or 0) > (version or 0):
+                return
+            self._store(key, (version, copy.deepcopy(data)))
+
+    def invalidate(self, key=None, version=None, prefix=None,
+                   broadcast=True):
+        """Drop a secret, or all secrets under `prefix`, in all processes
+
+        If the `version` of a secret that was just written is given, older
+        versions of it are not cached for a while, in case they are being
+        read concurrently.
+
+        """
+        message = {'key': key, 'version': version, 'prefix': prefix}
+        self._on_invalidate(message)
+        if broadcast and self.enabled:
+            self.broadcast(message)
+
+    def _on_invalidate(self, message):
+        key, version = message.get('key'), message.get('version')
+        prefix = message.get('prefix')
+        with self.lock:
+            if key is not None:
+                key = tuple(key)
+                self.entries.pop(key, None)
+                if version:
+                    self._store(key, (version, None))
+            if prefix is not None:
+                prefix = tuple(prefix)
+                for cached_key in list(self.entries):
+                    if cached_key[:len(prefix)] == prefix:
+                        del self.entries[cached_key]
+
+
+secret_cache = SecretCache(config.VAULT_SECRET_CACHE_SIZE,
+                           config.VAULT_SECRET_CACHE_TTL)
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import os
 import time
 import logging
 from typing import TYPE_CHECKING, List, Dict, Any, Tuple
@@ -10,6 +11,7 @@ from mist.api import config
 from mist.api.exceptions import BadRequestError
 from mist.api.exceptions import ServiceUnavailableError
 from mist.api.secrets.models import Secret, VaultSecret
+from mist.api.secrets.cache import secret_cache
 
 if TYPE_CHECKING:
     from mist.api.users.models import Organization
@@ -31,6 +33,10 @@ class MistVaultError(Exception):
     ...
 
 
+# Authenticated Vault clients of this process, by (pid, address, token).
+_vault_clients = {}
+
+
 class VaultPortalClient:
     """The portal's Vault client. This client should only be used to mount
     secrets engines and create policies for Organization clients.
@@ -145,49 +151,100 @@ class BaseSecretController:
 class VaultSecretController(BaseSecretController):
     def __init__(self, org: Organization) -> None:
         super().__init__(org)
-        url = org.vault_address or config.VAULT_ADDR
-        token = None
-        if org.vault_token:
-            token = org.vault_token
-        elif (
-            not org.vault_address and
-            not org.vault_role_id and
+        self.url = org.vault_address or config.VAULT_ADDR
+        self.client = self.get_client()
+
+    def get_token(self) -> str:
+        if self.org.vault_token:
+            return self.org.vault_token
+        if (
+            not self.org.vault_address and
+            not self.org.vault_role_id and
             config.VAULT_TOKEN
         ):
-            token = config.VAULT_TOKEN
-        is_authenticated = False
+            return config.VAULT_TOKEN
+        return None
+
+    def get_client(self, refresh: bool = False) -> hvac.Client:
+        """
+        Return a Vault client authenticated for the organization.
+
+        Clients are shared by all controllers of the process that use the
+        same Vault address and token, without checking the token again. Pass
+        refresh=True to authenticate again, e.g. after Vault responded with
+        403 because the token expired.
+        """
+        token = self.get_token()
+        key = (os.getpid(), self.url, token)
+        client = _vault_clients.pop(key, None)
+        if token and client is not None and not refresh:
+            _vault_clients[key] = client
+            return client
+
+        client = self.authenticate(token)
+        _vault_clients[(os.getpid(), self.url, client.token)] = client
+        while len(_vault_clients) > config.VAULT_CLIENT_POOL_SIZE:
+            _vault_clients.pop(next(iter(_vault_clients)), None)
+        return client
+
+    def authenticate(self, token: str = None) -> hvac.Client:
+        org = self.org
         if token:
-            self.client = hvac.Client(url=url, token=token)
+            client = hvac.Client(url=self.url, token=token)
             try:
-                is_authenticated = self.client.is_authenticated()
+                if client.is_authenticated():
+                    return client
             except hvac.exceptions.VaultDown:
                 raise ServiceUnavailableError("Vault is sealed.")
 
-        if not token or not is_authenticated:
-            if org.vault_role_id and org.vault_secret_id:
-                self.client = hvac.Client(url=url)
-                try:
-                    result = self.client.auth.approle.login(
-                        role_id=org.vault_role_id,
-                        secret_id=org.vault_secret_id,
-                    )
-                except hvac.exceptions.InvalidRequest:
-                    raise BadRequestError(
-                        "Vault approle authentication failed."
-                    )
-                client_token = result.get("auth", {}).get("client_token")
-                if client_token:
-                    org.vault_token = client_token
-                    org.save()
-                    return
-            raise BadRequestError("Vault authentication failed.")
+        if org.vault_role_id and org.vault_secret_id:
+            client = hvac.Client(url=self.url)
+            try:
+                result = client.auth.approle.login(
+                    role_id=org.vault_role_id,
+                    secret_id=org.vault_secret_id,
+                )
+            except hvac.exceptions.InvalidRequest:
+                raise BadRequestError(
+                    "Vault approle authentication failed."
+                )
+            client_token = result.get("auth", {}).get("client_token")
+            if client_token:
+                org.vault_token = client_token
+                org.save()
+                return client
+        raise BadRequestError("Vault authentication failed.")
+
+    def request(self, method: str, **kwargs) -> Any:
+        """
+        Call a method of the Vault client, e.g. "secrets.kv.v2.patch".
+
+        If Vault responds with 403, the organization authenticates again and
+        the request is retried once.
+        """
+        for retry in (True, False):
+            func = self.client
+            for attr in method.split("."):
+                func = getattr(func, attr)
+            try:
+                return func(**kwargs)
+            except hvac.exceptions.Forbidden:
+                if not retry:
+                    raise
+                log.info("Got 403 from Vault for org %s, will authenticate "
+                         "again", self.org.id)
+                self.client = self.get_client(refresh=True)
+
+    def cache_key(self, name: str) -> Tuple[str, str, str]:
+        return (self.url, self.org.vault_secret_engine_path, name)
 
     def ensure_secrets_engine(self) -> None:
         """
         Make sure that a secrets engine exists for the organization.
         """
         try:
-            self.client.sys.enable_secrets_engine(
+            self.request(
+                "sys.enable_secrets_engine",
                 backend_type="kv",
                 path=self.org.vault_secret_engine_path,
                 options={
@@ -215,7 +272,8 @@ class KV1VaultSecretController(VaultSecretController):
         self.ensure_secrets_engine()
 
         try:
-            response = self.client.secrets.kv.v1.list_secrets(
+            response = self.request(
+                "secrets.kv.v1.list_secrets",
                 mount_point=self.org.vault_secret_engine_path, path=path
             )
             keys = response["data"]["keys"]
@@ -275,7 +333,8 @@ class KV1VaultSecretController(VaultSecretController):
             existing_secret = {}
 
         try:
-            self.client.secrets.kv.v1.create_or_update_secret(
+            self.request(
+                "secrets.kv.v1.create_or_update_secret",
                 mount_point=self.org.vault_secret_engine_path,
                 path=name,
                 secret={**existing_secret, **attributes},
@@ -295,7 +354,8 @@ class KV1VaultSecretController(VaultSecretController):
           name(str): The name/path of the secret to retrieve.
         """
         try:
-            api_response = self.client.secrets.kv.v1.read_secret(
+            api_response = self.request(
+                "secrets.kv.v1.read_secret",
                 mount_point=self.org.vault_secret_engine_path,
                 path=name,
             )
@@ -317,7 +377,8 @@ class KV1VaultSecretController(VaultSecretController):
           name(str): The name/path of the secret to delete.
         """
         try:
-            self.client.secrets.kv.v1.delete_secret(
+            self.request(
+                "secrets.kv.v1.delete_secret",
                 mount_point=self.org.vault_secret_engine_path,
                 path=name,
             )
@@ -346,7 +407,8 @@ class KV2VaultSecretController(VaultSecretController):
         self.ensure_secrets_engine()
 
         try:
-            response = self.client.secrets.kv.list_secrets(
+            response = self.request(
+                "secrets.kv.list_secrets",
                 mount_point=self.org.vault_secret_engine_path, path=path
             )
             keys = response["data"]["keys"]
@@ -387,6 +449,10 @@ class KV2VaultSecretController(VaultSecretController):
             VaultSecret.objects(
                 owner=self.org, id__nin=[s.id for s in secrets]
             ).delete()
+            # secrets may have been changed outside of mist
+            secret_cache.invalidate(
+                prefix=(self.url, self.org.vault_secret_engine_path)
+            )
         return list(set(secrets))
 
     def create_or_update_secret(
@@ -402,19 +468,21 @@ class KV2VaultSecretController(VaultSecretController):
         self.ensure_secrets_engine()
         for _ in range(5):
             try:
-                self.client.secrets.kv.v2.patch(
+                response = self.request(
+                    "secrets.kv.v2.patch",
                     mount_point=self.org.vault_secret_engine_path,
                     path=name,
                     secret=attributes,
                 )
             except (hvac.exceptions.InvalidPath, KeyError):
                 # no existing data in this path
-                self.client.secrets.kv.v2.create_or_update_secret(
+                response = self.request(
+                    "secrets.kv.v2.create_or_update_secret",
                     mount_point=self.org.vault_secret_engine_path,
                     path=name,
                     secret=attributes,
                 )
-
+                self.invalidate_secret(name, response)
                 return
             except hvac.exceptions.Forbidden:
                 raise BadRequestError(
@@ -433,8 +501,18 @@ class KV2VaultSecretController(VaultSecretController):
 
                 raise
             else:
+                self.invalidate_secret(name, response)
                 return
 
+    def invalidate_secret(self, name: str, response: Any = None) -> None:
+        """
+        Drop a secret from the cache of all processes after writing it.
+        """
+        version = None
+        if isinstance(response, dict):
+            version = response.get("data", {}).get("version")
+        secret_cache.invalidate(self.cache_key(name), version=version)
+
     def read_secret(self, name: str) -> Dict[str, Any]:
         """
         Retrieve the secret's contents at the specified path.
@@ -442,8 +520,13 @@ class KV2VaultSecretController(VaultSecretController):
         Parameters:
           name(str): The name/path of the secret to retrieve.
         """
+        key = self.cache_key(name)
+        data = secret_cache.get(key)
+        if data is not None:
+            return data
         try:
-            api_response = self.client.secrets.kv.v2.read_secret_version(
+            api_response = self.request(
+                "secrets.kv.v2.read_secret_version",
                 mount_point=self.org.vault_secret_engine_path,
                 path=name,
             )
@@ -455,7 +538,10 @@ class KV2VaultSecretController(VaultSecretController):
         except hvac.exceptions.InvalidPath:
             raise BadRequestError("Secret does not exist")
 
-        return api_response["data"]["data"]
+        data = api_response["data"]["data"]
+        version = api_response["data"].get("metadata", {}).get("version")
+        secret_cache.set(key, version, data)
+        return data
 
     def delete_secret(self, name: str) -> None:
         """
@@ -465,7 +551,8 @@ class KV2VaultSecretController(VaultSecretController):
           name(str): The name/path of the secret to delete.
         """
         try:
-            self.client.secrets.kv.v2.delete_metadata_and_all_versions(
+            self.request(
+                "secrets.kv.v2.delete_metadata_and_all_versions",
                 mount_point=self.org.vault_secret_engine_path,
                 path=name,
             )
@@ -474,6 +561,7 @@ class KV2VaultSecretController(VaultSecretController):
                 "Make sure your Vault token has the "
                 "permissions to delete secret"
             )
+        self.invalidate_secret(name)
 
         # list all secrets
         self.list_secrets(path=".", recursive=True)
@@ -0,0 +1,19 @@
+import hashlib
+
+
+def _weight(shard_id, key):
+    digest = hashlib.md5(('%s:%s' % (shard_id, key)).encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def assign_shard(key, shard_ids):
+    """Return the shard that `key` is assigned to by rendezvous hashing
+
+    Every key goes to the shard with the highest weight for it. When a shard
+    joins or leaves, only the keys that it wins or had won move, i.e. about
+    1/N of them, and all others keep their shard.
+
+    """
+    if not shard_ids:
+        return None
+    return max(shard_ids, key=lambda shard_id: _weight(shard_id, key))
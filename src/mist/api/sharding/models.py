@@ -0,0 +1,49 @@
+import datetime
+
+import mongoengine as me
+
+
+class ShardMember(me.Document):
+    """A live scheduler process that schedules may be assigned to
+
+    Every process of a sharded scheduler keeps renewing the `heartbeat_at`
+    of its member document. Members that haven't done so within the shard
+    period are considered gone and their schedules are reassigned.
+
+    """
+
+    group = me.StringField(required=True)
+    shard_id = me.StringField(required=True)
+    started_at = me.DateTimeField()
+    heartbeat_at = me.DateTimeField()
+
+    meta = {
+        'collection': 'shard_members',
+        'indexes': [
+            {
+                'fields': ['group', 'shard_id'],
+                'unique': True,
+            },
+        ],
+    }
+
+    @classmethod
+    def heartbeat(cls, group, shard_id):
+        now = datetime.datetime.utcnow()
+        cls.objects(group=group, shard_id=shard_id).update_one(
+            upsert=True, set__heartbeat_at=now, set_on_insert__started_at=now)
+
+    @classmethod
+    def live_members(cls, group, max_shard_period):
+        """Return the sorted shard ids of the live members of the group"""
+        since = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=max_shard_period)
+        return sorted(cls.objects(group=group, heartbeat_at__gte=since)
+                      .distinct('shard_id'))
+
+    @classmethod
+    def leave(cls, group, shard_id):
+        cls.objects(group=group, shard_id=shard_id).delete()
+
+    def __str__(self):
+        return 'ShardMember %s of %s' % (self.shard_id, self.group)
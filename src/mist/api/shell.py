@@ -4,18 +4,22 @@ This module contains everything that is need to communicate with machines via
 SSH.
 
 """
+import os
 import paramiko
 import websocket
 import socket
 import _thread
 import ssl
+import atexit
+import hashlib
 import tempfile
+import threading
 import logging
 import base64
 import json
 
-from time import sleep
-from io import StringIO
+from time import sleep, time
+from io import StringIO, BytesIO
 
 from mist.api.clouds.models import Cloud
 from mist.api.machines.models import Machine, KeyMachineAssociation
@@ -42,6 +46,167 @@ logging.basicConfig(level=config.PY_LOG_LEVEL,
 log = logging.getLogger(__name__)
 
 
+class SSHConnection(object):
+    """A pooled SSH connection, leased by one or more shells at a time"""
+
+    def __init__(self, key, client, pooled=True):
+        self.key = key
+        self.client = client
+        self.pooled = pooled
+        self.leases = 0
+        self.last_used = time()
+        self.pid = os.getpid()
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception as exc:
+            log.error("Error closing ssh connection to %s: %r",
+                      self.key[0], exc)
+
+
+class SSHConnectionPool(object):
+    """Reuse SSH connections across the shells of a process
+
+    Connections are keyed by (host, port, username, credentials fingerprint).
+    Each one is leased to up to `max_sessions` shells at a time, that open
+    their own channels on it, and at most `max_per_host` connections are kept
+    per host. Shells over these limits get a connection of their own, which
+    is closed when released.
+
+    Idle connections are closed after `idle_ttl` seconds. Keepalives are sent
+    every `keepalive` seconds, so that broken connections are noticed and
+    replaced.
+
+    """
+
+    def __init__(self, idle_ttl, keepalive, max_per_host, max_sessions):
+        self.idle_ttl = idle_ttl
+        self.keepalive = keepalive
+        self.max_per_host = max_per_host
+        self.max_sessions = max_sessions
+        self.connections = {}
+        self.handshakes = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    @property
+    def enabled(self):
+        return bool(self.idle_ttl and self.max_per_host)
+
+    def acquire(self, key, connect):
+        """Lease a connection for `key`
+
+        If no pooled connection is available, `connect` is called to return
+        a new connected `paramiko.SSHClient`.
+
+        """
+        stale = []
+        try:
+            with self.lock:
+                self._check_pid()
+                for conn in list(self.connections.get(key, [])):
+                    if not conn.is_active():
+                        stale.append(self._remove(conn))
+                    elif conn.leases < self.max_sessions:
+                        conn.leases += 1
+                        conn.last_used = time()
+                        return conn
+        finally:
+            for conn in stale:
+                conn.close()
+
+        client = connect()
+        with self.lock:
+            self.handshakes += 1
+            pooled = self.enabled and sum(
+                len(conns) for conn_key, conns in self.connections.items()
+                if conn_key[0] == key[0]) < self.max_per_host
+            conn = SSHConnection(key, client, pooled=pooled)
+            conn.leases = 1
+            if pooled:
+                client.get_transport().set_keepalive(self.keepalive)
+                self.connections.setdefault(key, []).append(conn)
+                self._ensure_reaper()
+        return conn
+
+    def release(self, conn):
+        """Give back a leased connection, closing it if not pooled"""
+        with self.lock:
+            conn.leases -= 1
+            conn.last_used = time()
+            if conn.pooled and conn.pid == os.getpid() and conn.is_active():
+                return
+            self._remove(conn)
+            if conn.leases > 0:
+                return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        self.reap(idle_ttl=0)
+
+    def reap(self, idle_ttl=None):
+        """Close connections idle for more than `idle_ttl` seconds"""
+        if idle_ttl is None:
+            idle_ttl = self.idle_ttl
+        stale = []
+        with self.lock:
+            self._check_pid()
+            for conns in list(self.connections.values()):
+                for conn in list(conns):
+                    if not conn.is_active() or (
+                            not conn.leases and
+                            time() - conn.last_used >= idle_ttl):
+                        stale.append(self._remove(conn))
+        for conn in stale:
+            conn.close()
+
+    def _remove(self, conn):
+        conns = self.connections.get(conn.key, [])
+        if conn in conns:
+            conns.remove(conn)
+        if not conns:
+            self.connections.pop(conn.key, None)
+        return conn
+
+    def _check_pid(self):
+        # Connections inherited from the parent process can't be used after
+        # forking, since their transport threads didn't survive.
+        if self.pid != os.getpid():
+            self.connections = {}
+            self.thread = None
+            self.pid = os.getpid()
+
+    def _ensure_reaper(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._reap_forever,
+                                       name='SSHConnectionReaper',
+                                       daemon=True)
+        self.thread.start()
+
+    def _reap_forever(self):
+        while True:
+            sleep(max(min(self.idle_ttl, self.keepalive or 30), 1))
+            try:
+                self.reap()
+            except Exception as exc:
+                log.error("Error closing idle ssh connections: %r", exc)
+
+
+ssh_pool = SSHConnectionPool(config.SSH_POOL_IDLE_TTL,
+                             config.SSH_POOL_KEEPALIVE,
+                             config.SSH_POOL_MAX_PER_HOST,
+                             config.SSH_POOL_MAX_SESSIONS)
+atexit.register(ssh_pool.close)
+
+
 class ParamikoShell(object):
     """sHell
 
@@ -77,9 +242,8 @@ class ParamikoShell(object):
             raise RequiredParameterMissingError('host not given')
         self.host = host
         self.sudo = False
-
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh = None
+        self.connection = None
 
         # if username provided, try to connect
         if username:
@@ -103,22 +267,36 @@ class ParamikoShell(object):
             raise RequiredParameterMissingError("neither key nor password "
                                                 "provided.")
 
-        if key:
-            private = key.private.value
-            if isinstance(key, SignedSSHKey) and cert_file:
+        private = key.private.value if key else None
+        credentials = hashlib.sha256(
+            ('%s\0%s\0%s' % (private, cert_file, password)).encode()
+        ).hexdigest()
+
+        def connect():
+            if key and isinstance(key, SignedSSHKey) and cert_file:
                 # signed ssh key, use RSACert
                 rsa_key = paramiko.RSACert(privkey_file_obj=StringIO(private),
                                            cert_file_obj=StringIO(cert_file))
-            else:
+            elif key:
                 rsa_key = paramiko.RSAKey.from_private_key(StringIO(private))
-        else:
-            rsa_key = None
+            else:
+                rsa_key = None
+            return self._connect(username, password, rsa_key, port)
 
+        self.disconnect()
+        self.connection = ssh_pool.acquire(
+            (self.host, port, username, credentials), connect)
+        self.ssh = self.connection.client
+
+    def _connect(self, username, password, rsa_key, port):
+        """Open a new SSH connection, retrying on network errors."""
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         attempts = 3
         while attempts:
             attempts -= 1
             try:
-                self.ssh.connect(
+                ssh.connect(
                     self.host,
                     port=port,
                     username=username,
@@ -128,7 +306,7 @@ class ParamikoShell(object):
                     look_for_keys=False,
                     timeout=10
                 )
-                break
+                return ssh
             except paramiko.AuthenticationException as exc:
                 log.error("ssh exception %r", exc)
                 raise MachineUnauthorizedError("Couldn't connect to "
@@ -147,10 +325,18 @@ class ParamikoShell(object):
                     raise ServiceUnavailableError(repr(exc))
 
     def disconnect(self):
-        """Close the SSH connection."""
+        """Release the SSH connection.
+
+        The connection is given back to the pool, to be reused by other
+        shells until it's idle for SSH_POOL_IDLE_TTL seconds.
+
+        """
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
         try:
-            log.info("Closing ssh connection to %s", self.host)
-            self.ssh.close()
+            log.info("Releasing ssh connection to %s", self.host)
+            ssh_pool.release(connection)
         except:
             pass
 
@@ -181,7 +367,7 @@ class ParamikoShell(object):
         channel.exec_command(cmd)
         return stdout, stderr, channel
 
-    def command(self, cmd, pty=True):
+    def command(self, cmd, pty=True, callback=None):
         """Run command and return output.
 
         If pty is True, then it returns a string object that contains the
@@ -190,28 +376,35 @@ class ParamikoShell(object):
         If pty is False, then it returns a two string tuple, consisting of
         stdout and stderr.
 
+        If callback is given, it's called with every chunk of stdout received,
+        as bytes, while the command is running.
+
         """
         log.info("running command: '%s'", cmd)
         stdout, stderr, channel = self._command(cmd, pty)
-        line = stdout.readline()
-        out = ''
-        while line:
-            out += line
-            line = stdout.readline()
+        out = self._read(channel.recv, callback)
 
         if pty:
             retval = channel.recv_exit_status()
             return retval, out
         else:
-            line = stderr.readline()
-            err = ''
-            while line:
-                err += line
-                line = stderr.readline()
+            err = self._read(channel.recv_stderr)
             retval = channel.recv_exit_status()
 
             return retval, out, err
 
+    @staticmethod
+    def _read(recv, callback=None, size=32768):
+        """Read a channel stream until EOF and return it decoded."""
+        buf = BytesIO()
+        data = recv(size)
+        while data:
+            buf.write(data)
+            if callback:
+                callback(data)
+            data = recv(size)
+        return buf.getvalue().decode('utf-8', 'replace')
+
     def command_stream(self, cmd):
         """Run command and stream output line by line.
 
@@ -890,7 +1083,6 @@ class Shell(object):
         self._shell = None
         self.host = host
         self.channel = None
-        self.ssh = None
         if provider == 'docker' and not enforce_paramiko:
             self._shell = DockerShell(host)
         elif provider == 'kubevirt' and not enforce_paramiko:
@@ -901,7 +1093,12 @@ class Shell(object):
             self._shell = ParamikoShell(host, username=username, key=key,
                                         password=password, cert_file=cert_file,
                                         port=port)
-            self.ssh = self._shell.ssh
+
+    @property
+    def ssh(self):
+        """The connected paramiko.SSHClient, if this is a ParamikoShell"""
+        if isinstance(self._shell, ParamikoShell):
+            return self._shell.ssh
 
     def get_type(self):
         if isinstance(self._shell, ParamikoShell):
@@ -966,9 +1163,9 @@ class Shell(object):
     def disconnect(self):
         self._shell.disconnect()
 
-    def command(self, cmd, pty=True):
+    def command(self, cmd, pty=True, callback=None):
         if isinstance(self._shell, ParamikoShell):
-            return self._shell.command(cmd, pty=pty)
+            return self._shell.command(cmd, pty=pty, callback=callback)
         elif isinstance(self._shell, DockerShell) or\
                 isinstance(self._shell, LXDShell):
             return self._shell.command(cmd)
@@ -17,6 +17,7 @@ import datetime
 import traceback
 
 import tornado.gen
+import tornado.ioloop
 import tornado.httpclient
 
 from sockjs.tornado import SockJSConnection, SockJSRouter
@@ -31,13 +32,14 @@ from mist.api.machines.models import Machine
 
 from mist.api.auth.methods import auth_context_from_session_id
 
-from mist.api.helpers import filter_resource_ids
-
 from mist.api.exceptions import UnauthorizedError, MistError
 from mist.api.exceptions import PolicyUnauthorizedError
 from mist.api.amqp_tornado import Consumer
+from mist.api.sockjs_hub import OwnerHub, PatchBuffer
 
 from mist.api.clouds.methods import filter_list_clouds
+from mist.api.clouds.snapshot import RESOURCE_TYPES
+from mist.api.clouds.snapshot import build_snapshot_section
 
 from mist.api import tasks
 from mist.api.hub.tornado_shell_client import ShellHubClient
@@ -225,32 +227,6 @@ class ShellConnection(MistConnection):
         super(ShellConnection, self).on_close(stale=stale)
 
 
-class OwnerUpdatesConsumer(Consumer):
-    def __init__(self, main_sockjs_conn,
-                 amqp_url=config.BROKER_URL):
-        self.sockjs_conn = main_sockjs_conn
-        super(OwnerUpdatesConsumer, self).__init__(
-            amqp_url=amqp_url,
-            exchange='owner_%s' % self.sockjs_conn.owner.id,
-            queue='mist-socket-%d' % random.randrange(2 ** 20),
-            exchange_type='fanout',
-            exchange_kwargs={'auto_delete': True},
-            queue_kwargs={'auto_delete': True, 'exclusive': True},
-        )
-
-    def on_message(self, unused_channel, basic_deliver, properties, body):
-        super(OwnerUpdatesConsumer, self).on_message(
-            unused_channel, basic_deliver, properties, body
-        )
-        self.sockjs_conn.process_update(
-            unused_channel, basic_deliver, properties, body
-        )
-
-    def start_consuming(self):
-        super(OwnerUpdatesConsumer, self).start_consuming()
-        self.sockjs_conn.start()
-
-
 class LogsConsumer(Consumer):
 
     def __init__(self, owner_id, callback, amqp_url=config.BROKER_URL):
@@ -278,8 +254,8 @@ class MainConnection(MistConnection):
         log.info("************** Open!")
         super(MainConnection, self).on_open(conn_info)
         self.running_machines = set()
-        self.consumer = None
-        self.batch = []
+        self.hub = None
+        self.batch = PatchBuffer()
         self.log_kwargs = {
             'ip': self.ip,
             'user_agent': self.user_agent,
@@ -295,9 +271,8 @@ class MainConnection(MistConnection):
 
     def on_ready(self):
         log.info("************** Ready to go! %s", self.auth_context.owner.id)
-        if self.consumer is None:
-            self.consumer = OwnerUpdatesConsumer(self)
-            self.consumer.run()
+        if self.hub is None:
+            self.hub = OwnerHub.subscribe(self)
         else:
             log.error("It seems we have received 'on_ready' more than once.")
 
@@ -314,18 +289,20 @@ class MainConnection(MistConnection):
         self.update_notifications()
         self.check_monitoring()
         self.periodic_update_poller()
-        self.send_batch_update()
 
-    @tornado.gen.coroutine
+    def permissions_key(self):
+        """Connections with equal keys may share filtered patches"""
+        if self.auth_context.is_owner():
+            return ('owner', self.auth_context.org.id)
+        return (self.auth_context.user.id, self.auth_context.org.id)
+
     def send_batch_update(self):
-        """Send model patches in batches."""
-        while True:
-            if self.closed:
-                break
-            if self.batch:
-                self.send('patch_model', self.batch)
-                self.batch = []
-            yield tornado.gen.sleep(5)
+        """Send the buffered model patches, return the number of ops"""
+        if self.closed or not self.batch:
+            return 0
+        patch = self.batch.pop_all()
+        self.send('patch_model', patch)
+        return len(patch)
 
     @tornado.gen.coroutine
     def periodic_update_poller(self):
@@ -396,115 +373,41 @@ class MainConnection(MistConnection):
         )
 
     def list_images(self):
-        clouds = filter_list_clouds(self.auth_context, as_dict=False)
-        for cloud in clouds:
-            if not cloud.enabled:
-                continue
-            if cloud.ctl.ComputeController:
-                self.internal_request(
-                    'api/v1/clouds/%s/images' % cloud.id,
-                    params={'cached': True},
-                    callback=lambda images, cloud_id=cloud.id: self.send(
-                        'list_images',
-                        {'cloud_id': cloud_id, 'images': images}
-                    ),
-                )
+        clouds = [cloud for cloud in filter_list_clouds(self.auth_context,
+                                                        as_dict=False)
+                  if cloud.enabled]
+        self.send_snapshot(clouds, ('images', ), extra=True)
 
     def list_clouds(self):
         self.update_poller()
         clouds = filter_list_clouds(self.auth_context, as_dict=False)
         self.send('list_clouds', [c.as_dict() for c in clouds])
-        for cloud in clouds:
-            if not cloud.enabled:
+        self.send_snapshot([cloud for cloud in clouds if cloud.enabled],
+                           RESOURCE_TYPES)
+
+    @tornado.gen.coroutine
+    def send_snapshot(self, clouds, resource_types, extra=False):
+        """Send the cached resources of the clouds, one type at a time
+
+        Each type is read from the db by a thread of the executor, so that
+        the IOLoop is never blocked while the snapshot is being built.
+
+        """
+        loop = tornado.ioloop.IOLoop.current()
+        for rtype in resource_types:
+            try:
+                section = yield loop.run_in_executor(
+                    None, build_snapshot_section, self.auth_context, clouds,
+                    rtype, extra)
+            except Exception as exc:
+                log.error("Error listing %s of %s: %r", rtype, self.owner.id,
+                          exc)
                 continue
-            if cloud.ctl.ComputeController:
-                self.internal_request(
-                    'api/v1/clouds/%s/machines' % cloud.id,
-                    params={'cached': True},
-                    callback=lambda machines, cloud_id=cloud.id: self.send(
-                        'list_machines',
-                        {'cloud_id': cloud_id, 'machines': machines}
-                    ),
-                )
-                self.internal_request(
-                    'api/v1/clouds/%s/clusters' % cloud.id,
-                    params={'cached': True},
-                    callback=lambda clusters, cloud_id=cloud.id: self.send(
-                        'list_clusters',
-                        {'cloud_id': cloud_id, 'clusters': clusters}
-                    ),
-                )
-                self.internal_request(
-                    'api/v1/clouds/%s/locations' % cloud.id,
-                    params={
-                        'cached': True,
-                        'extra': False,
-                    },
-                    callback=lambda locations, cloud_id=cloud.id: self.send(
-                        'list_locations',
-                        {'cloud_id': cloud_id, 'locations': locations}
-                    ),
-                )
-                self.internal_request(
-                    'api/v1/clouds/%s/sizes' % cloud.id,
-                    params={
-                        'cached': True,
-                        'extra': False,
-                    },
-                    callback=lambda sizes, cloud_id=cloud.id: self.send(
-                        'list_sizes',
-                        {'cloud_id': cloud_id, 'sizes': sizes}
-                    ),
-                )
-                self.internal_request(
-                    'api/v1/clouds/%s/images' % cloud.id,
-                    params={
-                        'cached': True,
-                        'extra': False,
-                    },
-                    callback=lambda images, cloud_id=cloud.id: self.send(
-                        'list_images',
-                        {'cloud_id': cloud_id, 'images': images}
-                    ),
-                )
-            if cloud.ctl.NetworkController:
-                self.internal_request(
-                    'api/v1/clouds/%s/networks' % cloud.id,
-                    params={'cached': True},
-                    callback=lambda networks, cloud_id=cloud.id: self.send(
-                        'list_networks',
-                        {'cloud_id': cloud_id, 'networks': networks}
-                    ),
-                )
-            if cloud.ctl.DnsController:
-                self.internal_request(
-                    'api/v1/clouds/%s/zones' % cloud.id,
-                    params={'cached': True},
-                    callback=lambda zones, cloud_id=cloud.id: self.send(
-                        'list_zones',
-                        {'cloud_id': cloud_id, 'zones': zones}
-                    ),
-                )
-            if cloud.ctl.StorageController:
-                self.internal_request(
-                    'api/v1/clouds/%s/volumes' % cloud.id,
-                    params={'cached': True},
-                    callback=lambda volumes, cloud_id=cloud.id: self.send(
-                        'list_volumes',
-                        {'cloud_id': cloud_id, 'volumes': volumes}
-                    ),
-                )
-            if cloud.ctl.ObjectStorageController:
-                self.internal_request(
-                    'api/v1/clouds/%s/buckets' % cloud.id,
-                    params={'cached': True},
-                    callback=lambda buckets, cloud_id=cloud.id:
-                        self.send(
-                            'list_buckets', {
-                                'cloud_id': cloud_id,
-                                'buckets': buckets
-                            }),
-                )
+            if self.closed:
+                return
+            for cloud_id, items in section.items():
+                self.send('list_%s' % rtype, {'cloud_id': cloud_id,
+                                              rtype: items})
 
     def update_notifications(self):
         notifications = [ntf.as_dict() for ntf in InAppNotification.objects(
@@ -560,13 +463,8 @@ class MainConnection(MistConnection):
         except Exception as exc:
             log.error("Exception in get_stats: %r", exc)
 
-    def process_update(self, ch, method, properties, body):
-        routing_key = method.routing_key
-        try:
-            result = json.loads(body)
-        except:
-            result = body
-        log.info("Got %s", routing_key)
+    def process_update(self, routing_key, result):
+        """Handle an owner update, other than a patch, from the OwnerHub"""
         # TODO: list_locations, list_sizes and list_images can be removed...?
         if routing_key in set(['notify', 'probe', 'list_sizes', 'list_images',
                                'list_locations', 'list_projects', 'ping']):
@@ -606,49 +504,6 @@ class MainConnection(MistConnection):
             if result.get('user') == self.user.id:
                 self.send('patch_notifications', result)
 
-        elif routing_key in ['patch_machines', 'patch_networks',
-                             'patch_volumes', 'patch_zones',
-                             'patch_buckets', 'patch_clusters']:
-            cloud_id = result['cloud_id']
-            patch = result['patch']
-            rtype = routing_key.replace('patch_', '')
-            resource_ids = []
-            for line in patch:
-                if '-' in line['path']:
-                    resource_id, line['path'] = line['path'][1:].split('-', 1)
-                else:
-                    line['path'] = line['path'][1:]
-                    resource_id = line['path'].split('/', 1)[0]
-                resource_ids.append(resource_id)
-            if not self.auth_context.is_owner():
-                allowed_resource_ids = filter_resource_ids(self.auth_context,
-                                                           cloud_id, rtype,
-                                                           resource_ids)
-            else:
-                allowed_resource_ids = resource_ids
-            patch = [line for line, r_id in zip(patch, resource_ids)
-                     if r_id in allowed_resource_ids]
-            for line in patch:
-                line['path'] = '/clouds/%s/%s/%s' % (cloud_id, rtype,
-                                                     line['path'])
-            if patch:
-                self.batch.extend(patch)
-        # TODO: transfer patch_locations to above `elif`,
-        # locations need filtering
-        elif routing_key in ['patch_locations', 'patch_sizes', 'patch_images']:
-            cloud_id = result['cloud_id']
-            patch = result['patch']
-            for line in patch:
-                _id = line['path'][1:]
-                if routing_key == 'patch_locations':
-                    line['path'] = '/clouds/%s/locations/%s' % (cloud_id, _id)
-                elif routing_key == 'patch_sizes':
-                    line['path'] = '/clouds/%s/sizes/%s' % (cloud_id, _id)
-                elif routing_key == 'patch_images':
-                    line['path'] = '/clouds/%s/images/%s' % (cloud_id, _id)
-            if patch:
-                self.batch.extend(patch)
-
     def on_close(self, stale=False):
         if not self.closed:
             kwargs = {}
@@ -657,11 +512,8 @@ class MainConnection(MistConnection):
             if self.log_kwargs:
                 kwargs.update(self.log_kwargs)
             log_event(action='disconnect', **kwargs)
-        if self.consumer is not None:
-            try:
-                self.consumer.stop()
-            except Exception as exc:
-                log.error("Error closing pika consumer: %r", exc)
+        if self.hub is not None:
+            self.hub.unsubscribe(self)
         super(MainConnection, self).on_close(stale=stale)
 
 
@@ -777,10 +629,9 @@ class LogsConnection(MistConnection):
             return filter_log_event(self.auth_context, event)
         return event
 
-    @tornado.gen.coroutine
     def on_close(self, stale=False):
         """Stop the Consumer and close the WebSocket."""
-        yield self.es_client.close()
+        # The Elasticsearch client is shared by the process, don't close it.
         if self.consumer is not None:
             try:
                 self.consumer.stop()
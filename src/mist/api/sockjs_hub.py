@@ -0,0 +1,266 @@
+"""Per-process hub of the owner updates of sockjs connections
+
+Every `MainConnection` used to consume the updates of its owner through its
+own AMQP queue and decode, filter and rebuild each patch by itself. An
+`OwnerHub` holds a single AMQP subscription per owner in each sockjs process
+instead. Every message is decoded once, resource patches are filtered once
+for all connections with the same effective permissions, and the patches of
+each connection are merged in a `PatchBuffer` until they are flushed.
+
+"""
+
+import json
+import random
+import logging
+
+import tornado.ioloop
+
+from mist.api.amqp_tornado import Consumer
+from mist.api.helpers import filter_resource_ids
+
+from mist.api import config
+
+
+log = logging.getLogger(__name__)
+
+
+# Patches of resources that need to be filtered by RBAC.
+FILTERED_PATCHES = ('patch_machines', 'patch_networks', 'patch_volumes',
+                    'patch_zones', 'patch_buckets', 'patch_clusters')
+
+# TODO: transfer patch_locations to FILTERED_PATCHES, locations need filtering
+UNFILTERED_PATCHES = ('patch_locations', 'patch_sizes', 'patch_images')
+
+
+def _is_related(path, other):
+    """Whether either path points inside, or at, the other one"""
+    return path == other or other.startswith(path + '/') or \
+        path.startswith(other + '/')
+
+
+def _merge_ops(old, new):
+    """Return a single op equivalent to `old` followed by `new`, or None
+
+    Only ops on object members are merged, since ops on array items also
+    shift the items after them.
+
+    """
+    last = new['path'].rsplit('/', 1)[-1]
+    if last == '-' or last.isdigit():
+        return None
+    # An added member may have been missing before, so removing it after
+    # the merge could fail.
+    if new['op'] == 'remove' and old['op'] == 'replace':
+        return new
+    if new['op'] in ('add', 'replace') and \
+            old['op'] in ('add', 'replace', 'remove'):
+        op = 'replace' if old['op'] == 'replace' and \
+            new['op'] == 'replace' else 'add'
+        return {'op': op, 'path': new['path'], 'value': new.get('value')}
+    return None
+
+
+class PatchBuffer(object):
+    """JSON patch ops waiting to be sent to a connection
+
+    Consecutive ops on the same path are merged into one, as long as no op
+    on a related path, or moving or copying from one, was added in between.
+
+    """
+
+    def __init__(self):
+        self.ops = []
+        self.last_index = {}  # path -> index of its last op in `self.ops`
+        self.merged_count = 0
+
+    def extend(self, ops):
+        for op in ops:
+            self.append(op)
+
+    def append(self, op):
+        path = op.get('path')
+        index = self.last_index.get(path)
+        # Move and copy ops also read from the path in `from`.
+        if index is not None and not any(
+                _is_related(path, later[key])
+                for later in self.ops[index + 1:]
+                for key in ('path', 'from') if key in later):
+            merged = _merge_ops(self.ops[index], op)
+            if merged is not None:
+                self.ops[index] = merged
+                self.merged_count += 1
+                return
+        self.last_index[path] = len(self.ops)
+        self.ops.append(op)
+
+    def pop_all(self):
+        ops, self.ops, self.last_index = self.ops, [], {}
+        return ops
+
+    def __bool__(self):
+        return bool(self.ops)
+
+    def __len__(self):
+        return len(self.ops)
+
+
+class OwnerHubConsumer(Consumer):
+    def __init__(self, hub, amqp_url=config.BROKER_URL):
+        self.hub = hub
+        super(OwnerHubConsumer, self).__init__(
+            amqp_url=amqp_url,
+            exchange='owner_%s' % hub.owner_id,
+            queue='mist-socket-%d' % random.randrange(2 ** 20),
+            exchange_type='fanout',
+            exchange_kwargs={'auto_delete': True},
+            queue_kwargs={'auto_delete': True, 'exclusive': True},
+        )
+
+    def on_message(self, unused_channel, basic_deliver, properties, body):
+        super(OwnerHubConsumer, self).on_message(
+            unused_channel, basic_deliver, properties, body
+        )
+        self.hub.process_update(basic_deliver.routing_key, body)
+
+    def start_consuming(self):
+        super(OwnerHubConsumer, self).start_consuming()
+        self.hub.on_consuming()
+
+
+class OwnerHub(object):
+    """Share the owner updates among the connections of this process"""
+
+    hubs = {}  # owner id -> OwnerHub
+
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+        self.connections = set()
+        self.consumer = None
+        self.consuming = False
+        self.flush_handle = None
+        self.received_count = 0
+        self.sent_count = 0
+
+    @classmethod
+    def subscribe(cls, conn):
+        """Start delivering the updates of the owner of `conn` to it
+
+        The connection's `start` method is called as soon as the hub is
+        consuming, so that no update is lost after it has been started.
+
+        """
+        hub = cls.hubs.get(conn.owner.id)
+        if hub is None:
+            hub = cls.hubs[conn.owner.id] = cls(conn.owner.id)
+        hub.connections.add(conn)
+        if hub.consumer is None:
+            hub.consumer = OwnerHubConsumer(hub)
+            hub.consumer.run()
+        elif hub.consuming:
+            conn.start()
+        return hub
+
+    def unsubscribe(self, conn):
+        self.connections.discard(conn)
+        if self.connections:
+            return
+        if self.hubs.get(self.owner_id) is self:
+            del self.hubs[self.owner_id]
+        if self.flush_handle is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.flush_handle)
+            self.flush_handle = None
+        if self.consumer is not None:
+            try:
+                self.consumer.stop()
+            except Exception as exc:
+                log.error("Error closing pika consumer: %r", exc)
+            self.consumer = None
+
+    def on_consuming(self):
+        # Also called after reconnecting, when updates may have been lost.
+        self.consuming = True
+        for conn in list(self.connections):
+            conn.start()
+
+    def process_update(self, routing_key, body):
+        try:
+            result = json.loads(body)
+        except Exception:
+            result = body
+        log.info("Got %s for %d connections of %s", routing_key,
+                 len(self.connections), self.owner_id)
+        self.received_count += 1
+        if routing_key in FILTERED_PATCHES:
+            self.add_filtered_patch(routing_key, result)
+        elif routing_key in UNFILTERED_PATCHES:
+            self.add_unfiltered_patch(routing_key, result)
+        else:
+            for conn in list(self.connections):
+                try:
+                    conn.process_update(routing_key, result)
+                except Exception as exc:
+                    log.error("Error processing %s for %s: %r",
+                              routing_key, conn, exc)
+
+    def add_filtered_patch(self, routing_key, result):
+        cloud_id = result['cloud_id']
+        rtype = routing_key.replace('patch_', '')
+        lines = []
+        for line in result['patch']:
+            if '-' in line['path']:
+                resource_id, path = line['path'][1:].split('-', 1)
+            else:
+                path = line['path'][1:]
+                resource_id = path.split('/', 1)[0]
+            lines.append((resource_id, path, line))
+        resource_ids = [resource_id for resource_id, _, _ in lines]
+
+        groups = {}
+        for conn in self.connections:
+            groups.setdefault(conn.permissions_key(), []).append(conn)
+        for conns in groups.values():
+            auth_context = conns[0].auth_context
+            if auth_context.is_owner():
+                allowed_resource_ids = set(resource_ids)
+            else:
+                allowed_resource_ids = filter_resource_ids(
+                    auth_context, cloud_id, rtype, resource_ids)
+            prefix = '/clouds/%s/%s/' % (cloud_id, rtype)
+            patch = [dict(line, path=prefix + path)
+                     for resource_id, path, line in lines
+                     if resource_id in allowed_resource_ids]
+            if patch:
+                for conn in conns:
+                    conn.batch.extend(patch)
+                self.schedule_flush()
+
+    def add_unfiltered_patch(self, routing_key, result):
+        cloud_id = result['cloud_id']
+        rtype = routing_key.replace('patch_', '')
+        prefix = '/clouds/%s/%s/' % (cloud_id, rtype)
+        patch = [dict(line, path=prefix + line['path'][1:])
+                 for line in result['patch']]
+        if patch:
+            for conn in self.connections:
+                conn.batch.extend(patch)
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        """Flush in a while, so that more patches may be merged"""
+        if self.flush_handle is None:
+            self.flush_handle = tornado.ioloop.IOLoop.current().call_later(
+                config.SOCKJS_PATCH_FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        for conn in list(self.connections):
+            self.sent_count += conn.send_batch_update()
+
+    def metrics(self):
+        return {
+            'connections': len(self.connections),
+            'permission_groups': len({conn.permissions_key()
+                                      for conn in self.connections}),
+            'received': self.received_count,
+            'sent_ops': self.sent_count,
+        }
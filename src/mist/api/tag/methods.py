@@ -3,11 +3,11 @@ import re
 from mist.api.exceptions import NotFoundError, PolicyUnauthorizedError
 
 from mongoengine import Q
-import mongoengine as me
+from pymongo import UpdateMany
 from mist.api.tag.models import Tag
+from mist.api.tag.tasks import sync_resource_tags
 from mist.api.helpers import trigger_session_update
 from mist.api.helpers import get_object_with_id, search_parser
-from functools import reduce
 from mist.api.config import TAGS_RESOURCE_TYPES
 from mist.api import config
 from mist.api.helpers import get_resource_model
@@ -54,8 +54,8 @@ def get_tags(auth_context, types=[], search='', sort='key',
         deref(str): Name or id. Display either the id or the name of the tagged
                     resources (default id).
     Returns:
-        tuple(A mongoengine QuerySet containing the objects found,
-             the total number of items found)
+        tuple(A list of the unique tags in the requested page,
+              a dict with the total number of unique tags found)
     """
 
     query = Q(owner=auth_context.owner)
@@ -107,67 +107,117 @@ def get_tags(auth_context, types=[], search='', sort='key',
         sort = 'key'
         reverse = False
 
-    tags = Tag.objects(query)
-
-    tags_unique = [{'key': k, 'value': v} for k, v in
-                   set((t.key, t.value) for t in tags)]
-    data = []
-
-    for tag_unique in tags_unique:
-
-        item = {'tag': {tag_unique['key']: tag_unique['value']}}
-        item['resource_count'] = tags.filter(**tag_unique).count()
-        if types:
-
-            for resource_type in types:
-                resource_type = resource_type.rstrip('s')
-                resource_atrrs = []
-                if deref == 'name' and resource_type == 'zone':
-                    attr = 'domain'
-                else:
-                    attr = deref
-
-                for tag in tags.filter(**tag_unique,
-                                       resource_type=resource_type):
-
-                    if deref == 'id':
-                        resource_atrrs.append(tag.resource_id)
-                    else:
-                        resource = tag.resource
-                        if resource:
-                            resource_atrrs.append(getattr(resource, attr))
-
-                if resource_atrrs:
-                    item[resource_type + 's'] = resource_atrrs
-        data.append(item)
-
-    if sort == "resource_count" and types:
-        data.sort(key=lambda x: x['resource_count'],
-                  reverse=reverse)
-    elif sort == 'key':
-        data.sort(key=lambda x: list(x['tag'])[0],
-                  reverse=reverse)
-
     try:
-        start = int(start)
-        limit = int(limit)
+        start = max(int(start), 0)
+        limit = max(int(limit), 1)
     except (ValueError, TypeError):
         start = 0
         limit = 100
 
+    # Group the matching tags by key and value in a single aggregation and
+    # let the db sort and paginate the groups.
+    direction = -1 if reverse else 1
+    if sort == 'resource_count' and types:
+        sort_stage = {'resource_count': direction,
+                      '_id.key': 1, '_id.value': 1}
+    else:
+        sort_stage = {'_id.key': direction, '_id.value': direction}
+    pipeline = [{'$match': Tag.objects(query)._query}]
+    if types:
+        pipeline += [
+            {'$group': {
+                '_id': {'key': '$key', 'value': '$value',
+                        'resource_type': '$resource_type'},
+                'count': {'$sum': 1},
+                'resource_ids': {'$addToSet': '$resource_id'},
+            }},
+            {'$group': {
+                '_id': {'key': '$_id.key', 'value': '$_id.value'},
+                'resource_count': {'$sum': '$count'},
+                'resources': {'$push': {
+                    'resource_type': '$_id.resource_type',
+                    'resource_ids': '$resource_ids',
+                }},
+            }},
+        ]
+    else:
+        pipeline.append({'$group': {
+            '_id': {'key': '$key', 'value': '$value'},
+            'resource_count': {'$sum': 1},
+        }})
+    pipeline += [
+        {'$sort': sort_stage},
+        {'$facet': {
+            'total': [{'$count': 'count'}],
+            'page': [{'$skip': start}, {'$limit': limit}],
+        }},
+    ]
+    result = next(Tag._get_collection().aggregate(pipeline,
+                                                  allowDiskUse=True))
+    total = result['total'][0]['count'] if result['total'] else 0
+
+    data = []
+    for group in result['page']:
+        item = {'tag': {group['_id']['key']: group['_id'].get('value')},
+                'resource_count': group['resource_count']}
+        for resources in group.get('resources', []):
+            if resources['resource_ids']:
+                item[resources['resource_type'] + 's'] = \
+                    resources['resource_ids']
+        data.append(item)
+
+    if types and deref and deref != 'id':
+        _deref_tagged_resources(data, types, deref)
+
     if only and data:
         only_list = [field for field in data[0]
                      if field in only.split(',')]
         data = [{k: v for k, v in d.items() if k in only_list} for d in data]
 
     meta = {
-        'total': len(data),
-        'returned': len(data[start:start + limit]),
+        'total': total,
+        'returned': len(data),
         'sort': sort,
         'start': start
     }
 
-    return data[start:start + limit], meta
+    return data, meta
+
+
+def _deref_tagged_resources(data, types, deref):
+    """Replace the resource ids in the items of `get_tags` with `deref`
+
+    The resources of each type are loaded with a single `$in` query.
+    Resources that no longer exist are dropped.
+
+    """
+    for resource_type in types:
+        resource_type = resource_type.rstrip('s')
+        field = resource_type + 's'
+        resource_ids = {rid for item in data for rid in item.get(field, [])}
+        if not resource_ids:
+            continue
+        if deref == 'name' and resource_type == 'zone':
+            attr = 'domain'
+        else:
+            attr = deref
+        try:
+            model = get_resource_model(resource_type)
+        except KeyError:
+            continue
+        resources = model.objects(id__in=list(resource_ids))
+        if attr in model._fields:
+            resources = resources.only('id', attr)
+        attrs = {resource.id: getattr(resource, attr)
+                 for resource in resources}
+        for item in data:
+            if field not in item:
+                continue
+            values = [attrs[rid] for rid in item[field] if rid in attrs]
+            if values:
+                item[field] = values
+            else:
+                del item[field]
 
 
 def get_tags_for_resource(owner, resource_obj, *args, **kwargs):
@@ -195,43 +245,25 @@ def add_tags_to_resource(owner, resources, tags, *args, **kwargs):
     :param resources: the resource objects where the tags will be added
     :param tags: list of tags to be added
     """
-
-    tag_objects = []
-    missing_resources = get_missing_resources()
-    rtypes_to_update = set()
-    for resource in resources:
-        resource_type = resource.get('resource_type').rstrip('s')
-        resource_id = resource.get('resource_id')
-
-        if resource_id in missing_resources[resource_type]:
-            raise NotFoundError(msg=f'{resource_type} {resource_id}')
-        try:
-            resource_obj = get_resource_model(
-                resource_type).objects(id=resource_id).get()
-        except me.DoesNotExist:
-            raise NotFoundError(msg=f'{resource_type} {resource_id}')
-
-        existing_tags = get_tags_for_resource(owner, resource_obj)
-
-        tag_dict = {
-            k: v for k, v
-            in dict(tags).items() - existing_tags.items()
-        }
-        if tag_dict:
-            # Remove existing tags with common keys with the tags to be added,
-            # in order to update them.
-            remove_tags_from_resource(owner, [resource], tag_dict)
-
-            rtypes_to_update.add(resource_type + 's')
-            tag_objects.extend([Tag(owner=owner, resource_id=resource_id,
-                                    resource_type=resource_type, key=key,
-                                    value=value)
-                                for key, value in tag_dict.items()])
-
-            # SEC
-            owner.mapper.update(resource_obj)
-    Tag.objects.insert(tag_objects)
-    trigger_session_update(owner, list(rtypes_to_update))
+    tag_dict = dict(tags)
+    if not tag_dict:
+        return
+    resource_objs = _get_taggable_resources(resources)
+
+    # Upsert the tags of all resources by key, so that existing tags with
+    # common keys are updated in place.
+    requests = []
+    for resource_type, objs in resource_objs.items():
+        for resource_obj in objs:
+            for key, value in tag_dict.items():
+                query = Tag.objects(owner=owner, resource_type=resource_type,
+                                    resource_id=resource_obj.id,
+                                    key=key)._query
+                requests.append(UpdateMany(query, {'$set': {'value': value}},
+                                           upsert=True))
+    Tag._get_collection().bulk_write(requests, ordered=False)
+
+    _update_tagged_resources(owner, resource_objs)
 
 
 def remove_tags_from_resource(owner, resources, tags, *args, **kwargs):
@@ -244,36 +276,78 @@ def remove_tags_from_resource(owner, resources, tags, *args, **kwargs):
     :param rtype: resource type
     :param tags: list of tags to be deleted
     """
-    # ensure there are no duplicate tag keys because mongoengine will
-    # raise exception for duplicates in query
     key_list = list(dict(tags))
-    # create a query that will return all the tags with the specified keys
-    query = reduce(lambda q1, q2: q1.__or__(q2),
-                   [Q(key=key) for key in key_list])
+    if not key_list:
+        return
+    resource_objs = _get_taggable_resources(resources)
+
+    query = Q()
+    for resource_type, objs in resource_objs.items():
+        query |= Q(resource_type=resource_type,
+                   resource_id__in=[obj.id for obj in objs])
+    query &= Q(owner=owner, key__in=key_list)
+    Tag._get_collection().delete_many(Tag.objects(query)._query)
+
+    _update_tagged_resources(owner, resource_objs)
 
-    resource_query = Q()
-    missing_resources = get_missing_resources()
-    rtypes_to_update = set()
 
+def _get_taggable_resources(resources):
+    """Load the resources to be tagged with one query per resource type
+
+    Returns a dict mapping each resource type to its resources. Raises
+    `NotFoundError` if any resource does not exist or is missing.
+
+    """
+    resource_ids = {}
     for resource in resources:
         resource_type = resource.get('resource_type').rstrip('s')
-        resource_id = resource.get('resource_id')
-
-        if resource_id in missing_resources[resource_type]:
-            raise NotFoundError(msg=f'{resource_type} {resource_id}')
-
-        resource_query |= Q(owner=owner,
-                            resource_id=resource_id,
-                            resource_type=resource_type)
-        rtypes_to_update.add(resource_type + 's')
-        # SEC
-        owner.mapper.update(
-            get_resource_model(resource_type).
-            objects(id=resource_id).get())
-
-    query &= resource_query
-    Tag.objects.filter(query).delete()
-    trigger_session_update(owner, list(rtypes_to_update))
+        resource_ids.setdefault(resource_type, []).append(
+            resource.get('resource_id'))
+
+    ret = {}
+    for resource_type, rids in resource_ids.items():
+        ret[resource_type] = list(get_resource_model(resource_type).objects(
+            id__in=rids))
+        found = {obj.id: obj for obj in ret[resource_type]}
+        for resource_id in rids:
+            resource_obj = found.get(resource_id)
+            if resource_obj is None or \
+                    _is_missing(resource_type, resource_obj):
+                raise NotFoundError(msg=f'{resource_type} {resource_id}')
+    return ret
+
+
+def _is_missing(resource_type, resource_obj):
+    """Whether the resource is missing, deleted or disabled
+
+    Checks a single resource for the same conditions as
+    `get_missing_resources`.
+
+    """
+    if getattr(resource_obj, 'missing_since', None):
+        return True
+    if getattr(resource_obj, 'deleted', None):
+        return True
+    return resource_type == 'cloud' and resource_obj.enabled is False
+
+
+def _update_tagged_resources(owner, resource_objs):
+    """Sync the RBAC mappings & denormalized tags of newly tagged resources
+
+    The denormalized tags are rebuilt by one task per resource type and
+    batch of resources.
+
+    """
+    batch_size = config.TAGS_BULK_BATCH_SIZE
+    for resource_type, objs in resource_objs.items():
+        for resource_obj in objs:
+            # SEC
+            owner.mapper.update(resource_obj)
+        rids = [obj.id for obj in objs]
+        for i in range(0, len(rids), batch_size):
+            sync_resource_tags.send(resource_type, rids[i:i + batch_size])
+    trigger_session_update(owner, [resource_type + 's'
+                                   for resource_type in resource_objs])
 
 
 def resolve_id_and_get_tags(owner, rtype, rid, *args, **kwargs):
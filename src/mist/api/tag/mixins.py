@@ -17,7 +17,8 @@ class TagMixin(object):
 
         return dikt
 
-    def tags_to_string(self, tag_dict):
+    @staticmethod
+    def tags_to_string(tag_dict):
         tags = ''
         for k, v in tag_dict.items():
             tags = tags.rstrip(',') + f',{k}:{v},'
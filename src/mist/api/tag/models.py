@@ -5,7 +5,7 @@ import mongoengine as me
 from mist.api.mongoengine_extras import TagQuerySet
 from mist.api.config import TAGS_RESOURCE_TYPES
 from mist.api.users.models import Owner
-from mist.api.tag.tasks import update_tags, delete_tags
+from mist.api.tag.tasks import sync_resource_tags
 
 
 class Tag(me.Document):
@@ -20,7 +20,11 @@ class Tag(me.Document):
     resource_id = me.StringField()
 
     meta = {
-        'indexes': ['owner', 'resource_type', 'resource_id', 'key'],
+        'indexes': [
+            'owner', 'resource_type', 'resource_id', 'key',
+            ('owner', 'resource_type', 'resource_id'),
+            ('owner', 'key', 'value', 'resource_type'),
+        ],
         'queryset_class': TagQuerySet
     }
 
@@ -53,15 +57,11 @@ class Tag(me.Document):
     def save(self):
         super(Tag, self).save()
         delay = random.randrange(10**3, 10000)
-        update_tags.send_with_options(args=(self.resource_type,
-                                      self.resource_id,
-                                      {self.key: self.value}),
-                                      delay=delay)
+        sync_resource_tags.send_with_options(
+            args=(self.resource_type, [self.resource_id]), delay=delay)
 
     def delete(self):
-        delay = random.randrange(1000, 10000)
-        delete_tags.send_with_options(args=(self.resource_type,
-                                      self.resource_id,
-                                      [self.key]),
-                                      delay=delay)
         super(Tag, self).delete()
+        delay = random.randrange(1000, 10000)
+        sync_resource_tags.send_with_options(
+            args=(self.resource_type, [self.resource_id]), delay=delay)
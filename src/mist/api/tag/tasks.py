@@ -1,44 +1,46 @@
 from mist.api.dramatiq_app import dramatiq
 from mist.api.helpers import get_resource_model
-from mongoengine import ValidationError, DoesNotExist
+from mist.api import config
+from pymongo import UpdateOne
 
 
 @dramatiq.actor(queue_name='dramatiq_tags', max_retries=0)
-def update_tags(tag_objects):
-    resources = set(
-        [(x['resource_type'], x['resource_id'])
-         for x in tag_objects])
-
-    for resource in resources:
-        resource_type, resource_id = resource
-        tags = {
-            x['key']: x['value'] for x in tag_objects
-            if (x['resource_type'], x['resource_id']) == resource}
-
-        try:
-            get_resource_model(resource_type).objects.get(
-                id=resource_id).update_tags(tags)
-        except (DoesNotExist, ValidationError) as exc:
-            update_tags.logger.error(
-                'Saving tag  on %s (id%s)failed with %r',
-                tags, resource_type, resource_id, exc)
+def sync_resource_tags(resource_type, resource_ids):
+    """Rebuild the denormalized tags of many resources of the same type
 
+    The tags are read from the Tag collection with a single query and set
+    on the resources with a single bulk write.
 
-@dramatiq.actor(queue_name='dramatiq_tags', max_retries=0)
-def delete_tags(tag_objects):
-    resources = set(
-        [(x['resource_type'], x['resource_id'])
-         for x in tag_objects])
-
-    for resource in resources:
-        resource_type, resource_id = resource
-        key_list = [
-            x['key'] for x in tag_objects
-            if (x['resource_type'], x['resource_id']) == resource]
-        try:
-            get_resource_model(resource_type).objects.get(
-                id=resource_id).delete_tags(key_list)
-        except (DoesNotExist, ValidationError) as exc:
-            delete_tags.logger.error(
-                'Deleting tag %s on %s (id%s)failed with %r',
-                key_list, resource_type, resource_id, exc)
+    """
+    from mist.api.tag.models import Tag
+    model = get_resource_model(resource_type)
+    if 'tags' not in model._fields:
+        return
+    tags = {resource_id: {} for resource_id in resource_ids}
+    for tag in Tag.objects(resource_type=resource_type,
+                           resource_id__in=resource_ids).only(
+                               'resource_id', 'key', 'value'):
+        tags[tag.resource_id][tag.key] = tag.value
+    model._get_collection().bulk_write([
+        UpdateOne({'_id': resource_id},
+                  {'$set': {'tags': model.tags_to_string(tag_dict)}})
+        for resource_id, tag_dict in tags.items()
+    ], ordered=False)
+
+
+def sync_tagged_resources(tags):
+    """Rebuild the denormalized tags of the resources of `tags`
+
+    One `sync_resource_tags` task is sent per resource type and batch of up
+    to `TAGS_BULK_BATCH_SIZE` resources.
+
+    """
+    resource_ids = {}
+    for tag in tags:
+        resource_ids.setdefault(tag.resource_type, set()).add(
+            tag.resource_id)
+    batch_size = config.TAGS_BULK_BATCH_SIZE
+    for resource_type, rids in resource_ids.items():
+        rids = sorted(rids)
+        for i in range(0, len(rids), batch_size):
+            sync_resource_tags.send(resource_type, rids[i:i + batch_size])
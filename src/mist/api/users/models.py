@@ -321,6 +321,13 @@ class User(Owner):
     def __eq__(self, other):
         return self.id == other.id
 
+    def save(self, *args, **kwargs):
+        from mist.api.auth.cache import auth_cache
+        broadcast = not self._created and bool(self._get_changed_fields())
+        ret = super(User, self).save(*args, **kwargs)
+        auth_cache.invalidate(users=[self.id], broadcast=broadcast)
+        return ret
+
     def clean(self):
         # make sure user.email is unique - we can't use the unique keyword on
         # the field definition because both User and Organization subclass
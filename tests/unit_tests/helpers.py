@@ -0,0 +1,57 @@
+"""Helpers shared by the unit tests"""
+
+import threading
+
+from http.server import HTTPServer
+from unittest import mock
+
+import mongomock
+import mongoengine as me
+
+from pymongo import UpdateMany
+
+
+def start_server(test, handler_class, server_class=HTTPServer, **attrs):
+    """Serve requests with `handler_class` from a thread during a test
+
+    The server listens on a free port of 127.0.0.1. Any `attrs` are set on
+    it, for the handler to use as `self.server.<attr>`. Returns the server,
+    which is shut down once the test ends.
+
+    """
+    server = server_class(('127.0.0.1', 0), handler_class)
+    for name, value in attrs.items():
+        setattr(server, name, value)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
+
+
+def start_patches(test, *patches):
+    """Start mock patches, which are stopped once the test ends"""
+    for patch in patches:
+        patch.start()
+        test.addCleanup(patch.stop)
+
+
+def _bulk_write(collection, requests, ordered=True, **kwargs):
+    # mongomock can't add the update requests of newer pymongo versions to
+    # its bulk operations, so apply them one by one.
+    for request in requests:
+        if isinstance(request, UpdateMany):
+            update = collection.update_many
+        else:
+            update = collection.update_one
+        update(request._filter, request._doc, upsert=bool(request._upsert))
+
+
+def use_mongomock(test):
+    """Store all documents in a new in-memory db during a test"""
+    me.disconnect()
+    me.connect('mongoenginetest', host='mongodb://localhost',
+               mongo_client_class=mongomock.MongoClient)
+    test.addCleanup(me.disconnect)
+    start_patches(test, mock.patch.object(mongomock.Collection,
+                                          'bulk_write', _bulk_write))
@@ -0,0 +1,109 @@
+import datetime
+import unittest
+
+from unittest import mock
+
+import netaddr
+
+from mist.api.auth.cache import auth_cache
+from mist.api.auth.methods import _get_cached_token
+from mist.api.auth.models import ApiToken, SessionToken
+from mist.api.users.models import User, WhitelistIP
+
+from .helpers import start_patches, use_mongomock
+
+
+class TestAuthCache(unittest.TestCase):
+    def setUp(self):
+        use_mongomock(self)
+        self.publish = mock.Mock()
+        start_patches(
+            self,
+            mock.patch.object(auth_cache, 'size', 100),
+            mock.patch.object(auth_cache, 'ttl', 60),
+            mock.patch.object(auth_cache, '_ensure_listener'),
+            mock.patch('mist.api.helpers.amqp_publish', self.publish),
+        )
+        auth_cache.clear()
+        self.addCleanup(auth_cache.clear)
+        self.user = User(email='user@example.com',
+                         ips=[WhitelistIP(cidr='10.0.0.0/24')])
+        self.user.save()
+        self.session = SessionToken(user_id=self.user.id)
+        self.session.save()
+
+    def cached_token(self):
+        return _get_cached_token(self.session.token, SessionToken)
+
+    def test_token_hit(self):
+        self.assertEqual(self.cached_token().id, self.session.id)
+        with mock.patch.object(SessionToken, 'objects') as objects:
+            self.assertEqual(self.cached_token().id, self.session.id)
+        objects.get.assert_not_called()
+        self.assertIsNone(_get_cached_token(self.session.token, ApiToken))
+
+    def test_revoked_token(self):
+        self.cached_token()
+        self.session.invalidate()
+        self.session.save()
+        self.assertIsNone(auth_cache.get_token(self.session.token))
+        self.assertIsNone(self.cached_token())
+        self.publish.assert_called_once_with(
+            auth_cache.exchange, '',
+            {'tokens': [self.session.token], 'users': []}, ex_declare=True)
+
+    def test_revoked_in_other_process(self):
+        self.cached_token()
+        SessionToken.objects(id=self.session.id).update(revoked=True)
+        auth_cache._on_invalidate({'tokens': [self.session.token]})
+        self.assertIsNone(self.cached_token())
+
+    def test_expired_token(self):
+        self.session.ttl = 60
+        self.session.save()
+        self.cached_token()
+        later = datetime.datetime.utcnow() + datetime.timedelta(minutes=2)
+        with mock.patch('mist.api.auth.models.datetime') as dt:
+            dt.utcnow.return_value = later
+            self.assertIsNone(auth_cache.get_token(self.session.token))
+            self.assertNotIn(('token', self.session.token),
+                             auth_cache.entries)
+
+    def test_touch_not_broadcast(self):
+        self.cached_token()
+        self.session.touch()
+        self.session.save()
+        self.publish.assert_not_called()
+        self.assertIsNone(auth_cache.get_token(self.session.token))
+
+    def test_user_save(self):
+        self.assertEqual(self.session.get_user().email, 'user@example.com')
+        self.assertEqual(auth_cache.get_user_email(self.user.id),
+                         'user@example.com')
+        self.user.email = 'other@example.com'
+        self.user.save()
+        self.assertIsNone(auth_cache.get_user(User, self.user.id))
+        self.assertIsNone(auth_cache.get_user_email(self.user.id))
+        self.assertEqual(self.session.get_user().email, 'other@example.com')
+        self.publish.assert_called_once_with(
+            auth_cache.exchange, '',
+            {'tokens': [], 'users': [self.user.id]}, ex_declare=True)
+
+    def test_whitelist_change(self):
+        ip = netaddr.IPAddress('10.0.0.1')
+        networks, _ = auth_cache.whitelist_networks(self.session.get_user())
+        self.assertTrue(any(ip in network for network in networks))
+        self.user.ips = [WhitelistIP(cidr='10.1.0.0/24')]
+        self.user.save()
+        networks, _ = auth_cache.whitelist_networks(self.session.get_user())
+        self.assertFalse(any(ip in network for network in networks))
+        self.assertIn(netaddr.IPNetwork('10.1.0.0/24'), networks)
+
+    def test_disabled(self):
+        for size, ttl in ((0, 60), (100, 0)):
+            auth_cache.size, auth_cache.ttl = size, ttl
+            self.assertEqual(self.cached_token().id, self.session.id)
+            self.assertEqual(self.session.get_user().id, self.user.id)
+            self.assertEqual(auth_cache.entries, {})
+            self.assertIsNone(auth_cache.get_token(self.session.token))
+            self.assertIsNone(auth_cache.get_user(User, self.user.id))
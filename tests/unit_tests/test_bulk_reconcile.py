@@ -0,0 +1,164 @@
+import datetime
+import unittest
+
+from unittest import mock
+
+from mist.api.clouds.models import AmazonCloud
+from mist.api.users.models import Organization
+from mist.api.machines import models as machine_models
+from mist.api.machines.models import Machine
+
+from .helpers import start_patches
+
+
+NODE = {
+    'id': 'i-0123',
+    'name': 'renamed',
+    'state': 'running',
+    'private_ips': ['10.0.0.2'],
+    'public_ips': [],
+    'extra': {},
+}
+
+
+def postparse_machine(machine, node):
+    # As set from the node's extra['platform'] by the EC2 controller.
+    machine.os_type = 'Windows'
+    return True
+
+
+class TestBulkReconcile(unittest.TestCase):
+    def setUp(self):
+        self.org = Organization(id='a' * 32, name='org')
+        self.cloud = AmazonCloud(id='b' * 32, owner=self.org, name='cloud')
+        self.saved = []
+        compute = self.cloud.ctl.compute
+        self.patches = [
+            mock.patch.object(machine_models.KeyMachineAssociation,
+                              'objects', return_value=[]),
+            mock.patch.object(Machine, 'save', autospec=True,
+                              side_effect=self.save),
+        ] + [
+            mock.patch.object(compute, '_list_machines__%s' % name,
+                              return_value=value)
+            for name, value in (('node_fingerprint', None),
+                                ('get_location', None),
+                                ('get_image', None),
+                                ('get_custom_image', None),
+                                ('get_size', None),
+                                ('get_custom_size', None),
+                                ('get_machine_extra', {}),
+                                ('machine_creation_date', None),
+                                ('machine_actions', None),
+                                ('cost_machine', (0, 0)))
+        ] + [
+            mock.patch.object(compute, '_list_machines__postparse_machine',
+                              postparse_machine),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def save(self, machine, *args, **kwargs):
+        machine.validate()
+        self.saved.append(machine)
+        return machine
+
+    def reconcile(self, bulk):
+        machine = Machine(id='c' * 32, cloud=self.cloud, owner=None,
+                          external_id=NODE['id'], name='old')
+        bulk_updates = [] if bulk else None
+        self.cloud.ctl.compute._update_machine_from_node(
+            NODE, {}, {}, {}, datetime.datetime(2020, 1, 1),
+            machines_map={NODE['id']: machine}, tags_map={machine.id: {}},
+            bulk_updates=bulk_updates)
+        if bulk:
+            self.assertEqual(bulk_updates, [machine])
+        else:
+            self.assertEqual(self.saved, [machine])
+        return machine
+
+    def test_bulk_machine_is_cleaned(self):
+        machine = self.reconcile(bulk=True)
+        self.assertEqual(machine.os_type, 'windows')
+        self.assertEqual(machine.owner, self.org)
+
+    def test_bulk_matches_save(self):
+        bulk = self.reconcile(bulk=True).to_mongo().to_dict()
+        saved = self.reconcile(bulk=False).to_mongo().to_dict()
+        # The collectd password is generated randomly when cleaning.
+        for doc in (bulk, saved):
+            self.assertTrue(doc['monitoring'].pop('collectd_password'))
+        self.assertEqual(bulk, saved)
+
+
+class TestNodeFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.org = Organization(id='a' * 32, name='org')
+        self.cloud = AmazonCloud(id='b' * 32, owner=self.org, name='cloud')
+        self.machine = Machine(id='c' * 32, cloud=self.cloud, owner=None,
+                               external_id=NODE['id'], name='old')
+        compute = self.cloud.ctl.compute
+        self.postparse = mock.Mock(return_value=False)
+        start_patches(self, *[
+            mock.patch.object(machine_models.KeyMachineAssociation,
+                              'objects', return_value=[]),
+            mock.patch.object(Machine, 'save', autospec=True),
+            mock.patch.object(compute, '_list_machines__postparse_machine',
+                              self.postparse),
+        ] + [
+            mock.patch.object(compute, '_list_machines__%s' % name,
+                              return_value=value)
+            for name, value in (('get_location', None),
+                                ('get_image', None),
+                                ('get_custom_image', None),
+                                ('get_size', None),
+                                ('get_custom_size', None),
+                                ('get_machine_extra', {}),
+                                ('machine_creation_date', None),
+                                ('machine_actions', None),
+                                ('cost_machine', (0, 0)))
+        ])
+
+    def reconcile(self, node=NODE, tags=None):
+        stats = {}
+        self.cloud.ctl.compute._update_machine_from_node(
+            node, {}, {}, {}, datetime.datetime(2020, 1, 1),
+            machines_map={node['id']: self.machine},
+            tags_map={self.machine.id: tags or {}}, stats=stats)
+        return stats
+
+    def test_unchanged_node_skipped(self):
+        self.assertEqual(self.reconcile(), {'updated': 1})
+        self.assertTrue(self.machine.node_fingerprint)
+        self.assertEqual(self.reconcile(), {'skipped': 1})
+        self.assertEqual(self.postparse.call_count, 1)
+
+    def test_changed_node_reparsed(self):
+        self.reconcile()
+        self.assertEqual(self.reconcile(dict(NODE, name='other')),
+                         {'updated': 1})
+        self.assertEqual(self.machine.name, 'other')
+        self.assertEqual(self.postparse.call_count, 2)
+
+    def test_changed_cost_inputs_reparsed(self):
+        self.reconcile()
+        self.assertEqual(self.reconcile(tags={'cost_per_hour': '1'}),
+                         {'updated': 1})
+        self.assertEqual(self.machine.cost.hourly, 1)
+        next_month = datetime.datetime.utcnow() + datetime.timedelta(days=32)
+        with mock.patch('datetime.datetime') as dt:
+            dt.utcnow.return_value = next_month
+            stats = self.reconcile(tags={'cost_per_hour': '1'})
+        self.assertEqual(stats, {'updated': 1})
+        self.assertEqual(self.postparse.call_count, 3)
+
+    def test_failed_node_retried(self):
+        self.postparse.side_effect = ValueError()
+        self.reconcile()
+        self.assertIsNone(self.machine.node_fingerprint)
+        self.postparse.side_effect = None
+        self.assertEqual(self.reconcile(), {'updated': 1})
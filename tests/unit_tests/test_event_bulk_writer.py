@@ -0,0 +1,119 @@
+import unittest
+
+from unittest import mock
+
+from mist.api import helpers
+from mist.api.auth.cache import auth_cache
+from mist.api.logs import bulk
+from mist.api.logs.methods import get_user_email
+from mist.api.users.models import User
+
+from .helpers import start_patches, use_mongomock
+
+
+def event(i):
+    return {'log_id': 'l%d' % i, 'time': 1500000000 + i, 'action': 'test'}
+
+
+class TestEventBulkWriter(unittest.TestCase):
+    def setUp(self):
+        self.bulk = mock.Mock(return_value=(0, []))
+        self.atexit = mock.Mock()
+        self.ensure = mock.Mock()
+        start_patches(
+            self,
+            mock.patch.object(bulk, 'bulk', self.bulk),
+            mock.patch.object(bulk, 'es_client'),
+            mock.patch.object(bulk.atexit, 'register', self.atexit),
+            mock.patch.object(bulk.ProcessThread, 'ensure', self.ensure),
+        )
+        self.writer = bulk.EventBulkWriter(3, 2, index='events')
+
+    def flushed_ids(self, call):
+        return [action['_id'] for action in call[0][1]]
+
+    def test_flush_on_size(self):
+        self.writer.add(event(1))
+        self.writer.add(event(2))
+        self.bulk.assert_not_called()
+        self.writer.add(event(3))
+        self.bulk.assert_called_once()
+        self.assertEqual(self.flushed_ids(self.bulk.call_args),
+                         ['l1', 'l2', 'l3'])
+        action = self.bulk.call_args[0][1][0]
+        self.assertEqual(action['_index'], 'events')
+        self.assertEqual(action['_source']['@timestamp'], 1500000001000)
+        self.assertEqual(self.writer.events, [])
+
+    def test_flush_on_interval(self):
+        self.writer.add(event(1))
+        with mock.patch.object(bulk.time, 'sleep',
+                               side_effect=[None, StopIteration]) as sleep:
+            self.assertRaises(StopIteration, self.writer._run)
+        sleep.assert_called_with(2)
+        self.assertEqual(self.flushed_ids(self.bulk.call_args), ['l1'])
+
+    def test_index_per_day(self):
+        writer = bulk.EventBulkWriter(1, 2)
+        with mock.patch.object(bulk.config, 'LOG_EVENTS_ES_INDEX',
+                               'app-logs-%Y.%m.%d'):
+            writer.add(event(1))
+        self.assertEqual(self.bulk.call_args[0][1][0]['_index'],
+                         'app-logs-2017.07.14')
+
+    def test_failed_flush(self):
+        self.bulk.side_effect = ConnectionError()
+        self.writer.add(event(1))
+        self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(self.writer.events, [])
+
+    def test_started_in_new_process(self):
+        self.writer.add(event(1))
+        self.ensure.assert_called_once_with(on_start=self.writer._on_start)
+        self.writer._on_start()
+        self.assertEqual(self.writer.events, [])
+        self.atexit.assert_called_once_with(self.writer.flush)
+
+
+class TestGetUserEmail(unittest.TestCase):
+    def setUp(self):
+        use_mongomock(self)
+        start_patches(
+            self,
+            mock.patch.object(auth_cache, 'size', 100),
+            mock.patch.object(auth_cache, 'ttl', 60),
+            mock.patch.object(auth_cache, '_ensure_listener'),
+            mock.patch('mist.api.helpers.amqp_publish'),
+        )
+        auth_cache.clear()
+        self.addCleanup(auth_cache.clear)
+        self.user = User(email='user@example.com')
+        self.user.save()
+
+    def test_cached(self):
+        self.assertEqual(get_user_email(self.user.id), 'user@example.com')
+        with mock.patch.object(User, 'objects') as objects:
+            self.assertEqual(get_user_email(self.user.id),
+                             'user@example.com')
+        objects.assert_not_called()
+        self.assertIsNone(get_user_email('missing'))
+
+    def test_invalidated(self):
+        get_user_email(self.user.id)
+        self.user.email = 'other@example.com'
+        self.user.save()
+        self.assertEqual(get_user_email(self.user.id), 'other@example.com')
+
+
+class TestESClient(unittest.TestCase):
+    def setUp(self):
+        start_patches(self, mock.patch.object(helpers, '_es_clients', {}))
+
+    def test_shared_per_process(self):
+        client = helpers.es_client()
+        self.assertIs(helpers.es_client(), client)
+        with mock.patch('os.getpid', return_value=-1):
+            forked_client = helpers.es_client()
+            self.assertIsNot(forked_client, client)
+            self.assertIs(helpers.es_client(), forked_client)
+        self.assertIs(helpers.es_client(), client)
@@ -0,0 +1,43 @@
+import time
+import threading
+import unittest
+
+from unittest import mock
+
+from mist.api.machines import methods
+
+
+class TestFanOutListMachines(unittest.TestCase):
+    def setUp(self):
+        self.hung = threading.Event()
+
+    def tearDown(self):
+        self.hung.set()
+
+    def list_machines(self, auth_context, cloud_id, cached=False):
+        if cloud_id.startswith('hung'):
+            self.hung.wait()
+        return [{'id': cloud_id}]
+
+    def fan_out(self, cloud_ids, concurrency):
+        with mock.patch.object(methods, 'filter_list_machines',
+                               self.list_machines):
+            return list(methods.fan_out_list_machines(
+                None, cloud_ids, concurrency=concurrency, timeout=1))
+
+    def test_queued_clouds_time_out(self):
+        start = time.time()
+        results = self.fan_out(['hung1', 'hung2', 'queued'], concurrency=2)
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual({cloud_id for cloud_id, _, _ in results},
+                         {'hung1', 'hung2', 'queued'})
+        for cloud_id, machines, error in results:
+            self.assertIsNone(machines)
+            self.assertEqual(error['type'], 'CloudUnavailableError')
+
+    def test_completed_clouds(self):
+        results = self.fan_out(['a', 'hung', 'b'], concurrency=3)
+        self.assertEqual(sorted(results[:2]), [('a', [{'id': 'a'}], None),
+                                               ('b', [{'id': 'b'}], None)])
+        self.assertEqual(results[2][0], 'hung')
+        self.assertEqual(results[2][2]['type'], 'CloudUnavailableError')
@@ -0,0 +1,91 @@
+import copy
+import unittest
+
+from unittest import mock
+
+import jsonpatch
+
+from mist.api.clouds.models import AmazonCloud
+from mist.api.machines.models import Machine
+from mist.api.users.models import Organization
+
+from .helpers import start_patches
+
+
+class FakeMachine(object):
+    def __init__(self, machine_id, **fields):
+        self.id = machine_id
+        self.external_id = 'i-%s' % machine_id
+        self.fields = fields
+
+    def as_dict(self):
+        return dict(copy.deepcopy(self.fields), id=self.id,
+                    external_id=self.external_id, last_seen='now',
+                    extra={'ports': [{'PublicPort': 2}, {'PublicPort': 1}]})
+
+    def summary(self):
+        return {'id': self.id, 'external_id': self.external_id,
+                'name': self.fields.get('name')}
+
+
+class TestIncrementalPatch(unittest.TestCase):
+    def setUp(self):
+        org = Organization(id='a' * 32, name='org')
+        self.compute = AmazonCloud(id='b' * 32, owner=org,
+                                   name='cloud').ctl.compute
+        self.publish = mock.Mock()
+        start_patches(
+            self,
+            mock.patch.object(self.compute, '_publish_machines_patch',
+                              self.publish),
+            mock.patch.object(Machine, 'as_dicts',
+                              lambda machines: [m.as_dict()
+                                                for m in machines]),
+        )
+
+    def patched(self, machine_dicts, patch):
+        """Apply a patch to the machines the UI holds for `machine_dicts`"""
+        machines = {'%s-%s' % (m['id'], m['external_id']): copy.deepcopy(m)
+                    for m in machine_dicts}
+        for machine in machines.values():
+            machine.pop('last_seen')
+            machine['extra']['ports'].sort(key=lambda p: p['PublicPort'])
+        return jsonpatch.apply_patch(machines, patch)
+
+    def test_same_as_full_patch(self):
+        unchanged = FakeMachine('a', name='a', state='running',
+                                tags={'env': 'dev'})
+        changed = FakeMachine('b', name='b', state='running',
+                              private_ips=['10.0.0.1', '10.0.0.2'],
+                              tags={'env': 'dev', 'team': 'x'})
+        removed = FakeMachine('c', name='c', state='stopped')
+        before = [unchanged, changed, removed]
+        snapshots = {changed.id: changed.as_dict()}
+        cached_dicts = [m.as_dict() for m in before]
+        cached_summaries = [m.summary() for m in before]
+
+        changed.fields.update(name='renamed', state='stopped',
+                              private_ips=['10.0.0.2'],
+                              tags={'env': 'prod', 'owner': 'y'})
+        added = FakeMachine('d', name='d', state='pending')
+        after = [added, changed, unchanged]
+
+        self.compute.produce_and_publish_patch(cached_dicts, after)
+        full_patch = self.publish.call_args[0][0]
+        self.compute.produce_and_publish_incremental_patch(
+            cached_summaries, after, snapshots)
+        incremental_patch = self.publish.call_args[0][0]
+
+        expected = self.patched([m.as_dict() for m in after], [])
+        self.assertEqual(self.patched(cached_dicts, full_patch), expected)
+        self.assertEqual(self.patched(cached_dicts, incremental_patch),
+                         expected)
+        self.assertEqual(
+            sorted((op['op'], op['path']) for op in incremental_patch),
+            sorted((op['op'], op['path']) for op in full_patch))
+
+    def test_no_changes(self):
+        machines = [FakeMachine('a', name='a'), FakeMachine('b', name='b')]
+        self.compute.produce_and_publish_incremental_patch(
+            [m.summary() for m in machines], machines, {})
+        self.assertEqual(self.publish.call_args[0][0], [])
@@ -0,0 +1,138 @@
+import datetime
+import unittest
+
+from collections import OrderedDict
+from unittest import mock
+
+from mist.api import methods
+from mist.api.exceptions import BadRequestError
+from mist.api.methods import _encode_cursor, _decode_cursor, _keyset_query
+
+
+DOCS = [
+    {'_id': 'a', 'name': 'x'},
+    {'_id': 'b'},
+    {'_id': 'c', 'name': None},
+    {'_id': 'd', 'name': 'y'},
+    {'_id': 'e', 'name': 'x'},
+    {'_id': 'f', 'name': 'x'},
+    {'_id': 'g'},
+    {'_id': 'h', 'name': 'w'},
+]
+
+
+def matches(doc, query):
+    """Match a document against the subset of queries _keyset_query uses"""
+    if '$or' in query:
+        return any(matches(doc, subquery) for subquery in query['$or'])
+    for field, condition in query.items():
+        value = doc.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for op, operand in condition.items():
+            if op == '$ne':
+                if value == operand:
+                    return False
+            elif value is None or not {'$lt': value < operand,
+                                       '$gt': value > operand}[op]:
+                return False
+    return True
+
+
+def sort_key(doc, field):
+    # Missing and null values sort before any other value, like in mongo.
+    value = doc.get(field)
+    return (value is not None, value or '', doc['_id'])
+
+
+class TestKeysetQuery(unittest.TestCase):
+    def paginate(self, field, descending, limit):
+        ordered = sorted(DOCS, key=lambda doc: sort_key(doc, field),
+                         reverse=descending)
+        pages = []
+        query = {}
+        while True:
+            page = [doc for doc in ordered if matches(doc, query)][:limit]
+            if not page:
+                return ordered, pages
+            pages.append(page)
+            last = page[-1]
+            query = _keyset_query(field, descending, last.get(field),
+                                  last['_id'])
+
+    def assert_pages(self, field, descending):
+        for limit in (1, 2, 3):
+            ordered, pages = self.paginate(field, descending, limit)
+            self.assertEqual([doc for page in pages for doc in page],
+                             ordered)
+
+    def test_ascending(self):
+        self.assert_pages('name', False)
+
+    def test_descending(self):
+        self.assert_pages('name', True)
+
+    def test_id(self):
+        self.assertEqual(_keyset_query('_id', False, 'c', 'c'),
+                         {'_id': {'$gt': 'c'}})
+        self.assertEqual(_keyset_query('_id', True, 'c', 'c'),
+                         {'_id': {'$lt': 'c'}})
+        self.assert_pages('_id', False)
+        self.assert_pages('_id', True)
+
+
+class TestCursor(unittest.TestCase):
+    def test_round_trip(self):
+        for value in (datetime.datetime(2020, 1, 2, 3, 4, 5), None, 'x', 10,
+                      1.5, True):
+            cursor = _encode_cursor('-created', value, 'a' * 32)
+            self.assertNotIn('=', cursor)
+            self.assertEqual(_decode_cursor(cursor, '-created'),
+                             (value, 'a' * 32))
+
+    def test_different_sort(self):
+        cursor = _encode_cursor('name', 'x', 'a' * 32)
+        with self.assertRaises(BadRequestError):
+            _decode_cursor(cursor, '-name')
+
+    def test_invalid(self):
+        for cursor in ('not a cursor', 'e30', '!!'):
+            with self.assertRaises(BadRequestError):
+                _decode_cursor(cursor, 'name')
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestEstimatedCount(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(methods, '_count_cache', OrderedDict())
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def queryset(self, query, count):
+        return mock.Mock(_query=query, **{'count.return_value': count})
+
+    def test_cached(self):
+        self.assertEqual(methods._estimated_count(
+            'machine', self.queryset({'a': 1}, 3)), 3)
+        self.assertEqual(methods._estimated_count(
+            'machine', self.queryset({'a': 1}, 4)), 3)
+        self.assertEqual(methods._estimated_count(
+            'volume', self.queryset({'a': 1}, 5)), 5)
+        with mock.patch.object(methods, 'time', return_value=10 ** 10):
+            self.assertEqual(methods._estimated_count(
+                'machine', self.queryset({'a': 1}, 4)), 4)
+
+    def test_size(self):
+        with mock.patch.object(methods.config,
+                               'LIST_RESOURCES_COUNT_CACHE_SIZE', 2):
+            for i in range(3):
+                methods._estimated_count('machine',
+                                         self.queryset({'a': i}, i))
+        self.assertEqual(len(methods._count_cache), 2)
+        self.assertEqual(methods._estimated_count(
+            'machine', self.queryset({'a': 0}, 10)), 10)
@@ -0,0 +1,63 @@
+import json
+import unittest
+
+from unittest import mock
+
+from pyramid.response import Response
+
+from mist.api.exceptions import CloudUnavailableError, ForbiddenError
+from mist.api.machines import views
+from mist.api.renderers import StreamingJSONRenderer
+
+
+CLOUDS = [{'id': 'a', 'enabled': True}, {'id': 'b', 'enabled': True},
+          {'id': 'c', 'enabled': True}]
+
+
+def filter_iter_machines(auth_context, cloud_id, cached=True):
+    yield {'id': cloud_id + '1'}
+    if cloud_id == 'a':
+        raise ValueError('connection reset')
+    if cloud_id == 'b':
+        raise CloudUnavailableError()
+    yield {'id': cloud_id + '2'}
+
+
+class TestListMachinesStream(unittest.TestCase):
+    def render(self, value):
+        request = mock.Mock(response=Response())
+        StreamingJSONRenderer(None)(value, {'request': request})
+        return json.loads(b''.join(request.response.app_iter))
+
+    def test_cloud_error(self):
+        with mock.patch.object(views, 'auth_context_from_request'), \
+                mock.patch.object(views, 'params_from_request',
+                                  return_value={}), \
+                mock.patch.object(views, 'filter_list_clouds',
+                                  return_value=CLOUDS), \
+                mock.patch.object(views.methods, 'filter_iter_machines',
+                                  filter_iter_machines):
+            machines = self.render(views.list_machines(mock.Mock()))
+        self.assertEqual(machines[0], {'id': 'a1'})
+        self.assertEqual(machines[1]['cloud'], 'a')
+        self.assertEqual(machines[1]['error']['type'],
+                         'CloudUnavailableError')
+        self.assertEqual(machines[2:], [{'id': 'b1'}, {'id': 'c1'},
+                                        {'id': 'c2'}])
+
+    def test_error_before_streaming(self):
+        def iter_machines():
+            raise ForbiddenError()
+            yield
+
+        request = mock.Mock(response=Response())
+        with self.assertRaises(ForbiddenError):
+            StreamingJSONRenderer(None)(iter_machines(),
+                                        {'request': request})
+
+    def test_empty(self):
+        self.assertEqual(self.render(iter([])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import datetime
+import unittest
+
+from unittest import mock
+
+from bson import DBRef
+
+from mist.api.actions.models import MachineAction
+from mist.api.clouds.models import AmazonCloud, CloudSize
+from mist.api.keys.models import SSHKey
+from mist.api.machines import models
+from mist.api.machines.models import KeyMachineAssociation, Machine
+from mist.api.schedules.models import Schedule
+from mist.api.tag.models import Tag
+from mist.api.users.models import Organization
+from mist.api.when.models import OneOff, Reminder
+
+from .helpers import use_mongomock
+
+
+def insert(*docs):
+    """Store documents as they are, without their save hooks"""
+    for doc in docs:
+        type(doc)._get_collection().insert_one(doc.to_mongo())
+
+
+class TestMachineAsDicts(unittest.TestCase):
+    def setUp(self):
+        use_mongomock(self)
+        now = datetime.datetime(2020, 1, 1)
+        self.org = Organization(id='o' * 32, name='org')
+        self.cloud = AmazonCloud(id='c' * 32, owner=self.org, name='cloud')
+        size = CloudSize(id='s' * 32, cloud=self.cloud, external_id='t2',
+                         name='t2.micro')
+        reminder = Schedule(id='r' * 32, owner=self.org, name='reminder',
+                            when=Reminder(entry=now))
+        expiration = Schedule(
+            id='e' * 32, owner=self.org, name='expiration',
+            when=OneOff(entry=now + datetime.timedelta(hours=1)),
+            actions=[MachineAction(action='stop')], reminder=reminder)
+        key = SSHKey(id='k' * 32, owner=self.org, name='key')
+        self.machines = [
+            Machine(id='m1', cloud=self.cloud, owner=self.org,
+                    external_id='i-1', name='m1', size=size,
+                    expiration=expiration, parent='m2', last_seen=now,
+                    extra={'created': now, 'tags': {'a': 'b'}}),
+            Machine(id='m2', cloud=self.cloud, owner=self.org,
+                    external_id='i-2', name='m2', location='l1'),
+            Machine(id='m3', cloud=self.cloud, owner=self.org,
+                    external_id='i-3', name='m3', size=size),
+        ]
+        insert(self.org, self.cloud, size, reminder, expiration, key,
+               *self.machines)
+        insert(Tag(owner=self.org, resource_type='machine',
+                   resource_id='m1', key='env', value='dev'),
+               Tag(owner=self.org, resource_type='machine',
+                   resource_id='m1', key='empty'),
+               Tag(owner='other', resource_type='machine',
+                   resource_id='m1', key='other', value='org'),
+               KeyMachineAssociation(key=key, machine=self.machines[0],
+                                     ssh_user='ubuntu'))
+
+    def test_same_as_as_dict(self):
+        machines = Machine.objects(cloud=self.cloud).order_by('id')
+        expected = [machine.as_dict() for machine in machines]
+        self.assertEqual(Machine.as_dicts(machines), expected)
+        self.assertEqual(expected[0]['tags'], {'env': 'dev', 'empty': None})
+        self.assertEqual(len(expected[0]['key_associations']), 1)
+        self.assertEqual(expected[0]['expiration']['notify'], 3600)
+        self.assertEqual(expected[0]['size'], 't2.micro')
+        self.assertEqual(expected[0]['parent'], 'm2')
+        self.assertEqual(expected[1]['expiration'], None)
+        self.assertEqual(Machine.as_dicts([]), [])
+
+    def test_queries(self):
+        machines = list(Machine.objects(cloud=self.cloud))
+        with mock.patch.object(Schedule, 'objects',
+                               wraps=Schedule.objects) as objects:
+            Machine.as_dicts(machines)
+        # One query for the expirations and one for their reminders.
+        self.assertEqual(objects.call_count, 2)
+
+
+class TestHelpers(unittest.TestCase):
+    def test_ref_id(self):
+        machine = Machine(id='m1')
+        self.assertEqual(models._ref_id(machine), 'm1')
+        self.assertEqual(models._ref_id(DBRef('machines', 'm1')), 'm1')
+        self.assertEqual(models._ref_id('m1'), 'm1')
+        self.assertIsNone(models._ref_id(None))
+
+    def test_expiration_as_dict(self):
+        now = datetime.datetime(2020, 1, 1)
+        reminder = Schedule(id='r1', when=Reminder(entry=now))
+        schedule = Schedule(
+            id='e1', when=OneOff(entry=now + datetime.timedelta(minutes=5)),
+            actions=[MachineAction(action='destroy')])
+        self.assertEqual(models._expiration_as_dict(schedule), {
+            'id': 'e1', 'action': 'destroy', 'date': '2020-01-01T00:05:00',
+            'notify': 0})
+        self.assertEqual(
+            models._expiration_as_dict(schedule, reminder)['notify'], 300)
+        schedule.reminder = reminder
+        self.assertEqual(models._expiration_as_dict(schedule)['notify'], 300)
+        self.assertIsNone(models._expiration_as_dict(None))
@@ -0,0 +1,95 @@
+import time
+import asyncio
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from mist.api.monitoring.httpclient import HTTPClient
+
+from .helpers import start_server
+
+
+class FakeBackendHandler(BaseHTTPRequestHandler):
+    """Reply with the path after sleeping for `?sleep=<seconds>`"""
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight,
+                                            self.server.in_flight)
+        try:
+            if query.startswith('sleep='):
+                time.sleep(float(query[len('sleep='):]))
+            data = path.encode()
+            self.send_response(404 if path == '/missing' else 200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPClient(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server(self, FakeBackendHandler,
+                                   ThreadingHTTPServer, lock=threading.Lock(),
+                                   in_flight=0, max_in_flight=0)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.client = HTTPClient(10, 2, 5)
+        self.addCleanup(self.client.close)
+
+    def test_get(self):
+        resp = self.client.get(self.url + '/a', headers={'x-org-id': 'o1'})
+        self.assertTrue(resp.ok)
+        self.assertEqual(resp.text, '/a')
+        self.assertEqual(resp.url, self.url + '/a')
+
+    def test_get_many(self):
+        results = self.client.get_many(
+            [self.url + '/a', self.url + '/missing', 'http://127.0.0.1:1/'])
+        self.assertEqual(results[0].text, '/a')
+        self.assertEqual(results[1].status_code, 404)
+        self.assertFalse(results[1].ok)
+        self.assertIsInstance(results[2], Exception)
+        self.assertEqual(self.client.get_many([]), [])
+
+    def test_timeout(self):
+        start = time.time()
+        results = self.client.get_many([self.url + '/a', self.url + '/b'],
+                                       params={'sleep': 2}, timeout=0.2)
+        self.assertLess(time.time() - start, 1)
+        for result in results:
+            self.assertIsInstance(result, asyncio.TimeoutError)
+        self.client.timeout = 0.2
+        self.assertRaises(asyncio.TimeoutError, self.client.get,
+                          self.url + '/a', params={'sleep': 2})
+
+    def test_concurrency_per_process(self):
+        urls = [self.url + '/%d' % i for i in range(3)]
+        threads = [threading.Thread(target=self.client.get_many,
+                                    args=(urls, {'sleep': 0.1}))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.max_in_flight, 2)
+
+    def test_new_loop_in_new_process(self):
+        self.client.get(self.url + '/a')
+        loop, session = self.client.loop, self.client.session
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertEqual(self.client.get(self.url + '/b').text, '/b')
+            self.assertIsNot(self.client.loop, loop)
+            self.assertIsNot(self.client.session, session)
+            self.client.close()
+        # Stop the loop of the parent process too.
+        asyncio.run_coroutine_threadsafe(session.close(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
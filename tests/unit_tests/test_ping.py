@@ -0,0 +1,268 @@
+import types
+import socket
+import struct
+import subprocess
+import unittest
+
+from unittest import mock
+
+import pingparsing
+
+from bson import ObjectId
+
+from mist.api import ping
+from mist.api.clouds.models import AmazonCloud
+from mist.api.machines.models import Machine, PingProbe
+from mist.api.methods import format_ping_result
+from mist.api.poller.models import PingProbeMachinePollingSchedule
+from mist.api.poller.tasks import ping_probe_batch
+
+from .helpers import start_patches, use_mongomock
+
+
+PING_OUTPUT = """PING 10.0.0.1 (10.0.0.1) 56(84) bytes of data.
+
+--- 10.0.0.1 ping statistics ---
+4 packets transmitted, 3 received, 25% packet loss, time 1203ms
+rtt min/avg/max/mdev = 0.100/0.110/0.120/0.008 ms
+"""
+
+FPING_OUTPUT = b"""10.0.0.1 : 0.10 - 0.12 0.11
+10.0.0.2 : - - - -
+"""
+
+
+class TestPingHosts(unittest.TestCase):
+    def fping(self, hosts):
+        fping = mock.Mock(stdout=b'', stderr=FPING_OUTPUT)
+        with mock.patch.object(ping, 'icmp_socket_type', return_value=None), \
+                mock.patch.object(ping.shutil, 'which',
+                                  return_value='/usr/bin/fping'), \
+                mock.patch.object(ping.subprocess, 'run',
+                                  return_value=fping) as run:
+            return ping.ping_hosts(hosts, pkts=4), run
+
+    def test_pingparsing_format(self):
+        expected = pingparsing.PingParsing().parse(PING_OUTPUT).as_dict()
+        results, _ = self.fping(['10.0.0.1'])
+        self.assertDictEqual(results['10.0.0.1'], expected)
+        self.assertDictEqual(format_ping_result(results['10.0.0.1']),
+                             format_ping_result(expected))
+
+    def test_fping_fallback(self):
+        results, run = self.fping(['10.0.0.1', '10.0.0.2', '10.0.0.1'])
+        run.assert_called_once_with(
+            ['fping', '-q', '-C', '4', '-p', '400', '-t', '1000',
+             '10.0.0.1', '10.0.0.2'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(set(results), {'10.0.0.1', '10.0.0.2'})
+        unreachable = results['10.0.0.2']
+        self.assertEqual(unreachable['packet_transmit'], 4)
+        self.assertEqual(unreachable['packet_receive'], 0)
+        self.assertEqual(unreachable['packet_loss_rate'], 100.0)
+        self.assertIsNone(unreachable['rtt_avg'])
+
+
+class FakeICMPSocket(object):
+    """An ICMP socket that replies to echo requests through a socketpair
+
+    The `replies` of each host map a sequence number to the number of times
+    it is echoed, 1 by default.
+
+    """
+
+    def __init__(self, family, sock_type, proto, replies):
+        self.family = family
+        self.sock_type = sock_type
+        self.replies = replies
+        self.sock, self.peer = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_DGRAM)
+        self.host = None
+
+    def connect(self, address):
+        self.host = address[0]
+
+    def send(self, data):
+        _, code, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+        if self.sock_type == socket.SOCK_DGRAM:
+            ident = 0  # Replaced by the kernel.
+        # Replies to other requests are received too.
+        self.peer.send(self.reply(ping.ICMP_ECHO_REQUEST, ident, seq))
+        for _ in range(self.replies.get(self.host, {}).get(seq, 1)):
+            self.peer.send(self.reply(ping.ICMP_ECHO_REPLY, ident, seq))
+        return len(data)
+
+    def reply(self, reply_type, ident, seq):
+        data = struct.pack('!BBHHH', reply_type, 0, 0, ident, seq)
+        if self.sock_type == socket.SOCK_RAW:
+            data = b'\x45' + b'\x00' * 19 + data
+        return data
+
+    def close(self):
+        self.sock.close()
+        self.peer.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class TestPingHostsAsync(unittest.TestCase):
+    def setUp(self):
+        self.replies = {}
+        self.sockets = []
+
+        def socket_factory(*args):
+            sock = FakeICMPSocket(*args, replies=self.replies)
+            self.sockets.append(sock)
+            return sock
+
+        module = types.SimpleNamespace(**vars(socket))
+        module.socket = socket_factory
+        start_patches(
+            self,
+            mock.patch.object(ping, 'socket', module),
+            mock.patch.object(ping, 'PING_INTERVAL', 0.01),
+            mock.patch.object(ping, 'PING_TIMEOUT', 0.2),
+        )
+
+    def ping_hosts(self, hosts, sock_type=socket.SOCK_DGRAM):
+        with mock.patch.object(ping, 'icmp_socket_type',
+                               return_value=sock_type):
+            return ping.ping_hosts(hosts, pkts=4, concurrency=2)
+
+    def test_ping(self):
+        for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            results = self.ping_hosts(['127.0.0.1', '127.0.0.2'], sock_type)
+            self.assertEqual(set(results), {'127.0.0.1', '127.0.0.2'})
+            result = results['127.0.0.1']
+            self.assertEqual(result['destination'], '127.0.0.1')
+            self.assertEqual(result['packet_transmit'], 4)
+            self.assertEqual(result['packet_receive'], 4)
+            self.assertEqual(result['packet_loss_rate'], 0)
+            self.assertLessEqual(result['rtt_min'], result['rtt_avg'])
+            self.assertLessEqual(result['rtt_avg'], result['rtt_max'])
+        self.assertTrue(all(sock.sock._closed for sock in self.sockets))
+
+    def test_loss_and_duplicates(self):
+        self.replies['127.0.0.1'] = {1: 0, 2: 0, 3: 2}
+        self.replies['127.0.0.2'] = {0: 0, 1: 0, 2: 0, 3: 0}
+        results = self.ping_hosts(['127.0.0.1', '127.0.0.2'])
+        lossy = results['127.0.0.1']
+        self.assertEqual(lossy['packet_receive'], 2)
+        self.assertEqual(lossy['packet_loss_count'], 2)
+        self.assertEqual(lossy['packet_loss_rate'], 50.0)
+        self.assertEqual(lossy['packet_duplicate_count'], 1)
+        self.assertEqual(lossy['packet_duplicate_rate'], 50.0)
+        unreachable = results['127.0.0.2']
+        self.assertEqual(unreachable['packet_receive'], 0)
+        self.assertEqual(unreachable['packet_loss_rate'], 100.0)
+        self.assertIsNone(unreachable['rtt_avg'])
+        self.assertIsNone(format_ping_result(unreachable)['rtt_avg'])
+
+    def test_error(self):
+        with mock.patch.object(FakeICMPSocket, 'connect',
+                               side_effect=PermissionError()):
+            self.assertEqual(self.ping_hosts(['127.0.0.1']), {})
+
+    def test_echo_request(self):
+        request = ping._echo_request(socket.AF_INET, 1234, 5)
+        self.assertEqual(ping._checksum(request), 0)
+        self.assertEqual(struct.unpack('!BBHHH', request[:8])[3:], (1234, 5))
+        request = ping._echo_request(socket.AF_INET6, 1234, 5)
+        self.assertEqual(request[0], ping.ICMPV6_ECHO_REQUEST)
+
+    def test_echo_reply(self):
+        reply = struct.pack('!BBHHH', ping.ICMP_ECHO_REPLY, 0, 0, 7, 3)
+        self.assertEqual(ping._echo_reply(socket.AF_INET, socket.SOCK_DGRAM,
+                                          reply), (7, 3))
+        self.assertEqual(ping._echo_reply(socket.AF_INET, socket.SOCK_RAW,
+                                          b'\x46' + b'\x00' * 23 + reply),
+                         (7, 3))
+        self.assertIsNone(ping._echo_reply(socket.AF_INET6,
+                                           socket.SOCK_DGRAM, reply))
+        self.assertIsNone(ping._echo_reply(socket.AF_INET,
+                                           socket.SOCK_DGRAM, reply[:6]))
+
+
+@unittest.skipUnless(ping.icmp_socket_type(), "Can't open ICMP sockets")
+class TestPingLoopback(unittest.TestCase):
+    def test_ping(self):
+        with mock.patch.object(ping, 'PING_INTERVAL', 0.01):
+            result = ping.ping_hosts(['127.0.0.1'], pkts=3)['127.0.0.1']
+        self.assertEqual(result['packet_receive'], 3)
+
+
+class TestPingProbeBatch(unittest.TestCase):
+    def setUp(self):
+        use_mongomock(self)
+        self.ping_hosts = mock.Mock(return_value={
+            '10.0.0.1': ping._ping_result('10.0.0.1', 4, [1, 2, 3]),
+            'm2.example.com': ping._ping_result('m2.example.com', 4, []),
+        })
+        self.publish = mock.Mock()
+        start_patches(
+            self,
+            mock.patch.object(ping, 'ping_hosts', self.ping_hosts),
+            mock.patch('mist.api.helpers.amqp_publish_user', self.publish),
+        )
+        for cloud_id, enabled in (('c1', True), ('c2', False)):
+            AmazonCloud._get_collection().insert_one(
+                {'_id': cloud_id, '_cls': AmazonCloud._class_name,
+                 'owner': 'o-' + cloud_id, 'enabled': enabled})
+        self.old_probe = PingProbe(rtt_avg=1, packets_tx=1, packets_rx=1,
+                                   packets_loss=0)
+        machines = [
+            ('m1', 'c1', {'private_ips': ['10.0.0.1']}),
+            ('m2', 'c1', {'hostname': 'm2.example.com'}),
+            ('m3', 'c1', {'public_ips': ['10.0.0.3'],
+                          'ping_probe': self.old_probe.to_mongo()}),
+            ('m4', 'c1', {'public_ips': ['10.0.0.4']}),
+            ('m5', 'c1', {'hostname': 'localhost'}),
+            ('m6', 'c1', {}),
+            ('m7', 'c2', {'public_ips': ['10.0.0.7']}),
+            ('m8', 'c1', {'public_ips': ['10.0.0.8'], 'state': 'stopped'}),
+        ]
+        self.schedules = {}
+        for machine_id, cloud_id, fields in machines:
+            Machine._get_collection().insert_one(dict(
+                fields, _id=machine_id, cloud=cloud_id,
+                external_id='i-' + machine_id))
+            self.schedules[machine_id] = str(ObjectId())
+            PingProbeMachinePollingSchedule._get_collection().insert_one({
+                '_id': ObjectId(self.schedules[machine_id]),
+                'name': 'ping-' + machine_id, 'machine_id': machine_id,
+                '_cls': PingProbeMachinePollingSchedule._class_name})
+
+    def probe(self, machine_id):
+        return Machine.objects.get(id=machine_id).ping_probe
+
+    def test_results_mapped_to_machines(self):
+        ping_probe_batch(list(self.schedules.values()))
+        self.assertEqual(sorted(self.ping_hosts.call_args[0][0]),
+                         ['10.0.0.1', '10.0.0.3', '10.0.0.4',
+                          'm2.example.com'])
+        self.assertEqual(self.probe('m1').packets_rx, 3)
+        self.assertEqual(self.probe('m1').rtt_avg, 2)
+        self.assertEqual(self.probe('m2').packets_loss, 100)
+        self.assertIsNotNone(self.probe('m3').unreachable_since)
+        self.assertEqual(self.probe('m3').rtt_avg, 1)
+        for machine_id in ('m4', 'm5', 'm6', 'm7', 'm8'):
+            self.assertIsNone(self.probe(machine_id))
+
+        self.publish.assert_called_once()
+        owner_id = self.publish.call_args[0][0]
+        data = self.publish.call_args[1]['data']
+        self.assertEqual(owner_id, 'o-c1')
+        self.assertEqual(data['cloud_id'], 'c1')
+        self.assertEqual({op['path'].split('/')[1] for op in data['patch']},
+                         {'m1-i-m1', 'm2-i-m2', 'm3-i-m3'})
+
+    def test_unchanged_not_published(self):
+        self.ping_hosts.return_value = {}
+        ping_probe_batch([self.schedules['m4']])
+        self.assertIsNone(self.probe('m4'))
+        self.publish.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
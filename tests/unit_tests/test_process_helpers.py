@@ -0,0 +1,91 @@
+import threading
+import unittest
+
+from unittest import mock
+
+from mist.api.concurrency import process
+
+
+class FakeCache(process.InvalidatedCache):
+    exchange = 'fake_cache_invalidation'
+
+    def _on_invalidate(self, message):
+        self.pop(message['key'])
+
+
+class TestProcessThread(unittest.TestCase):
+    def setUp(self):
+        self.stop = threading.Event()
+        self.thread = process.ProcessThread(self.stop.wait, 'TestThread')
+        self.addCleanup(self.stop.set)
+
+    def test_started_once_per_process(self):
+        on_start = mock.Mock()
+        self.thread.ensure(on_start)
+        first = self.thread.thread
+        self.thread.ensure(on_start)
+        self.assertIs(self.thread.thread, first)
+        self.assertEqual(on_start.call_count, 1)
+        with mock.patch('os.getpid', return_value=-1):
+            self.thread.ensure(on_start)
+            self.assertIsNot(self.thread.thread, first)
+            self.assertTrue(self.thread.is_running())
+        self.assertEqual(on_start.call_count, 2)
+
+    def test_restarted_when_dead(self):
+        self.thread.ensure()
+        self.stop.set()
+        self.thread.thread.join()
+        self.stop.clear()
+        self.thread.ensure()
+        self.assertTrue(self.thread.is_running())
+
+
+class TestInvalidatedCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeCache(2, 60)
+        self.cache._ensure_listener = mock.Mock()
+
+    def test_lru(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(list(self.cache.entries), ['a', 'c'])
+
+    def test_ttl(self):
+        self.cache.set('a', 1)
+        with mock.patch('time.time', return_value=10 ** 10):
+            self.assertIsNone(self.cache.get('a'))
+        self.assertNotIn('a', self.cache.entries)
+
+    def test_disabled(self):
+        cache = FakeCache(0, 60)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        cache = FakeCache(2, 0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_cleared_in_new_process(self):
+        self.cache.set('a', 1)
+        del self.cache._ensure_listener
+        self.cache.listener.target = mock.Mock()
+        self.cache.set('b', 2)
+        self.assertEqual(list(self.cache.entries), ['b'])
+
+    def test_listen(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+
+        def subscribe(exchange, callback):
+            self.assertEqual(exchange, FakeCache.exchange)
+            callback({'key': 'a'}, None)
+            raise ConnectionError()
+
+        with mock.patch('mist.api.helpers.amqp_subscribe', subscribe), \
+                mock.patch('time.sleep', side_effect=StopIteration):
+            self.cache.clear = mock.Mock(wraps=self.cache.clear)
+            self.assertRaises(StopIteration, self.cache._listen)
+        self.cache.clear.assert_called_once_with()
+        self.assertEqual(self.cache.entries, {})
@@ -0,0 +1,137 @@
+import unittest
+
+from unittest import mock
+
+from mist.api import methods
+from mist.api.clouds.models import Cloud, CloudLocation
+from mist.api.machines.models import Machine, KeyMachineAssociation
+from mist.api.tag.models import Tag
+from mist.api.users.models import Organization
+
+
+class Cursor(object):
+    """A pymongo cursor over a list of documents"""
+
+    def __init__(self, docs):
+        self.docs = iter(docs)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.docs)
+
+    def __getattr__(self, name):
+        # Options like limit or hint return the cursor itself.
+        return lambda *args, **kwargs: self
+
+
+def clauses(query):
+    """Return the clauses of a query as a list"""
+    if '$and' in query:
+        return query['$and']
+    return [{key: value} for key, value in query.items()]
+
+
+def collection(*results):
+    """Return a collection whose finds return each of the given results"""
+    coll = mock.MagicMock()
+    coll.find.side_effect = [Cursor(docs) for docs in results]
+    return coll
+
+
+class TestQueryResources(unittest.TestCase):
+    def setUp(self):
+        self.org = Organization(id='a' * 32, name='org')
+        self.auth_context = mock.Mock(org=self.org, owner=self.org)
+        clouds = [{'_id': 'c1', '_cls': 'Cloud.AmazonCloud'}]
+        self.collections = {
+            Cloud: collection(clouds, clouds),
+            CloudLocation: collection([{'_id': 'l1'}], [{'_id': 'l2'}]),
+            Machine: collection([{'_id': 'm1'}, {'_id': 'm2'}]),
+            KeyMachineAssociation: mock.MagicMock(),
+            Tag: mock.MagicMock(),
+        }
+        self.patches = [mock.patch.object(model, '_get_collection',
+                                          return_value=coll)
+                        for model, coll in self.collections.items()]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def query(self, search='', tags=''):
+        self.subqueries = []
+        result = methods._query_resources(self.auth_context, 'machine',
+                                          search=search, tags=tags,
+                                          subqueries=self.subqueries)
+        return clauses(result._query)
+
+    def test_compile_search(self):
+        self.assertEqual(methods.compile_search(
+            'cloud:"aws" location:eu key_associations:root tag:env,prod'), (
+            ('cloud', '', 'aws', False),
+            ('location', '__contains', 'eu', False),
+            ('key_associations', '__contains', 'root', False),
+            ('tag', '__contains', 'env,prod', False),
+        ))
+
+    def test_cloud(self):
+        query = self.query('cloud:"aws"')
+        self.assertIn({'cloud': {'$in': ['c1']}}, query)
+        subquery = self.subqueries[-1]
+        self.assertEqual(subquery['resource_type'], 'cloud')
+        name_query = clauses(subquery['query'])[-1]['$or']
+        self.assertCountEqual(name_query, [{'_id': 'aws'}, {'name': 'aws'},
+                                           {'tags': 'aws'}])
+
+    def test_location(self):
+        query = self.query('location:"eu"')
+        # Children of the matching locations are included as well.
+        self.assertIn({'location': {'$in': ['l1', 'l2']}}, query)
+        self.assertEqual(self.subqueries[-1]['resource_type'], 'location')
+
+    def test_key_associations(self):
+        associations = self.collections[KeyMachineAssociation]
+        associations.distinct.return_value = ['m1']
+        query = self.query('key_associations:root')
+        self.assertIn({'_id': {'$in': ['m1']}}, query)
+        association_query = {'machine': {'$in': ['m1', 'm2']},
+                             'ssh_user': 'root',
+                             '_cls': 'KeyMachineAssociation'}
+        associations.distinct.assert_called_once_with('machine',
+                                                      association_query)
+        self.assertEqual(self.subqueries[-1],
+                         {'resource_type': 'key_association',
+                          'query': association_query})
+
+    def test_without_key_associations(self):
+        self.collections[KeyMachineAssociation].distinct.return_value = [
+            'm1']
+        query = self.query('key_associations:false')
+        self.assertIn({'_id': {'$nin': ['m1']}}, query)
+
+    def test_tag_term(self):
+        query = self.query('tag:env,prod')
+        self.assertIn({'$text': {'$search': '"env:prod"'}}, query)
+        query = self.query('tag:env')
+        self.assertIn({'$text': {'$search': '"env:"'}}, query)
+
+    def test_tags(self):
+        tags = self.collections[Tag]
+        tags.aggregate.return_value = [{'_id': 'm1'}]
+        query = self.query(tags='env=prod,team=ops')
+        self.assertIn({'_id': {'$in': ['m1']}}, query)
+        pipeline = tags.aggregate.call_args[0][0]
+        match = clauses(pipeline[0]['$match'])
+        self.assertIn({'resource_type': 'machine'}, match)
+        self.assertIn({'owner': self.org.id}, match)
+        self.assertIn({'$or': [{'key': 'env', 'value': 'prod'},
+                               {'key': 'team', 'value': 'ops'}]}, match)
+        self.assertEqual(pipeline[2], {'$match': {'keys': {'$size': 2}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
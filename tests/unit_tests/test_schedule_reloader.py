@@ -0,0 +1,81 @@
+import time
+import datetime
+import unittest
+
+from unittest import mock
+
+from mist.api import scheduler
+from mist.api.schedules.models import Schedule
+
+
+class FakeQuerySet(list):
+    def filter(self, id__in):
+        return FakeQuerySet(item for item in self if item.id in id__in)
+
+
+class TestScheduleReloader(unittest.TestCase):
+    def setUp(self):
+        self.schedule = Schedule(name='s', task_enabled=True,
+                                 max_run_count=2, total_run_count=1)
+        self.jobs = set()
+        patches = [
+            mock.patch.object(Schedule, 'get_resources',
+                              return_value=mock.Mock(count=lambda: 1)),
+            mock.patch.object(scheduler, 'load_schedule', self.load),
+            mock.patch.object(scheduler, 'remove_job', self.remove),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.reloader = scheduler.ScheduleReloader(
+            'user schedules', None, lambda: FakeQuerySet([self.schedule]),
+            ignored_fields=('shard_update_at', 'last_run_at'))
+        # Act as if the change stream is being watched.
+        self.reloader.thread = mock.Mock()
+        self.reloader.reload(first_run=True)
+        self.reloader.watching = True
+        self.assertEqual(self.jobs, {self.schedule.id})
+
+    def load(self, _, schedule, first_run=False):
+        if not schedule.enabled:
+            return False
+        self.jobs.add(schedule.id)
+        return True
+
+    def remove(self, _, schedule_id):
+        self.jobs.discard(schedule_id)
+
+    def pipeline_ignored_fields(self):
+        pipeline = self.reloader._pipeline()
+        relevant = pipeline[0]['$match']['$or'][2]['$expr']['$gt'][0]
+        return relevant['$size']['$filter']['cond']['$not'][0]['$in'][1]
+
+    def test_max_run_count(self):
+        self.assertNotIn('total_run_count', self.pipeline_ignored_fields())
+        self.schedule.total_run_count = 2
+        # The change stream reports the update of the run count.
+        self.reloader.changed_ids.add(self.schedule.id)
+        self.reloader.reload()
+        self.assertEqual(self.reloader.full_reload_count, 1)
+        self.assertEqual(self.jobs, set())
+        self.assertEqual(self.reloader.schedule_ids, [])
+
+    def test_expires(self):
+        self.schedule.expires = datetime.datetime.now() + \
+            datetime.timedelta(seconds=0.2)
+        self.reloader.resync = True
+        self.reloader.reload()
+        self.assertEqual(self.jobs, {self.schedule.id})
+        time.sleep(0.3)
+        self.reloader.reload()
+        self.assertEqual(self.reloader.full_reload_count, 2)
+        self.assertEqual(self.jobs, set())
+
+    def test_polling_schedules(self):
+        reloader = scheduler.ScheduleReloader('polling schedules', None,
+                                              FakeQuerySet)
+        self.assertIn('total_run_count', reloader.ignored_fields)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+
+from mist.api.scripts import base, cache
+from mist.api.scripts.base import BaseScriptController
+from mist.api.scripts.cache import ScriptArtifactCache
+
+from .helpers import start_server
+
+
+TARBALL = b'\x1f\x8b' + b'x' * 1000
+
+
+class FakeGithubHandler(BaseHTTPRequestHandler):
+    """Serve a repo with a single commit, its tarball and a plain script"""
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests[self.path] += 1
+        sha = self.server.sha
+        etag = '"%s"' % sha
+        if self.path.startswith('/repos/owner/repo/commits/'):
+            if self.headers.get('If-None-Match') == etag:
+                return self.reply(304)
+            return self.reply(200, sha.encode(), {'ETag': etag})
+        if self.path == '/repos/owner/repo/tarball/%s' % sha:
+            return self.reply(302, headers={
+                'Location': '/codeload/owner/repo/%s' % sha})
+        if self.path == '/codeload/owner/repo/%s' % sha:
+            return self.reply(200, TARBALL, {
+                'Content-Type': 'application/x-gzip',
+                'Content-Disposition':
+                    'attachment; filename=owner-repo-%s.tar.gz' % sha})
+        if self.path == '/script.sh':
+            if self.headers.get('If-None-Match') == etag:
+                return self.reply(304)
+            return self.reply(200, b'#!/bin/sh\necho ' + sha.encode(), {
+                'Content-Type': 'text/x-sh', 'ETag': etag})
+        return self.reply(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestScriptArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server(self, FakeGithubHandler,
+                                   server_class=ThreadingHTTPServer,
+                                   requests=Counter(), sha='a' * 40)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.cache = ScriptArtifactCache(self.path, 10 * 1024, 60,
+                                         github_api_url=self.url)
+
+    def count(self, path):
+        return self.server.requests[path]
+
+    def read(self, result):
+        meta, file = result
+        with file:
+            return meta, file.read()
+
+    def test_concurrent_github_downloads(self):
+        results = []
+
+        def fetch():
+            results.append(self.read(self.cache.github_file(
+                'https://github.com/owner/repo')))
+
+        threads = [threading.Thread(target=fetch) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 20)
+        for meta, body in results:
+            self.assertEqual(body, TARBALL)
+            self.assertEqual(meta['size'], len(TARBALL))
+        self.assertEqual(self.count('/repos/owner/repo/commits/HEAD'), 1)
+        self.assertEqual(self.count('/codeload/owner/repo/' + 'a' * 40), 1)
+
+    def test_new_commit(self):
+        self.cache.ref_ttl = 0
+        self.read(self.cache.github_file('owner/repo'))
+        self.read(self.cache.github_file('owner/repo'))
+        self.assertEqual(self.count('/repos/owner/repo/commits/HEAD'), 2)
+        self.assertEqual(self.count('/codeload/owner/repo/' + 'a' * 40), 1)
+        self.server.sha = 'b' * 40
+        self.read(self.cache.github_file('owner/repo'))
+        self.assertEqual(self.count('/codeload/owner/repo/' + 'b' * 40), 1)
+
+    def test_url_etag(self):
+        url = self.url + '/script.sh'
+        for _ in range(3):
+            meta, body = self.read(self.cache.url_file(url))
+        self.assertEqual(body, b'#!/bin/sh\necho ' + b'a' * 40)
+        self.assertEqual(self.count('/script.sh'), 1)
+        self.cache.ref_ttl = 0
+        meta, body = self.read(self.cache.url_file(url))
+        self.assertEqual(self.count('/script.sh'), 2)
+        self.assertEqual(body, b'#!/bin/sh\necho ' + b'a' * 40)
+        self.server.sha = 'b' * 40
+        meta, body = self.read(self.cache.url_file(url))
+        self.assertEqual(body, b'#!/bin/sh\necho ' + b'b' * 40)
+
+    def test_eviction(self):
+        self.cache.size = len(TARBALL) * 2
+        for sha in ('a', 'b', 'c'):
+            self.server.sha = sha * 40
+            self.cache.ref_ttl = 0
+            self.read(self.cache.github_file('owner/repo/tree/main'))
+        self.server.requests.clear()
+        self.server.sha = 'a' * 40
+        self.read(self.cache.github_file('owner/repo/tree/main'))
+        self.assertEqual(self.count('/codeload/owner/repo/' + 'a' * 40), 1)
+        self.server.sha = 'c' * 40
+        self.read(self.cache.github_file('owner/repo/tree/main'))
+        self.assertEqual(self.count('/codeload/owner/repo/' + 'c' * 40), 0)
+
+    def test_stale_files(self):
+        self.cache.size = len(TARBALL)
+        self.read(self.cache.github_file('owner/repo'))
+        self.read(self.cache.github_file('owner/repo/tree/main'))
+        with open(os.path.join(self.path, 'x.tmp'), 'w'):
+            pass
+        stale = time.time() - cache.STALE_FILE_AGE - 1
+        for name in os.listdir(self.path):
+            os.utime(os.path.join(self.path, name), (stale, stale))
+        self.server.sha = 'b' * 40
+        self.cache.ref_ttl = 0
+        self.read(self.cache.github_file('owner/repo'))
+        # Only the new tarball, the commit of the default branch and their
+        # locks are left.
+        self.assertEqual(sorted(os.path.splitext(name)[1]
+                                for name in os.listdir(self.path)),
+                         ['.bin', '.json', '.json', '.lock', '.lock'])
+
+    def test_private_dir(self):
+        path = os.path.join(self.path, 'cache')
+        self.cache = ScriptArtifactCache(path, 10 * 1024, 60,
+                                         github_api_url=self.url)
+        self.read(self.cache.github_file('owner/repo'))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+        self.assertTrue(os.listdir(path))
+
+    def test_shared_dir(self):
+        os.chmod(self.path, 0o777)
+        for _ in range(2):
+            meta, body = self.read(self.cache.github_file('owner/repo'))
+            self.assertEqual(body, TARBALL)
+        self.assertFalse(self.cache.enabled)
+        self.assertEqual(os.listdir(self.path), [])
+        self.assertEqual(self.count('/codeload/owner/repo/' + 'a' * 40), 2)
+
+    def test_disabled(self):
+        self.cache.size = 0
+        for _ in range(2):
+            meta, body = self.read(self.cache.github_file('owner/repo'))
+            self.assertEqual(body, TARBALL)
+        self.assertEqual(self.count('/codeload/owner/repo/' + 'a' * 40), 2)
+
+    def test_get_file(self):
+        script = mock.Mock()
+        script.location.type = 'github'
+        script.location.repo = 'https://github.com/owner/repo'
+        with mock.patch.object(base, 'artifact_cache', self.cache):
+            for _ in range(2):
+                kwargs = BaseScriptController(script).get_file()
+                self.assertEqual(b''.join(kwargs['app_iter']), TARBALL)
+        self.assertEqual(kwargs['content_disposition'],
+                         'attachment; filename=owner-repo-%s.tar.gz'
+                         % ('a' * 40))
+        self.assertEqual(kwargs['content_length'], len(TARBALL))
+        self.assertEqual(self.count('/codeload/owner/repo/' + 'a' * 40), 1)
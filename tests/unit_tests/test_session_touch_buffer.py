@@ -0,0 +1,86 @@
+import datetime
+import unittest
+
+from unittest import mock
+
+from mist.api.auth.middleware import SessionTouchBuffer
+from mist.api.auth.models import ApiToken, SessionToken
+
+from .helpers import start_patches, use_mongomock
+
+
+class TestSessionTouchBuffer(unittest.TestCase):
+    def setUp(self):
+        use_mongomock(self)
+        self.atexit = mock.Mock()
+        start_patches(
+            self,
+            mock.patch('mist.api.auth.middleware.atexit.register',
+                       self.atexit),
+            mock.patch('mist.api.auth.middleware.ProcessThread.ensure',
+                       lambda thread, on_start: on_start()),
+            mock.patch('mist.api.helpers.amqp_publish'),
+        )
+        self.buffer = SessionTouchBuffer(10)
+        self.accessed_at = datetime.datetime.utcnow() - \
+            datetime.timedelta(minutes=1)
+        self.session = SessionToken(user_id='u1', timeout=3600,
+                                    last_accessed_at=self.accessed_at)
+        self.session.save()
+
+    def loaded(self, token_cls=SessionToken, token_id=None):
+        return token_cls.objects.get(id=token_id or self.session.id)
+
+    def stored_accessed_at(self, token_cls=SessionToken, token_id=None):
+        return token_cls._get_collection().find_one(
+            {'_id': token_id or self.session.id})['last_accessed_at']
+
+    def test_buffered(self):
+        session = self.loaded()
+        self.buffer.touch(session)
+        self.assertEqual(self.stored_accessed_at().replace(microsecond=0),
+                         self.accessed_at.replace(microsecond=0))
+        self.assertEqual(len(self.buffer.entries), 1)
+        self.buffer.flush()
+        self.assertEqual(self.buffer.entries, {})
+        self.assertEqual(self.stored_accessed_at().replace(microsecond=0),
+                         session.last_accessed_at.replace(microsecond=0))
+
+    def test_flush_keeps_latest(self):
+        api_token = ApiToken(user_id='u1', name='t',
+                             last_accessed_at=self.accessed_at)
+        api_token.save()
+        self.buffer.touch(self.loaded())
+        self.buffer.touch(self.loaded(ApiToken, api_token.id))
+        # A process that wrote through meanwhile stored a later time.
+        later = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        SessionToken.objects(id=self.session.id).update(
+            last_accessed_at=later)
+        self.buffer.flush()
+        self.assertEqual(self.stored_accessed_at().replace(microsecond=0),
+                         later.replace(microsecond=0))
+        self.assertGreater(self.stored_accessed_at(ApiToken, api_token.id),
+                           self.accessed_at)
+
+    def test_write_through_near_timeout(self):
+        # Only 15s left, less than two flush intervals.
+        SessionToken.objects(id=self.session.id).update(timeout=75)
+        session = self.loaded()
+        self.buffer.touch(session)
+        self.assertEqual(self.buffer.entries, {})
+        self.assertGreater(self.stored_accessed_at(), self.accessed_at)
+
+    def test_write_through_other_changes(self):
+        session = self.loaded()
+        session.user_agent = 'test'
+        self.buffer.touch(session)
+        self.assertEqual(self.buffer.entries, {})
+        self.assertEqual(self.loaded().user_agent, 'test')
+        self.assertGreater(self.stored_accessed_at(), self.accessed_at)
+
+    def test_flush_at_exit(self):
+        self.buffer.touch(self.loaded())
+        self.atexit.assert_called_once_with(self.buffer.flush)
+        self.atexit.call_args[0][0]()
+        self.assertEqual(self.buffer.entries, {})
+        self.assertGreater(self.stored_accessed_at(), self.accessed_at)
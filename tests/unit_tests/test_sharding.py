@@ -0,0 +1,43 @@
+import unittest
+
+from mist.api.sharding.methods import assign_shard
+
+
+class TestAssignShard(unittest.TestCase):
+    keys = ['%032x' % i for i in range(5000)]
+
+    def test_no_shards(self):
+        self.assertIsNone(assign_shard('key', []))
+
+    def test_independent_of_order(self):
+        for key in self.keys[:100]:
+            self.assertEqual(assign_shard(key, ['a', 'b', 'c']),
+                             assign_shard(key, ['c', 'a', 'b']))
+
+    def test_balanced(self):
+        shards = ['a', 'b', 'c', 'd']
+        counts = {shard: 0 for shard in shards}
+        for key in self.keys:
+            counts[assign_shard(key, shards)] += 1
+        for count in counts.values():
+            self.assertAlmostEqual(count / len(self.keys), 0.25, delta=0.03)
+
+    def test_join_moves_keys_to_new_shard_only(self):
+        before = {key: assign_shard(key, ['a', 'b', 'c', 'd'])
+                  for key in self.keys}
+        after = {key: assign_shard(key, ['a', 'b', 'c', 'd', 'e'])
+                 for key in self.keys}
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(all(after[key] == 'e' for key in moved))
+        self.assertAlmostEqual(len(moved) / len(self.keys), 0.2, delta=0.03)
+
+    def test_leave_moves_keys_of_gone_shard_only(self):
+        before = {key: assign_shard(key, ['a', 'b', 'c', 'd'])
+                  for key in self.keys}
+        after = {key: assign_shard(key, ['a', 'b', 'c']) for key in self.keys}
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(all(before[key] == 'd' for key in moved))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import datetime
+import unittest
+
+from unittest import mock
+
+from mist.api.clouds import views
+from mist.api.clouds.models import AmazonCloud, CloudLocation, CloudSize
+from mist.api.clouds.snapshot import RESOURCE_TYPES, build_snapshot
+from mist.api.containers.methods import filter_list_clusters
+from mist.api.containers.models import AmazonCluster
+from mist.api.dns.methods import filter_list_zones
+from mist.api.dns.models import ARecord, Zone
+from mist.api.exceptions import BadRequestError, PolicyUnauthorizedError
+from mist.api.images.methods import filter_list_images
+from mist.api.images.models import CloudImage
+from mist.api.machines.methods import filter_list_machines
+from mist.api.machines.models import Machine
+from mist.api.methods import filter_list_locations
+from mist.api.networks.methods import filter_list_networks
+from mist.api.networks.models import AmazonNetwork
+from mist.api.objectstorage.methods import filter_list_buckets
+from mist.api.objectstorage.models import Bucket
+from mist.api.users.models import Organization
+from mist.api.volumes.methods import filter_list_volumes
+from mist.api.volumes.models import Volume
+
+from .helpers import start_patches, use_mongomock
+
+
+def insert(*docs):
+    """Store documents as they are, without their save hooks"""
+    for doc in docs:
+        type(doc)._get_collection().insert_one(doc.to_mongo())
+
+
+class FakeAuthContext(object):
+    """An auth context allowed to read only the `allowed` resources"""
+
+    def __init__(self, owner, allowed=None):
+        self.owner = owner
+        self.allowed = allowed
+
+    def is_owner(self):
+        return self.allowed is None
+
+    def check_perm(self, rtype, action, rid):
+        if not self.is_owner() and \
+                rid not in self.allowed.get(rtype + 's', []):
+            raise PolicyUnauthorizedError(rtype, action, rid)
+
+    def get_allowed_resources(self, action='read', rtype=None):
+        if rtype:
+            return list(self.allowed.get(rtype, []))
+        return {key: list(value) for key, value in self.allowed.items()}
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        use_mongomock(self)
+        start_patches(
+            self, mock.patch('mist.api.helpers.amqp_publish_user'))
+        now = datetime.datetime.utcnow()
+        self.org = Organization(id='o' * 32, name='org')
+        self.clouds = [
+            AmazonCloud(id=cloud_id * 32, owner=self.org, name=cloud_id,
+                        enabled=True, dns_enabled=True,
+                        container_enabled=True, object_storage_enabled=True)
+            for cloud_id in 'ab']
+        insert(self.org, *self.clouds)
+        for cloud in self.clouds:
+            for i in range(2):
+                rid = '%s%d' % (cloud.name, i)
+                zone = Zone(id='z' + rid, owner=self.org, cloud=cloud,
+                            external_id=rid, domain=rid + '.com.', type='m')
+                insert(
+                    Machine(id='m' + rid, owner=self.org, cloud=cloud,
+                            external_id=rid, name=rid, last_seen=now),
+                    AmazonCluster(id='k' + rid, owner=self.org, cloud=cloud,
+                                  external_id=rid, name=rid, last_seen=now),
+                    CloudLocation(id='l' + rid, owner=self.org, cloud=cloud,
+                                  external_id=rid, name=rid),
+                    CloudSize(id='s' + rid, cloud=cloud, external_id=rid,
+                              name=rid),
+                    CloudImage(id='i' + rid, cloud=cloud, external_id=rid,
+                               name=rid),
+                    AmazonNetwork(id='n' + rid, owner=self.org, cloud=cloud,
+                                  external_id=rid, name=rid),
+                    zone,
+                    ARecord(id='r' + rid, owner=self.org, zone=zone,
+                            external_id=rid, name=rid, type='A',
+                            rdata=['10.0.0.1']),
+                    ARecord(id='q' + rid, owner=self.org, zone=zone,
+                            external_id='q' + rid, name='q' + rid, type='A',
+                            rdata=['10.0.0.2']),
+                    Volume(id='v' + rid, owner=self.org, cloud=cloud,
+                           external_id=rid, name=rid, last_seen=now),
+                    Bucket(id='b' + rid, owner=self.org, cloud=cloud,
+                           name=rid),
+                )
+        # A user who may read only the first cloud, but the first resource
+        # of each type of both clouds.
+        allowed = {'clouds': [self.clouds[0].id], 'records': ['ra0', 'rb0']}
+        for rtype, prefix in zip(RESOURCE_TYPES, 'mklsinzvb'):
+            allowed[rtype] = [prefix + 'a0', prefix + 'b0']
+        self.auth_context = FakeAuthContext(self.org, allowed)
+
+    def list_cached(self, auth_context, cloud):
+        """Return the cached resources as the per section endpoints do"""
+        return {
+            'machines': filter_list_machines(auth_context, cloud.id,
+                                             cached=True),
+            'clusters': filter_list_clusters(auth_context, cloud.id,
+                                             cached=True),
+            'locations': filter_list_locations(auth_context, cloud.id,
+                                               cached=True, extra=False),
+            'sizes': [size.as_dict(extra=False)
+                      for size in cloud.ctl.compute.list_cached_sizes()],
+            'images': filter_list_images(auth_context, cloud.id,
+                                         cached=True, extra=False),
+            'networks': filter_list_networks(auth_context, cloud.id,
+                                             cached=True),
+            'zones': filter_list_zones(auth_context, cloud.id, cached=True),
+            'volumes': filter_list_volumes(auth_context, cloud.id,
+                                           cached=True),
+            'buckets': filter_list_buckets(auth_context, cloud.id,
+                                           cached=True),
+        }
+
+    def test_rbac_limited_user(self):
+        snapshot = build_snapshot(self.auth_context)
+        cloud = self.clouds[0]
+        self.assertEqual([c['id'] for c in snapshot['clouds']], [cloud.id])
+        expected = self.list_cached(self.auth_context, cloud)
+        for rtype in RESOURCE_TYPES:
+            self.assertEqual(snapshot[rtype], {cloud.id: expected[rtype]},
+                             rtype)
+            if rtype != 'sizes':
+                self.assertEqual(len(expected[rtype]), 1, rtype)
+        self.assertEqual(list(expected['zones'][0]['records']), ['ra0'])
+
+    def test_owner(self):
+        auth_context = FakeAuthContext(self.org)
+        snapshot = build_snapshot(auth_context)
+        for cloud in self.clouds:
+            expected = self.list_cached(auth_context, cloud)
+            for rtype in RESOURCE_TYPES:
+                self.assertEqual(snapshot[rtype][cloud.id], expected[rtype],
+                                 rtype)
+                self.assertEqual(len(expected[rtype]), 2, rtype)
+
+    def test_view(self):
+        request = mock.Mock()
+        start_patches(
+            self,
+            mock.patch.object(views, 'auth_context_from_request',
+                              return_value=self.auth_context),
+            mock.patch.object(views, 'params_from_request',
+                              return_value={
+                                  'resource_types': 'machines, zones'}),
+        )
+        snapshot = views.get_snapshot(request)
+        self.assertEqual(set(snapshot), {'clouds', 'machines', 'zones'})
+        self.assertEqual(snapshot, build_snapshot(
+            self.auth_context, resource_types=('machines', 'zones')))
+        views.params_from_request.return_value = {}
+        self.assertEqual(views.get_snapshot(request),
+                         build_snapshot(self.auth_context))
+        views.params_from_request.return_value = {
+            'resource_types': 'machines,keys'}
+        self.assertRaises(BadRequestError, views.get_snapshot, request)
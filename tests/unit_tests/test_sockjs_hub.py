@@ -0,0 +1,81 @@
+import unittest
+
+from mist.api.sockjs_hub import PatchBuffer
+
+
+class TestPatchBuffer(unittest.TestCase):
+    def test_merge_replace(self):
+        batch = PatchBuffer()
+        batch.extend([
+            {'op': 'replace', 'path': '/clouds/c/machines/a/state',
+             'value': 'stopped'},
+            {'op': 'replace', 'path': '/clouds/c/machines/b/state',
+             'value': 'running'},
+            {'op': 'replace', 'path': '/clouds/c/machines/a/state',
+             'value': 'running'},
+        ])
+        self.assertListEqual(batch.pop_all(), [
+            {'op': 'replace', 'path': '/clouds/c/machines/a/state',
+             'value': 'running'},
+            {'op': 'replace', 'path': '/clouds/c/machines/b/state',
+             'value': 'running'},
+        ])
+        self.assertFalse(batch)
+
+    def test_merge_add_and_replace(self):
+        batch = PatchBuffer()
+        batch.extend([
+            {'op': 'add', 'path': '/clouds/c/machines/a', 'value': {}},
+            {'op': 'replace', 'path': '/clouds/c/machines/a',
+             'value': {'state': 'running'}},
+        ])
+        self.assertListEqual(batch.pop_all(), [
+            {'op': 'add', 'path': '/clouds/c/machines/a',
+             'value': {'state': 'running'}},
+        ])
+
+    def test_keep_add_and_remove(self):
+        ops = [
+            {'op': 'add', 'path': '/clouds/c/machines/a', 'value': {}},
+            {'op': 'remove', 'path': '/clouds/c/machines/a'},
+        ]
+        batch = PatchBuffer()
+        batch.extend(ops)
+        self.assertListEqual(batch.pop_all(), ops)
+
+    def test_keep_array_items(self):
+        ops = [
+            {'op': 'add', 'path': '/clouds/c/machines/a/public_ips/0',
+             'value': '10.0.0.1'},
+            {'op': 'add', 'path': '/clouds/c/machines/a/public_ips/0',
+             'value': '10.0.0.2'},
+        ]
+        batch = PatchBuffer()
+        batch.extend(ops)
+        self.assertListEqual(batch.pop_all(), ops)
+
+    def test_keep_order_of_related_paths(self):
+        ops = [
+            {'op': 'replace', 'path': '/clouds/c/machines/a/state',
+             'value': 'stopped'},
+            {'op': 'replace', 'path': '/clouds/c/machines/a', 'value': {}},
+            {'op': 'replace', 'path': '/clouds/c/machines/a/state',
+             'value': 'running'},
+        ]
+        batch = PatchBuffer()
+        batch.extend(ops)
+        self.assertListEqual(batch.pop_all(), ops)
+
+    def test_keep_order_of_moved_paths(self):
+        ops = [
+            {'op': 'replace', 'path': '/a/x', 'value': 'v1'},
+            {'op': 'move', 'from': '/a/x', 'path': '/b'},
+            {'op': 'add', 'path': '/a/x', 'value': 'v2'},
+        ]
+        batch = PatchBuffer()
+        batch.extend(ops)
+        self.assertListEqual(batch.pop_all(), ops)
+
+
+if __name__ == '__main__':
+    unittest.main()
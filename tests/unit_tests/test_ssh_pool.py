@@ -0,0 +1,164 @@
+import socket
+import threading
+import unittest
+
+from io import StringIO
+from unittest import mock
+
+import paramiko
+
+from mist.api import shell as shell_module
+from mist.api.shell import ParamikoShell, SSHConnectionPool
+from mist.api.methods import probe_ssh_only
+
+
+HOST_KEY = paramiko.RSAKey.generate(2048)
+CLIENT_KEY = paramiko.RSAKey.generate(2048)
+
+PROBE_OUTPUT = '\n--------\n'.join([
+    '1',
+    ' 10:00:00 up 1 day,  2 users,  load average: 0.10, 0.20, 0.30',
+    '86400.00',
+    '2',
+    'eth0: inet 10.0.0.2  netmask 255.255.255.0  ether 02:42:ac:11:00:02',
+    'Filesystem Size Used Avail Use% Mounted on',
+    '5.10.0',
+    'NAME="Debian GNU/Linux"\nVERSION_ID="11"\nID=debian',
+    '',
+])
+
+
+class StubSSHServer(paramiko.ServerInterface):
+    """Accept any public key and reply to every command with `output`"""
+
+    def __init__(self, output):
+        self.output = output
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        # Reply before accepting the request, so that the client doesn't
+        # find the channel closed while waiting for the request to succeed.
+        channel.sendall(self.output.encode())
+        channel.send_exit_status(0)
+        channel.shutdown_write()
+        return True
+
+
+class StubSSHListener(object):
+    """Listen on localhost and count SSH handshakes"""
+
+    def __init__(self, output=PROBE_OUTPUT):
+        self.output = output
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    @property
+    def handshakes(self):
+        return len(self.transports)
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(HOST_KEY)
+            transport.start_server(server=StubSSHServer(self.output))
+            self.transports.append(transport)
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class TestSSHConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = StubSSHListener()
+        self.pool = SSHConnectionPool(idle_ttl=300, keepalive=30,
+                                      max_per_host=2, max_sessions=2)
+        self.patch = mock.patch.object(shell_module, 'ssh_pool', self.pool)
+        self.patch.start()
+        private = StringIO()
+        CLIENT_KEY.write_private_key(private)
+        self.key = mock.Mock(private=mock.Mock(value=private.getvalue()))
+
+    def tearDown(self):
+        self.patch.stop()
+        self.pool.close()
+        self.server.close()
+
+    def connect(self):
+        shell = ParamikoShell('127.0.0.1')
+        shell.connect('root', key=self.key, port=self.server.port)
+        return shell
+
+    def probe(self):
+        shell = self.connect()
+        try:
+            return probe_ssh_only(None, None, None, None, shell=shell)
+        finally:
+            shell.disconnect()
+
+    def test_repeated_probes(self):
+        for _ in range(5):
+            result = self.probe()
+            self.assertEqual(result['cores'], '2')
+            self.assertEqual(result['loadavg'], ['0.10', '0.20', '0.30'])
+        self.assertEqual(self.server.handshakes, 1)
+        self.assertEqual(self.pool.handshakes, 1)
+
+    def test_concurrent_shells(self):
+        shells = [self.connect() for _ in range(3)]
+        for shell in shells:
+            self.assertEqual(shell.command('uptime', pty=False)[0], 0)
+        # Two shells share a connection, the third one gets another.
+        self.assertEqual(self.server.handshakes, 2)
+        for shell in shells:
+            shell.disconnect()
+        shells = [self.connect() for _ in range(4)]
+        self.assertEqual(self.server.handshakes, 2)
+        # Connections over the per host cap are closed once released.
+        extra = self.connect()
+        self.assertEqual(self.server.handshakes, 3)
+        extra.disconnect()
+        self.assertIsNone(extra.ssh.get_transport())
+        for shell in shells:
+            shell.disconnect()
+
+    def test_idle_and_broken_connections(self):
+        self.probe()
+        self.pool.reap(idle_ttl=0)
+        self.probe()
+        self.assertEqual(self.server.handshakes, 2)
+        self.server.transports[-1].close()
+        self.server.transports[-1].join(5)
+        self.pool.connections[list(self.pool.connections)[0]][0].client \
+            .get_transport().join(5)
+        self.probe()
+        self.assertEqual(self.server.handshakes, 3)
+
+    def test_streaming_output(self):
+        chunks = []
+        shell = self.connect()
+        retval, output = shell.command('uptime', callback=chunks.append)
+        shell.disconnect()
+        self.assertEqual(retval, 0)
+        self.assertEqual(output, PROBE_OUTPUT)
+        self.assertEqual(b''.join(chunks).decode(), PROBE_OUTPUT)
@@ -0,0 +1,50 @@
+import json
+import unittest
+
+from mist.api.logs.stories import story_updates, _stories_query
+
+
+EVENT = {
+    'owner_id': 'o1',
+    'log_id': 'l1',
+    'action': 'script_finished',
+    'type': 'job',
+    'time': 100.0,
+    'error': 'Script failed',
+    'job_id': 'j1',
+    'extra': json.dumps({'network_id': 'n1', 'output': 'x'}),
+    'stories': [['closes', 'job', 'j1']],
+}
+
+
+class TestStoryUpdates(unittest.TestCase):
+    def test_closing_event(self):
+        ops = [op._doc for op in story_updates(EVENT)]
+        upsert = ops[0]
+        self.assertEqual(upsert['$setOnInsert']['type'], 'job')
+        self.assertEqual(upsert['$setOnInsert']['error'], 'Script failed')
+        self.assertEqual(upsert['$setOnInsert']['network_id'], 'n1')
+        self.assertNotIn('finished_at', upsert['$setOnInsert'])
+        self.assertEqual(upsert['$max'], {'updated_at': 100.0,
+                                          'finished_at': 100.0})
+        self.assertEqual(upsert['$min'], {'started_at': 100.0})
+        log = upsert['$push']['logs']['$each'][0]
+        self.assertEqual(set(log), {'log_id', 'stories', 'error', 'time'})
+        self.assertIn({'$set': {'error': 'Script failed'}}, ops)
+        self.assertIn({'$set': {'owner_id': 'o1'}}, ops)
+
+    def test_event_without_stories(self):
+        self.assertEqual(story_updates(dict(EVENT, stories=[])), [])
+
+
+class TestStoriesQuery(unittest.TestCase):
+    def test_query(self):
+        query = _stories_query(
+            story_type='incident', owner_id='o1', pending=True, error=False,
+            range={'@timestamp': {'gte': 5000, 'lte': 'now'}},
+            stories='i1', cloud_id='c1', machine_id='')
+        self.assertEqual(query, {
+            'type': 'incident', 'owner_id': 'o1', 'finished_at': 0,
+            'error': False, 'updated_at': {'$gte': 5.0}, '_id': 'i1',
+            'cloud_id': 'c1',
+        })
@@ -0,0 +1,208 @@
+import datetime
+import unittest
+
+from unittest import mock
+
+from mist.api.dns.models import Zone
+from mist.api.exceptions import NotFoundError
+from mist.api.machines.models import Machine
+from mist.api.tag import methods
+from mist.api.tag import tasks
+from mist.api.tag.models import Tag
+from mist.api.users.models import Organization
+
+from .helpers import start_patches, use_mongomock
+
+
+class TestTagResources(unittest.TestCase):
+    def setUp(self):
+        use_mongomock(self)
+        self.send = mock.Mock()
+        start_patches(
+            self,
+            mock.patch.object(tasks.sync_resource_tags, 'send', self.send),
+            mock.patch.object(methods, 'trigger_session_update'),
+            mock.patch.object(Organization, 'mapper'),
+        )
+        self.owner = Organization(name='org')
+        self.owner.save(validate=False)
+        for machine_id in ('m1', 'm2', 'm3'):
+            Machine._get_collection().insert_one(
+                {'_id': machine_id, 'owner': self.owner.id, 'cloud': 'c1',
+                 'external_id': machine_id, 'tags': ''})
+        Machine._get_collection().update_one(
+            {'_id': 'm3'},
+            {'$set': {'missing_since': datetime.datetime.utcnow()}})
+
+    def resources(self, *machine_ids):
+        return [{'resource_type': 'machine', 'resource_id': machine_id}
+                for machine_id in machine_ids]
+
+    def tags(self, machine_id):
+        return {tag.key: tag.value
+                for tag in Tag.objects(resource_id=machine_id)}
+
+    def sync_sent(self):
+        """Run the sync tasks that were sent"""
+        for args, kwargs in self.send.call_args_list:
+            tasks.sync_resource_tags(*args, **kwargs)
+        self.send.reset_mock()
+
+    def test_add_tags(self):
+        methods.add_tags_to_resource(self.owner, self.resources('m1'),
+                                     {'env': 'dev'})
+        tag_id = Tag.objects.get(resource_id='m1', key='env').id
+        methods.add_tags_to_resource(self.owner, self.resources('m1', 'm2'),
+                                     [('env', 'prod'), ('team', 'a')])
+        self.assertEqual(self.tags('m1'), {'env': 'prod', 'team': 'a'})
+        self.assertEqual(self.tags('m2'), {'env': 'prod', 'team': 'a'})
+        self.assertEqual(Tag.objects.count(), 4)
+        self.assertEqual(Tag.objects.get(resource_id='m1', key='env').id,
+                         tag_id)
+        self.send.assert_called_with('machine', ['m1', 'm2'])
+        self.sync_sent()
+        self.assertEqual(Machine.objects.get(id='m1').tags_to_dict(),
+                         {'env': 'prod', 'team': 'a'})
+
+    def test_remove_tags(self):
+        methods.add_tags_to_resource(self.owner, self.resources('m1', 'm2'),
+                                     {'env': 'dev', 'team': 'a'})
+        methods.remove_tags_from_resource(self.owner, self.resources('m1'),
+                                          {'env': None})
+        self.assertEqual(self.tags('m1'), {'team': 'a'})
+        self.assertEqual(self.tags('m2'), {'env': 'dev', 'team': 'a'})
+
+    def test_missing_resources(self):
+        for machine_ids in (('m1', 'm3'), ('m1', 'unknown')):
+            self.assertRaises(NotFoundError, methods.add_tags_to_resource,
+                              self.owner, self.resources(*machine_ids),
+                              {'env': 'dev'})
+        self.assertEqual(Tag.objects.count(), 0)
+        self.send.assert_not_called()
+
+    def test_sync_matches_update_tags(self):
+        tags = {'env': 'prod', 'team': 'a', 'empty': None}
+        methods.add_tags_to_resource(self.owner, self.resources('m1'), tags)
+        self.sync_sent()
+        machine = Machine.objects.get(id='m2')
+        with mock.patch.object(Machine, 'save'):
+            machine.update_tags(tags)
+        self.assertEqual(Machine.objects.get(id='m1').tags, machine.tags)
+
+    def test_queryset_insert_and_delete(self):
+        Tag.objects.insert([
+            Tag(owner=self.owner, resource_type='machine', resource_id=rid,
+                key='env', value='dev')
+            for rid in ('m2', 'm1', 'm2')])
+        self.send.assert_called_once_with('machine', ['m1', 'm2'])
+        self.sync_sent()
+        self.assertEqual(Machine.objects.get(id='m2').tags, ',env:dev,')
+        Tag.objects(resource_id='m2').delete()
+        self.send.assert_called_once_with('machine', ['m2'])
+        self.sync_sent()
+        self.assertEqual(Machine.objects.get(id='m2').tags, '')
+        self.assertEqual(Machine.objects.get(id='m1').tags, ',env:dev,')
+
+    def test_sync_batches(self):
+        with mock.patch.object(tasks.config, 'TAGS_BULK_BATCH_SIZE', 1):
+            methods.add_tags_to_resource(
+                self.owner, self.resources('m1', 'm2'), {'env': 'dev'})
+            self.send.reset_mock()
+            Tag.objects.delete()
+        self.assertEqual(self.send.call_args_list,
+                         [mock.call('machine', ['m1']),
+                          mock.call('machine', ['m2'])])
+
+
+class TestGetTags(unittest.TestCase):
+    def setUp(self):
+        use_mongomock(self)
+        self.owner = Organization(id='o' * 32, name='org')
+        self.auth_context = mock.Mock(owner=self.owner)
+        self.auth_context.is_owner.return_value = True
+        now = datetime.datetime.utcnow()
+        for machine_id, name, missing_since in (('m1', 'one', None),
+                                                ('m2', 'two', None),
+                                                ('m3', 'three', now)):
+            Machine._get_collection().insert_one(
+                {'_id': machine_id, 'owner': self.owner.id, 'cloud': 'c1',
+                 'external_id': machine_id, 'name': name,
+                 'missing_since': missing_since})
+        Zone._get_collection().insert_one(
+            {'_id': 'z1', 'owner': self.owner.id, 'cloud': 'c1',
+             'external_id': 'z1', 'domain': 'example.com.', 'type': 'master'})
+        tags = [
+            ('machine', 'm1', 'env', 'dev'),
+            ('machine', 'm2', 'env', 'dev'),
+            ('machine', 'm3', 'env', 'dev'),
+            ('machine', 'gone', 'env', 'dev'),
+            ('zone', 'z1', 'env', 'dev'),
+            ('machine', 'm1', 'env', 'prod'),
+            ('machine', 'm2', 'team', None),
+            ('machine', 'gone', 'old', 'x'),
+        ]
+        Tag._get_collection().insert_many([
+            {'owner': self.owner.id, 'resource_type': resource_type,
+             'resource_id': resource_id, 'key': key, 'value': value}
+            for resource_type, resource_id, key, value in tags])
+        Tag._get_collection().insert_one(
+            {'owner': 'other', 'resource_type': 'machine',
+             'resource_id': 'm1', 'key': 'env', 'value': 'dev'})
+
+    def get_tags(self, **kwargs):
+        data, meta = methods.get_tags(self.auth_context, **kwargs)
+        for item in data:
+            for field in ('machines', 'zones'):
+                if field in item:
+                    item[field] = sorted(item[field])
+        return data, meta
+
+    def test_grouped_by_key_and_value(self):
+        data, meta = self.get_tags()
+        self.assertEqual(data, [
+            {'tag': {'env': 'dev'}, 'resource_count': 4},
+            {'tag': {'env': 'prod'}, 'resource_count': 1},
+            {'tag': {'old': 'x'}, 'resource_count': 1},
+            {'tag': {'team': None}, 'resource_count': 1},
+        ])
+        self.assertEqual(meta, {'total': 4, 'returned': 4, 'sort': 'key',
+                                'start': 0})
+
+    def test_resources_per_type(self):
+        data, _ = self.get_tags(types='machines,zones',
+                                sort='-resource_count')
+        self.assertEqual(data[0], {'tag': {'env': 'dev'},
+                                   'resource_count': 4,
+                                   'machines': ['gone', 'm1', 'm2'],
+                                   'zones': ['z1']})
+        self.assertEqual([item['tag'] for item in data[1:]],
+                         [{'env': 'prod'}, {'old': 'x'}, {'team': None}])
+        data, _ = self.get_tags(types='zones')
+        self.assertEqual(data, [{'tag': {'env': 'dev'}, 'resource_count': 1,
+                                 'zones': ['z1']}])
+
+    def test_deref_by_name(self):
+        data, _ = self.get_tags(types='machines,zones', deref='name')
+        self.assertEqual(data, [
+            {'tag': {'env': 'dev'}, 'resource_count': 4,
+             'machines': ['one', 'two'], 'zones': ['example.com.']},
+            {'tag': {'env': 'prod'}, 'resource_count': 1,
+             'machines': ['one']},
+            {'tag': {'old': 'x'}, 'resource_count': 1},
+            {'tag': {'team': None}, 'resource_count': 1,
+             'machines': ['two']},
+        ])
+
+    def test_pagination(self):
+        data, meta = self.get_tags(types='machines', start=1, limit=2)
+        self.assertEqual([item['tag'] for item in data],
+                         [{'env': 'prod'}, {'old': 'x'}])
+        self.assertEqual(meta, {'total': 4, 'returned': 2, 'sort': 'key',
+                                'start': 1})
+        data, meta = self.get_tags(start=10, limit=2)
+        self.assertEqual(data, [])
+        self.assertEqual(meta['total'], 4)
+        data, meta = self.get_tags(search='key:env', sort='-key')
+        self.assertEqual([item['tag'] for item in data],
+                         [{'env': 'prod'}, {'env': 'dev'}])
+        self.assertEqual(meta['total'], 2)
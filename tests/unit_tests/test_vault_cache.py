@@ -0,0 +1,129 @@
+import json
+import unittest
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from unittest import mock
+
+from mist.api.secrets import cache
+from mist.api.secrets import controllers
+from mist.api.secrets.controllers import KV2VaultSecretController
+
+from .helpers import start_server, start_patches
+
+
+class FakeVaultHandler(BaseHTTPRequestHandler):
+    """A KV v2 secrets engine mounted at /v1/org/ accepting token t1"""
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self):
+        path = self.path.split('?')[0]
+        self.server.requests[(self.command, path)] += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or '{}')
+        if self.headers.get('X-Vault-Token') != 't1':
+            return self.reply(403, {'errors': ['permission denied']})
+        if path == '/v1/auth/token/lookup-self':
+            return self.reply(200, {'data': {'id': 't1'}})
+        if path.startswith('/v1/sys/mounts/'):
+            return self.reply(400, {'errors': ['path is already in use']})
+        if path.startswith('/v1/org/metadata/'):
+            self.server.secrets.pop(path[len('/v1/org/metadata/'):], None)
+            return self.reply(204)
+        if not path.startswith('/v1/org/data/'):
+            return self.reply(404, {'errors': []})
+        name = path[len('/v1/org/data/'):]
+        if self.command == 'GET':
+            if self.server.forbidden:
+                self.server.forbidden -= 1
+                return self.reply(403, {'errors': ['permission denied']})
+            if name not in self.server.secrets:
+                return self.reply(404, {'errors': []})
+            version, data = self.server.secrets[name]
+            return self.reply(200, {'data': {
+                'data': data, 'metadata': {'version': version}}})
+        version, data = self.server.secrets.get(name, (0, {}))
+        data = dict(data, **body['data']) if self.command == 'PATCH' \
+            else body['data']
+        self.server.secrets[name] = (version + 1, data)
+        return self.reply(200, {'data': {'version': version + 1}})
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+class TestVaultSecretCache(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server(
+            self, FakeVaultHandler, requests=Counter(),
+            secrets={'creds': (1, {'password': 'old'})}, forbidden=0)
+        self.org = mock.Mock(
+            id='o1', vault_token='t1', vault_role_id=None,
+            vault_secret_id=None, vault_secret_engine_path='org',
+            vault_address='http://127.0.0.1:%d' % self.server.server_port)
+        start_patches(
+            self,
+            mock.patch.object(controllers, '_vault_clients', {}),
+            mock.patch.object(controllers, 'secret_cache',
+                              cache.SecretCache(10, 60)),
+            mock.patch.object(cache.SecretCache, '_ensure_listener'),
+            mock.patch('mist.api.helpers.amqp_publish'),
+            mock.patch.object(KV2VaultSecretController, 'list_secrets'),
+        )
+
+    def count(self, method, path):
+        return self.server.requests[(method, path)]
+
+    def test_repeated_reads(self):
+        for _ in range(3):
+            ctl = KV2VaultSecretController(self.org)
+            self.assertEqual(ctl.read_secret('creds'), {'password': 'old'})
+        self.assertEqual(self.count('GET', '/v1/org/data/creds'), 1)
+        self.assertEqual(self.count('GET', '/v1/auth/token/lookup-self'), 1)
+
+    def test_read_after_write(self):
+        ctl = KV2VaultSecretController(self.org)
+        ctl.read_secret('creds')
+        ctl.create_or_update_secret('creds', {'password': 'new'})
+        self.assertEqual(ctl.read_secret('creds'), {'password': 'new'})
+        ctl.delete_secret('creds')
+        self.assertRaises(controllers.BadRequestError, ctl.read_secret,
+                          'creds')
+
+    def test_revalidate_on_forbidden(self):
+        ctl = KV2VaultSecretController(self.org)
+        self.server.forbidden = 1
+        self.assertEqual(ctl.read_secret('creds'), {'password': 'old'})
+        self.assertEqual(self.count('GET', '/v1/org/data/creds'), 2)
+        self.assertEqual(self.count('GET', '/v1/auth/token/lookup-self'), 2)
+
+
+class TestSecretCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.SecretCache(2, 60)
+        self.cache._ensure_listener = mock.Mock()
+
+    def test_older_version_not_cached(self):
+        self.cache._on_invalidate({'key': ['vault', 'org', 'creds'],
+                                   'version': 3})
+        self.cache.set(('vault', 'org', 'creds'), 2, {'password': 'old'})
+        self.assertIsNone(self.cache.get(('vault', 'org', 'creds')))
+        self.cache.set(('vault', 'org', 'creds'), 3, {'password': 'new'})
+        self.assertEqual(self.cache.get(('vault', 'org', 'creds')),
+                         {'password': 'new'})
+
+    def test_invalidate_prefix(self):
+        self.cache.set(('vault', 'org', 'a'), 1, {})
+        self.cache.set(('vault', 'other', 'b'), 1, {})
+        self.cache._on_invalidate({'prefix': ['vault', 'org']})
+        self.assertIsNone(self.cache.get(('vault', 'org', 'a')))
+        self.assertEqual(self.cache.get(('vault', 'other', 'b')), {})
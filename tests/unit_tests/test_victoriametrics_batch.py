@@ -0,0 +1,110 @@
+import re
+import json
+import unittest
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler
+from unittest import mock
+
+from mist.api import config
+from mist.api.monitoring.victoriametrics import methods
+
+from .helpers import start_server, start_patches
+
+
+def inject_machine_id(query, machine_id):
+    return '%s{machine_id="%s"}' % (query, machine_id)
+
+
+class FakeVictoriaMetricsHandler(BaseHTTPRequestHandler):
+    """Return a series for each machine id matched by a query"""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        query = urllib.parse.parse_qs(
+            urllib.parse.urlparse(self.path).query)['query'][0]
+        machine_ids = re.search(r'machine_id=~"([^"]*)"',
+                                query).group(1).split('|')
+        body = json.dumps({'status': 'success', 'data': {
+            'resultType': 'matrix',
+            'result': [{
+                'metric': {'__name__': 'system_load1',
+                           'machine_id': machine_id},
+                'values': [[1600000000, '%d' % i]],
+            } for i, machine_id in enumerate(machine_ids)],
+        }}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGetStatsBatch(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server(self, FakeVictoriaMetricsHandler,
+                                   requests=[])
+        uri = 'http://127.0.0.1:%d/select/<org_id>/prometheus' % (
+            self.server.server_port)
+        start_patches(
+            self,
+            mock.patch.object(config, 'VICTORIAMETRICS_URI', uri),
+            mock.patch.object(methods, 'inject_promql_machine_id',
+                              inject_machine_id),
+        )
+        self.org = mock.Mock(id='0123abcd' * 4)
+
+    def get_stats_batch(self, count):
+        machine_ids = ['%032x' % i for i in range(count)]
+        del self.server.requests[:]
+        data = methods.get_stats_batch(self.org, machine_ids, 'system_load1',
+                                       start='10m')
+        self.assertEqual(set(data), set(machine_ids))
+        for machine_id in machine_ids:
+            self.assertEqual(len(data[machine_id]), 1)
+            series = list(data[machine_id].values())[0]
+            self.assertEqual(series['metric']['machine_id'], machine_id)
+        return len(self.server.requests)
+
+    def test_requests_constant(self):
+        with mock.patch.object(config, 'VICTORIAMETRICS_MAX_URL_LENGTH',
+                               60000):
+            self.assertEqual(self.get_stats_batch(1), 1)
+            self.assertEqual(self.get_stats_batch(100), 1)
+            self.assertEqual(self.get_stats_batch(1000), 1)
+
+    def test_requests_chunked(self):
+        max_length = config.VICTORIAMETRICS_MAX_URL_LENGTH
+        count = self.get_stats_batch(2000)
+        self.assertGreater(count, 1)
+        self.assertLessEqual(count, 2000 * 36 // (max_length // 2))
+        for path in self.server.requests:
+            self.assertLessEqual(
+                len('http://127.0.0.1:%d' % self.server.server_port) +
+                len(path), max_length)
+
+    def test_aggregated_series(self):
+        def aggregate(query, machine_id):
+            return 'sum(%s)' % inject_machine_id(query, machine_id)
+
+        with mock.patch.object(methods, 'inject_promql_machine_id',
+                               aggregate):
+            with mock.patch.object(FakeVictoriaMetricsHandler, 'do_GET',
+                                   _do_get_without_labels):
+                self.assertRaises(ValueError, methods.get_stats_batch,
+                                  self.org, ['a', 'b'], 'system_load1')
+
+
+def _do_get_without_labels(self):
+    self.server.requests.append(self.path)
+    body = json.dumps({'status': 'success', 'data': {
+        'resultType': 'matrix',
+        'result': [{'metric': {}, 'values': [[1600000000, '1']]}],
+    }}).encode()
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)